@@ -5,10 +5,19 @@ __author__ = 'wack'
 # patched for Python 3.9 in 2022
 # under development
 
+import logging
 import sys
-import matplotlib.pyplot as plt
+from array import array
+from functools import lru_cache
+from itertools import chain
+
 import numpy as np
-from scipy.interpolate import griddata
+from numpy.lib.stride_tricks import sliding_window_view
+
+from forc_filter import Convolve
+from forc_grid import CachedDelaunay, rotate_to_hc_hu
+
+log = logging.getLogger(__name__)
 
 
 def fitPolySurface(x, y, z):
@@ -30,42 +39,123 @@ def fitPolySurface(x, y, z):
     # return np.linalg.lstsq(v.T, z)
 
 
-def importFORCdata(filename, reflect=True, skipchunks=0):
+@lru_cache(maxsize=None)
+def polySurfaceDesign(SF):
+    """ design matrix of fitPolySurface for a (2*SF+1)^2 subarea, points in row major order """
+    x, y = np.meshgrid(np.arange(2 * SF + 1), np.arange(2 * SF + 1), indexing='ij')  # x: row, y: column index
+    x, y = x.ravel().astype(float), y.ravel().astype(float)
+    v = np.array([np.ones(len(x)), x, y, x ** 2, y ** 2, x * y]).T
+    v.setflags(write=False)  # cached, must not be changed by callers
+    return v
+
+
+@lru_cache(maxsize=None)
+def polySurfaceKernel(SF):
+    """ weights giving the mixed coefficient c5 of fitPolySurface for a complete (2*SF+1)^2 subarea """
+    # for a subarea without nan values the least squares solution is pinv(v) @ z, i.e. c5 is a fixed
+    # linear combination (Savitzky-Golay like kernel) of the values in the subarea
+    k = np.linalg.pinv(polySurfaceDesign(SF))[5].reshape(2 * SF + 1, 2 * SF + 1)
+    k.setflags(write=False)  # cached, must not be changed by callers
+    return k
+
+
+def compute_forc_distribution(grid, SF=2, chunksize=4096):
+    """ FORC distribution -0.5 * d2M / dHa dHb of gridded data by local polynomial surface fits
+
+    gives the same values as fitting fitPolySurface to every (2*SF+1)^2 subarea of grid
+    (derivatives in units of grid steps). Border points without a complete subarea are nan.
+    """
+    if SF < 1:
+        raise ValueError('smoothing factor SF must be at least 1')
+
+    zi = np.asarray(grid, dtype=float)
+    n = 2 * SF + 1
+    forc = np.full(zi.shape, np.nan)
+    if zi.shape[0] < n or zi.shape[1] < n:
+        return forc
+
+    isnan = np.isnan(zi)
+    # count nan values in each subarea by summed area table
+    c = np.pad(isnan.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    nancount = c[n:, n:] - c[:-n, n:] - c[n:, :-n] + c[:-n, :-n]
+
+    # subareas without nan: one correlation with the fit kernel (rank one, convolved as two 1d passes)
+    c5 = Convolve(np.where(isnan, 0, zi), polySurfaceKernel(SF)[::-1, ::-1], mode='constant')[SF:-SF, SF:-SF]
+
+    # subareas with only nan: fitPolySurface returns zero coefficients
+    c5[nancount == n * n] = 0
+
+    # subareas with some nan values: batched least squares fit of the remaining points
+    ii, jj = np.nonzero((nancount > 0) & (nancount < n * n))
+    windows = sliding_window_view(zi, (n, n))
+    # normal equations in centered and scaled coordinates are well conditioned, c5 just scales with SF**2
+    vs = polySurfaceDesign(SF)
+    vs = np.array([vs[:, 0], vs[:, 1] - SF, vs[:, 2] - SF, (vs[:, 1] - SF) ** 2, (vs[:, 2] - SF) ** 2,
+                   (vs[:, 1] - SF) * (vs[:, 2] - SF)]).T / np.array([1, SF, SF, SF ** 2, SF ** 2, SF ** 2])
+    vv = (vs[:, :, np.newaxis] * vs[:, np.newaxis, :]).reshape(n * n, 36)
+    for start in range(0, len(ii), chunksize):
+        ic, jc = ii[start:start + chunksize], jj[start:start + chunksize]
+        z = windows[ic, jc].reshape(-1, n * n)
+        idx = ~np.isnan(z)
+        z = np.where(idx, z, 0)
+        g = (idx @ vv).reshape(-1, 6, 6)
+        ev = np.linalg.eigvalsh(g)
+        ok = ev[:, 0] > 1e-8 * ev[:, -1]
+        c5[ic[ok], jc[ok]] = np.linalg.solve(g[ok], (z[ok] @ vs)[:, :, np.newaxis])[:, 5, 0] / SF ** 2
+
+        # (nearly) rank deficient fits: minimum norm solution of lstsq as in fitPolySurface
+        x, y = polySurfaceDesign(SF)[:, 1], polySurfaceDesign(SF)[:, 2]
+        for k in np.flatnonzero(~ok):
+            c5[ic[k], jc[k]] = fitPolySurface(x, y, np.where(idx[k], z[k], np.nan))[0][5]
+
+    forc[SF:-SF, SF:-SF] = -0.5 * c5
+    return forc
+
+
+def importFORCdata(filename, reflect=True, skipchunks=0, logger=None):
     # file format
     # long header
     # comma separated values: applied field, magnetic moment, (temperature)
     # alternating data chunks of drift field and FORC curves
+    #
+    # the file is parsed in a single pass, values are appended to growable flat buffers
+    # which are converted to numpy arrays once at the end (no np.vstack per line)
+
+    if logger is None:
+        logger = log
 
     def readMicroMagHeader(lines):
+        # lines is an iterator over the file, returns header and the line which terminated the header
         sectionstart = False
         sectiontitle = None
         sectioncount = 0
         header = {}
         # section header: CAPITALS, no spaces
         lc = 0
+        l = None
         for l in lines:
             lc += 1
             sl = l.strip()  # take away any leading and trailing whitespaces
             if lc == 1 and not sl.startswith("MicroMag 2900/3900 Data File"):  # check first line
-                print("No valid MicroMag file. Header not found in first line.")
-                return None
+                logger.error("No valid MicroMag file. Header not found in first line.")
+                return None, None
 
             if len(sl) == 0:  # empty line
                 if sectionstart:  # this is already the second empty line, something is wrong
-                    print('reading header finished at line %d' % (lc - 1))
+                    logger.debug('reading header finished at line %d', lc - 1)
                     break  # end of header
                 sectionstart = True
                 continue  # go to next line
             if sectionstart:  # previous line was empty
                 sectionstart = False
                 if sl.isupper():  # we have a capitalized section header
-                    print('reading header section %s' % sl)
+                    logger.debug('reading header section %s', sl)
                     sectiontitle = sl
                     header[sectiontitle] = {}  # make new dictionary to gather data fields
                     sectioncount += 1
                     continue  # go to next line
                 else:  # no captitalized section header after empty line -> we are probably at the end of the header
-                    print('reading header finished at line %d' % lc - 1)
+                    logger.debug('reading header finished at line %d', lc - 1)
                     break  # end of header
             if sectiontitle is not None:  # we are within a section
                 # split key value at fixed character position
@@ -76,106 +166,102 @@ def importFORCdata(filename, reflect=True, skipchunks=0):
         header['meta'] = {}
         header['meta']['numberoflines'] = lc - 1  # store header length
         header['meta']['numberofsections'] = sectioncount
-        return header
+        return header, l
 
     datachunktype = 'drift'  # defines actual chunk type 'drift' / 'forc'
 
-    driftdata = None
-    forcdata = None
-
-    f = open(filename)
-    # find start of data
+    # flat growable buffers, 3 values (H, M, T) per drift point and 4 values (Ha, Hb, M, T) per forc point
+    driftbuf = array('d')
+    forcbuf = array('d')
 
     hl = -1  # line number of data header
     chunkline = 0  # line number within current data chunk
     chunkcount = 0  # count number of chunks in file
     Halen = 0  # Ha dimension of data
     Hblen = 0  # Hb dimension of data
+    Ha, MHa = 0.0, 0.0
 
-    lines = f.readlines()
-
-    f.close()
-
-    header = readMicroMagHeader(lines)
+    with open(filename) as f:
+        header, lastline = readMicroMagHeader(f)
 
-    if header is None:  # no valid data file
-        return None
+        if header is None:  # no valid data file
+            return None
 
-    print(header)
+        logger.debug('header: %s', header)
 
-    cl = header['meta']['numberoflines']  # current line number
+        cl = header['meta']['numberoflines']  # current line number
 
-    for line in lines[cl:]:
-        cl += 1  # increase current line number count
-        if "".join(line.split()).startswith('FieldMoment'):
-            hl = cl  # set header line number to current line number
-            print('data header detected in line %d' % hl)
+        # the line which terminated the header is processed again as first data line candidate
+        for line in chain((lastline,), f) if lastline is not None else f:
+            cl += 1  # increase current line number count
+            if hl == -1:
+                if "".join(line.split()).startswith('FieldMoment'):
+                    hl = cl  # set header line number to current line number
+                    logger.debug('data header detected in line %d', hl)
+                continue
 
-        if cl > hl + 1 and hl != -1:  # now we are in the data part
+            if cl <= hl + 1:  # skip line following the data header
+                continue
 
-            if line.strip() == '':  # empty line toggles between drift and forc data chunk
+            # now we are in the data part
+            sl = line.strip()
+            if sl == '':  # empty line toggles between drift and forc data chunk
                 chunkcount += 1
                 if not chunkcount < skipchunks:
                     if datachunktype == 'drift':
                         datachunktype = 'forc'
-                    elif datachunktype == 'forc':
+                    else:
                         datachunktype = 'drift'
                 chunkline = 0
 
                 continue  # go on to next line
 
+            if sl.startswith('MicroMag 2900/3900 Data File ends'):  # regular end of file
+                break
+
             # go to next line in file if we have to skip this chunk
             if chunkcount < skipchunks:
                 continue
 
             # here we know that we have to expect a valid data line of datachunktype
             chunkline += 1
-            lstrs = line.strip().split(',')  # split comma seperated values
+            lstrs = sl.split(',')  # split comma seperated values
             if len(lstrs) < 2:
-                print('ERROR: line %d does not contain comma seperated values. Skipping rest of file.' % cl)
+                logger.error('line %d does not contain comma seperated values. Skipping rest of file.', cl)
+                break
+            if len(lstrs) > 3:
+                logger.error('line %d contains more than three values. Skipping rest of file.', cl)
                 break
-            # dl = np.array( map( float, lstrs))
-            dl = np.array(lstrs, dtype=float)
-            print(dl)
-            if len(dl) == 2:  # we only got two elements, i.e. no temperature
-                dl = np.append(dl, 0)  # lets append a zero for now
+            H = float(lstrs[0])
+            M = float(lstrs[1])
+            T = float(lstrs[2]) if len(lstrs) == 3 else 0.0  # no temperature -> lets use zero for now
 
             if datachunktype == 'drift':
-                print("reading drift chunk from line %d" % cl)
                 if chunkline > 1:
-                    print(
-                        'ERROR: more than one dataset found in drift data chunk (line %d). Skipping rest of file.' % cl)
+                    logger.error('more than one dataset found in drift data chunk (line %d). Skipping rest of file.',
+                                 cl)
                     break
                 # add dataset to driftdata
-                if driftdata is None:
-                    driftdata = np.reshape(dl, (1, len(dl)))  # reshape needed to form 2D array
-                else:
-                    driftdata = np.vstack((driftdata, dl))  # append line to array
+                driftbuf.extend((H, M, T))
 
-            elif datachunktype == 'forc':
-                # add dataset to forcdata
+            else:  # forc chunk
                 if chunkline == 1:  # start of forc chunk --> first value is Ha
-                    print("reading forc chunk from line %d" % cl)
-                    Ha = dl[0]
-                    MHa = dl[1]  # magnetic moment at Ha, needed to reflect data
+                    Ha = H
+                    MHa = M  # magnetic moment at Ha, needed to reflect data
                     Halen += 1  # count number of Ha steps
-                Hb, M, T = dl
-                fl = np.array((Ha, Hb, M, T))
-                if forcdata is None:
-                    forcdata = np.reshape(fl, (1, len(fl)))  # reshape needed to form 2D array
-                else:
-                    print('adding forc point line %d' % cl)
-                    forcdata = np.vstack((forcdata, fl))  # append line to array
-                    if reflect:  # extend forc space to Hb < Ha by point reflection for each branch
-                        flr = np.array((fl[0], 2 * fl[0] - fl[1], 2 * MHa - M, T))  # create reflected point
-                        forcdata = np.vstack((forcdata, flr))
-                        chunkline += 1
-                    print('done adding forc point line %d' % cl)
+                firstpoint = len(forcbuf) == 0  # very first forc point of the file is not reflected
+                forcbuf.extend((Ha, H, M, T))  # add dataset to forcdata
+                if reflect and not firstpoint:  # extend forc space to Hb < Ha by point reflection for each branch
+                    forcbuf.extend((Ha, 2 * Ha - H, 2 * MHa - M, T))  # add reflected point
+                    chunkline += 1
                 if chunkline > Hblen:
                     Hblen = chunkline  # make Hblen size of largest FORC chunk
 
-            else:
-                print('bad datachunktype: ' + str(datachunktype))
+    driftdata = np.frombuffer(driftbuf, dtype=float).reshape(-1, 3) if len(driftbuf) > 0 else None
+    forcdata = np.frombuffer(forcbuf, dtype=float).reshape(-1, 4) if len(forcbuf) > 0 else None
+
+    logger.info('imported %d drift and %d forc points from %s',
+                0 if driftdata is None else len(driftdata), 0 if forcdata is None else len(forcdata), filename)
 
     return driftdata, forcdata, Halen, Hblen
 
@@ -200,6 +286,9 @@ def TranslateHaHbHcHu(HaHbdata):
 
 
 if __name__ == '__main__':  # test routine
+    from scipy.interpolate import CloughTocher2DInterpolator
+    from forc_plot import PlotForcGrid, Show
+    logging.basicConfig(level=logging.DEBUG)
 
     #forcdata = importFORCdata('../data/140401-Gd2O3_2.forc')
     forcdata = importFORCdata('../data/FeNi100-A-a-24-M001_005.forc', reflect=True)
@@ -235,48 +324,21 @@ if __name__ == '__main__':  # test routine
     grid = np.meshgrid(xi, yi)
     # grid the data
     points = np.column_stack((x,y))
-    zi = griddata(points, z, tuple(grid), method='cubic', fill_value=np.nan)
+    zi = CloughTocher2DInterpolator(CachedDelaunay(points), z, fill_value=np.nan)(tuple(grid))
 
-    # contour the gridded data
-    plt.contourf(xi, yi, zi, 50, cmap=plt.cm.get_cmap("jet"))
-
-    # plt.imshow( zi, origin='lower', extent=(minHb, maxHb, minHa, maxHa), cmap='jet')
-    plt.colorbar()  # draw colorbar
-    plt.xlabel('Hb')
-    plt.ylabel('Ha')
-    plt.title('FORC raw data (magnetic moments)')
-    plt.axis('equal')
-    # plt.show()
+    # plot the gridded data
+    PlotForcGrid(xi, yi, zi, title='FORC raw data (magnetic moments)', figure=1)
 
     # calculate FORC diagram by fitting polygon surfaces to subareas of the gridded data
     SF = 2  # smoothing factor (use subarea of (2*SF+1)^2 for fitting)
 
-    fittedFORCdata = None
-
-    for Hbc in range(SF, Hblen - SF):  # walk through Ha and Hb space
-        for Hac in range(SF, Halen - SF):
-            # get sub area of gridded data
-            fitdata = zi[Hac - SF:Hac + SF + 1, Hbc - SF:Hbc + SF + 1]
-
-            if fitdata.shape == (2 * SF + 1, 2 * SF + 1):  # check if data is available for all points of subarea
-                Hafd, Hbfd, Mfd = [], [], []
-                for Hbfc in range(fitdata.shape[0]):
-                    for Hafc in range(fitdata.shape[1]):
-                        Hafd.append(Hafc)
-                        Hbfd.append(Hbfc)
-                        Mfd.append(fitdata[Hbfc, Hafc])
+    fitted = compute_forc_distribution(zi, SF)
 
-                # fit polynomial surface to sub area  f = c0 + c1 x + c2 y + c3 x**2 + c4 y**2 + c5 x*y
-                coefficients, residues, rank, singval = fitPolySurface(np.array(Hbfd), np.array(Hafd), np.array(Mfd))
-
-                # fitted data -> one point in FORC diagram
-                fdata = np.array((minHa + (maxHa - minHa) / Halen * Hac, minHb + (maxHb - minHb) / Hblen * Hbc,
-                                  -0.5 * coefficients[5]))
-
-                if fittedFORCdata is None:
-                    fittedFORCdata = np.reshape(fdata, (1, len(fdata)))  # reshape needed to form 2D array
-                else:
-                    fittedFORCdata = np.vstack((fittedFORCdata, fdata))  # append line to array
+    # fitted data -> one point in FORC diagram for each inner grid point
+    Hac, Hbc = np.meshgrid(np.arange(SF, Halen - SF), np.arange(SF, Hblen - SF), indexing='xy')
+    fittedFORCdata = np.column_stack((minHa + (maxHa - minHa) / Halen * Hac.ravel(),
+                                      minHb + (maxHb - minHb) / Hblen * Hbc.ravel(),
+                                      fitted[Hac.ravel(), Hbc.ravel()]))
 
     # plot FORC diagram in Ha, Hb
     x, y, z = fittedFORCdata[:, 1], fittedFORCdata[:, 0], fittedFORCdata[:, 2]
@@ -287,48 +349,21 @@ if __name__ == '__main__':  # test routine
 
     # grid the data
     points = np.column_stack((x, y))
-    zi = griddata(points, z, tuple(grid), method='cubic', fill_value=np.nan)
+    zi = CloughTocher2DInterpolator(CachedDelaunay(points), z, fill_value=np.nan)(tuple(grid))
     # print zi
-    plt.figure(2)
-    # contour the gridded data
-    plt.contourf(xi, yi, zi, 50, cmap=plt.cm.get_cmap("jet"))
-    # print(zi)
-    # plt.imshow( zi, origin='lower', extent=(minHb, maxHb, minHa, maxHa), cmap='RdBu')
-    plt.colorbar()  # draw colorbar
-    plt.xlabel('Hb')
-    plt.ylabel('Ha')
-    plt.title('FORC processed (SF=%d)' % SF)
-    plt.axis('equal')
+    PlotForcGrid(xi, yi, zi, title='FORC processed (SF=%d)' % SF, figure=2)
 
     print(fittedFORCdata.shape)
-    fittedFORCdata = TranslateHaHbHcHu(fittedFORCdata)
-
-    x, y, z = fittedFORCdata[:, 0], fittedFORCdata[:, 1], fittedFORCdata[:, 2]
-    # define grid
-
-    xi = np.linspace(0, max(x), Halen * 2)  # Hc space
-    yi = np.linspace(min(y), max(y), Hblen * 2)  # Hu space
-    grid = np.meshgrid(xi, yi)
-
-    # grid the data
-    points = np.column_stack((x, y))
-    zi = griddata(points, z, tuple(grid), method='cubic', fill_value=np.nan)
-    plt.figure(3)
-    # contour the gridded data
-    plt.contourf(xi, yi, zi, 50, cmap=plt.cm.get_cmap("jet"))
-    plt.axhline(0, color='black')
-    # plt.imshow( zi, origin='lower', extent=(minHb, maxHb, minHa, maxHa), cmap='RdBu')
-    plt.colorbar()  # draw colorbar
-    # plot data points.
-    plt.xlabel('Hc')
-    plt.ylabel('Hu')
-    # show data points
-    # plt.scatter( x, y)
-    plt.title('FORC processed (SF=%d)' % SF)
-    # plt.axis('equal')
+    # fitted data lie on a regular Ha, Hb lattice and Hc, Hu is its 45 degree rotation -> resample it directly
+    # (bilinear, Hc space 2 * Halen, Hu space 2 * Hblen points)
+    haxis = minHa + (maxHa - minHa) / Halen * np.arange(SF, Halen - SF)
+    hbaxis = minHb + (maxHb - minHb) / Hblen * np.arange(SF, Hblen - SF)
+    xi, yi, zi = rotate_to_hc_hu(fitted[SF:Halen - SF, SF:Hblen - SF], (hbaxis, haxis), hc=Halen * 2, hu=Hblen * 2)
+    PlotForcGrid(xi, yi, zi, title='FORC processed (SF=%d)' % SF, xlabel='Hc', ylabel='Hu', figure=3, axhline=True,
+                 equal=False)
 
     # plt.xlim( [0, 0.1])
     # plt.ylim( [-0.1, 0.03])
     # plt.savefig( fname + '.png')
 
-    plt.show()
\ No newline at end of file
+    Show('forc')
\ No newline at end of file
@@ -0,0 +1,241 @@
+__author__ = 'wack'
+
+# Derived parameters of FORC diagrams
+# profiles, marginal distributions, peak positions and widths and integrated moments computed directly on
+# gridded FORC distributions: Hc, Hu grids (..., rows Hu, columns Hc) as returned by GridHcHu and Ha, Hb grids
+# (..., rows Ha, columns Hb). All functions work on single diagrams and on stacks (batch results, series) without
+# per pixel loops, nan grid points count as zero in integrals.
+#
+# usage: python forc_analysis.py results/*.npz -o parameters.csv
+
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+
+from forc_filter import KernelScale, MixedDerivativeKernel
+from forc_store import OpenResult
+
+RESULT_KEYS = ('names', 'Hb', 'Ha', 'forc', 'Hc', 'Hu', 'forc_hchu', 'Ms', 'normalized')  # read from result files
+
+
+def Step(axis):
+    """ spacing of an evenly spaced axis (1 for a single value) """
+    return abs(axis[1] - axis[0]) if len(axis) > 1 else 1.0
+
+
+def ForcDensity(hb, ha, forc, k=None):
+    """ FORC distribution in moment per field squared from the convolution result of kernel k (default
+    FORC_KERNEL) on the Hb axis hb, Ha axis ha grid
+    """
+    if k is None:
+        from forc_convolution import FORC_KERNEL
+        k = FORC_KERNEL
+    return np.asarray(forc, dtype=float) * KernelScale(k) / (Step(hb) * Step(ha))
+
+
+def CentralRidge(hc, hu, forc):
+    """ profile along Hu = 0 (..., len(hc)), linearly interpolated between the neighbouring Hu rows """
+    hu = np.asarray(hu, dtype=float)
+    i = np.clip(np.searchsorted(hu, 0.0) - 1, 0, len(hu) - 2)
+    w = np.clip((0.0 - hu[i]) / (hu[i + 1] - hu[i]), 0, 1)
+    return (1 - w) * forc[..., i, :] + w * forc[..., i + 1, :]
+
+
+def CoercivityDistribution(hc, hu, forc):
+    """ marginal distribution over Hc: integral over Hu (..., len(hc)) """
+    return np.where(np.isfinite(forc), forc, 0).sum(axis=-2) * Step(hu)
+
+
+def InteractionDistribution(hc, hu, forc):
+    """ marginal distribution over Hu: integral over Hc (..., len(hu)) """
+    return np.where(np.isfinite(forc), forc, 0).sum(axis=-1) * Step(hc)
+
+
+def PeakFit(axis, profile):
+    """ subpixel peak position, height and full width at half maximum of profiles (..., len(axis))
+
+    position and height from a parabola through the maximum and its neighbours, half maximum crossings
+    linearly interpolated on both sides (nan if the profile does not fall below half of its maximum)
+    returns position, height, fwhm (arrays with the leading shape of profile)
+    """
+    axis = np.asarray(axis, dtype=float)
+    p = np.where(np.isfinite(profile), profile, -np.inf)
+    n = p.shape[-1]
+    k = p.argmax(axis=-1)[..., np.newaxis]
+    y1 = np.take_along_axis(p, k, axis=-1)[..., 0]
+    y0 = np.take_along_axis(p, np.maximum(k - 1, 0), axis=-1)[..., 0]
+    y2 = np.take_along_axis(p, np.minimum(k + 1, n - 1), axis=-1)[..., 0]
+    k = k[..., 0]
+
+    # parabola vertex, only for inner maxima with finite neighbours (profiles without data give -inf here)
+    with np.errstate(invalid='ignore'):
+        curvature = y0 - 2 * y1 + y2
+        inner = (k > 0) & (k < n - 1) & np.isfinite(y0) & np.isfinite(y2) & (curvature < 0)
+        offset = np.zeros(k.shape)
+        np.divide(0.5 * (y0 - y2), curvature, out=offset, where=inner)
+        offset = np.clip(offset, -0.5, 0.5)
+        height = np.where(inner, y1 - 0.25 * (y0 - y2) * offset, y1)
+    step = axis[1] - axis[0] if n > 1 else 1.0
+    position = axis[k] + offset * step
+
+    # half maximum crossings: last point below half maximum left of the peak, first one right of it
+    half = height[..., np.newaxis] / 2
+    index = np.arange(n)
+    below = p < half
+    left = np.where(below & (index < k[..., np.newaxis]), index, -1).max(axis=-1)
+    right = np.where(below & (index > k[..., np.newaxis]), index, n).min(axis=-1)
+    found = (left >= 0) & (right < n) & (height > 0)
+    l0, r1 = np.clip(left, 0, n - 2), np.clip(right, 1, n - 1)
+    pl0, pl1 = np.take_along_axis(p, l0[..., None], -1)[..., 0], np.take_along_axis(p, l0[..., None] + 1, -1)[..., 0]
+    pr0, pr1 = np.take_along_axis(p, r1[..., None] - 1, -1)[..., 0], np.take_along_axis(p, r1[..., None], -1)[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xl = axis[l0] + (half[..., 0] - pl0) / (pl1 - pl0) * step
+        xr = axis[r1 - 1] + (pr0 - half[..., 0]) / (pr0 - pr1) * step
+    fwhm = np.where(found, xr - xl, np.nan)
+    nodata = ~np.isfinite(y1)
+    return np.where(nodata, np.nan, position), np.where(nodata, np.nan, height), fwhm
+
+
+def ForcMoments(hc, hu, forc):
+    """ integrated moments of the FORC distribution over the Hc, Hu plane (integrals in dHc dHu = dHa dHb / 2)
+
+    returns dictionary with integral, positive (integral of positive values), mean_hc, mean_hu, std_hc, std_hu
+    (weights: distribution clipped at zero, negative regions are noise or interaction artefacts)
+    """
+    z = np.where(np.isfinite(forc), forc, 0)
+    cell = Step(hc) * Step(hu)
+    w = np.clip(z, 0, None)
+    total = w.sum(axis=(-2, -1))
+    wc, wu = w.sum(axis=-2), w.sum(axis=-1)  # marginals over Hc and Hu
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_hc = (wc * hc).sum(axis=-1) / total
+        mean_hu = (wu * hu).sum(axis=-1) / total
+        var_hc = (wc * hc ** 2).sum(axis=-1) / total - mean_hc ** 2
+        var_hu = (wu * hu ** 2).sum(axis=-1) / total - mean_hu ** 2
+    return {'integral': z.sum(axis=(-2, -1)) * cell, 'positive': total * cell, 'mean_hc': mean_hc,
+            'mean_hu': mean_hu, 'std_hc': np.sqrt(np.clip(var_hc, 0, None)),
+            'std_hu': np.sqrt(np.clip(var_hu, 0, None))}
+
+
+def ReversibleRatio(hb, ha, density, ridge=None, Ms=None):
+    """ reversible and irreversible parts of the FORC distribution density (moment per field squared, see
+    ForcDensity) on the Hb axis hb, Ha axis ha grid of mirrored data
+
+    the reversible part is the integral over Hc = (Hb - Ha) / 2 <= ridge (default: two grid steps of Hc),
+    the irreversible part the integral over larger Hc.
+    returns dictionary with reversible, irreversible, reversible_ratio (reversible / total) and, if the
+    saturation moment Ms is given, irreversible_fraction (irreversible / Ms)
+    """
+    z = np.where(np.isfinite(density), density, 0)
+    hc = (np.asarray(hb)[np.newaxis, :] - np.asarray(ha)[:, np.newaxis]) / 2
+    if ridge is None:
+        ridge = Step(hb) + Step(ha)  # two steps along Hc: (dHb + dHa) / 2 each
+    cell = Step(hb) * Step(ha)
+    irreversible = np.where(hc > ridge, z, 0).sum(axis=(-2, -1)) * cell
+    reversible = np.where(hc <= ridge, z, 0).sum(axis=(-2, -1)) * cell
+    total = reversible + irreversible
+    result = {'reversible': reversible, 'irreversible': irreversible,
+              'reversible_ratio': np.divide(reversible, total, out=np.full(np.shape(total), np.nan),
+                                            where=total != 0)}
+    if Ms is not None:
+        result['irreversible_fraction'] = irreversible / Ms
+    return result
+
+
+def AnalyseForc(hc, hu, forc_hchu, hb=None, ha=None, forc=None, k=None, Ms=None):
+    """ scalar parameters of FORC diagram(s), one value (or array over a stack) per name
+
+    hc, hu, forc_hchu: FORC distribution on the Hc, Hu grid (convolution result of kernel k)
+    hb, ha: axes of the Ha, Hb grid the distribution was computed on, needed for values in moment per field
+            squared (otherwise per grid step squared)
+    forc: distribution on the Ha, Hb grid, adds reversible / irreversible parts (see ReversibleRatio)
+    """
+    if k is None:
+        from forc_convolution import FORC_KERNEL
+        k = FORC_KERNEL
+    # resampling to Hc, Hu keeps the values, the density scale comes from the steps of the Ha, Hb grid
+    density = forc_hchu * KernelScale(k) if hb is None else ForcDensity(hb, ha, forc_hchu, k=k)
+    hc, hu = np.asarray(hc, dtype=float), np.asarray(hu, dtype=float)
+
+    parameters = {}
+    for name, (axis, profile) in (('ridge', (hc, CentralRidge(hc, hu, density))),
+                                  ('coercivity', (hc, CoercivityDistribution(hc, hu, density))),
+                                  ('interaction', (hu, InteractionDistribution(hc, hu, density)))):
+        position, height, fwhm = PeakFit(axis, profile)
+        parameters.update({name + '_peak': position, name + '_height': height, name + '_fwhm': fwhm})
+    parameters.update(('moment_' + key, value) for key, value in ForcMoments(hc, hu, density).items())
+    if forc is not None:
+        parameters.update(ReversibleRatio(hb, ha, ForcDensity(hb, ha, forc, k=k), Ms=Ms))
+    return parameters
+
+
+def WriteTable(filename, rows):
+    """ write a list of parameter dictionaries (one per diagram) as CSV
+
+    the columns are the keys of all rows in order of appearance, missing values (e.g. irreversible_fraction of
+    results without Ms) are left empty
+    """
+    fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def ProcessingKernel(params):
+    """ kernel with the density scale of a result processed with params (.forcr parameters), None: FORC_KERNEL
+
+    variable smoothing (SFmax) convolves with the Savitzky-Golay kernels of several SF, which share the same
+    KernelScale, any of them gives the scale
+    """
+    if params.get('SFmax') is not None:
+        return MixedDerivativeKernel(params.get('SF') or 2)
+    if params.get('SF'):
+        return MixedDerivativeKernel(params['SF'])
+    return None
+
+
+def AnalyseResultFile(filename, k=None):
+    """ parameter rows of a result file (.npz, .forcr): forc_batch output (one diagram) or forc_series output
+    (a stack), the kernel k defaults to the one of the smoothing stored in .forcr parameters
+    """
+    with OpenResult(filename) as result:
+        data = {key: np.asarray(result[key]) for key in result.files if key in RESULT_KEYS}
+        params = getattr(result, 'params', {})
+    if k is None:
+        k = ProcessingKernel(params)
+    forc = data['forc_hchu']
+    parameters = AnalyseForc(data['Hc'], data['Hu'], forc, hb=data['Hb'], ha=data['Ha'], forc=data['forc'], k=k,
+                             Ms=1.0 if data.get('normalized', False) else data.get('Ms'))
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    names = list(data['names']) if 'names' in data else [stem]
+    rows = []
+    for i, name in enumerate(names):
+        row = {'name': name}
+        row.update({key: float(np.reshape(value, -1)[i] if np.ndim(value) else value)
+                    for key, value in parameters.items()})
+        rows.append(row)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='scalar parameters of FORC result files (.npz) as CSV table')
+    parser.add_argument('files', nargs='+', help='result files (.npz, .forcr) of forc_batch or forc_series')
+    parser.add_argument('-o', '--output', default='forc_parameters.csv', help='CSV file')
+    parser.add_argument('--sf', type=int, default=None,
+                        help='smoothing factor used for processing '
+                             '(default: from .forcr parameters, else fixed 5x5 kernel)')
+    args = parser.parse_args(argv)
+
+    k = None if args.sf is None else MixedDerivativeKernel(args.sf)
+    rows = [row for f in args.files for row in AnalyseResultFile(f, k=k)]
+    WriteTable(args.output, rows)
+    print('wrote parameters of {} diagrams to {}'.format(len(rows), args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
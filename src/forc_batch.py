@@ -0,0 +1,318 @@
+__author__ = 'wack'
+
+# Batch processing of FORC files
+# runs import -> drift correction -> prepare -> grid -> convolve -> Hc/Hu regrid for many files in parallel
+#
+# usage: python forc_batch.py ../data -o results --png
+#        python forc_batch.py "../data/**/*.forc" -j 8 --timeout 300
+# result files are named by the path below the common input directory (run1/a.forc -> run1__a.forcr),
+# a file whose name differs only by the extension from an earlier one (a.frc after a.forc) is not processed
+
+import argparse
+import collections
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+import timeit
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from forc_pipeline import ForcConvolutionPipeline, JSONLinesSink
+
+PATTERNS = ('*.forc', '*.frc')  # file patterns used for directories
+POLL = 0.5  # seconds between checks for started files when a timeout is set
+
+
+def FindFiles(paths, patterns=PATTERNS):
+    """ list of files given as file names, directories (searched for patterns) or glob patterns """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in patterns:
+                files.extend(glob.glob(os.path.join(path, pattern)))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            files.extend(glob.glob(path, recursive=True))
+    return sorted(set(files))
+
+
+def InputRoot(files):
+    """ deepest directory containing all files """
+    return os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in files]) if files else None
+
+
+def OutputStem(filename, root=None):
+    """ name of the result files of filename without extension: its path relative to root (default: its own
+    directory) with directory separators replaced by '__', equally named files of different directories get
+    different names
+    """
+    relative = os.path.relpath(os.path.abspath(filename), root) if root else os.path.basename(filename)
+    return os.path.splitext(relative)[0].replace(os.sep, '__')
+
+
+def ProcessFORCFile(filename, sinks=(), profile=None, profile_dir=None, **kwargs):
+    """ run the whole processing for one file, returns dictionary of result arrays
+
+    kwargs are the processing options of forc_pipeline.ForcConvolutionPipeline, sinks receive a record per stage
+    """
+    pipeline = ForcConvolutionPipeline(sinks=sinks, profile=profile, profile_dir=profile_dir, **kwargs)
+    state = pipeline.Run(context={'file': filename}, filename=filename)
+    return {key: state[key] for key in ('Hb', 'Ha', 'M', 'forc', 'Hc', 'Hu', 'forc_hchu')}
+
+
+def WarmUp():
+    """ load the slow imports of the processing once per worker process instead of in its first file """
+    import pandas  # noqa: F401
+    import scipy.ndimage  # noqa: F401
+    import scipy.sparse  # noqa: F401
+    import scipy.spatial  # noqa: F401
+
+
+STARTED = None  # queue of a WorkerPool, workers put (file or None, time, process id)
+
+
+def WorkerInit(started, initializer, initargs):
+    """ initializer of WorkerPool processes: announce the process id, then run initializer(*initargs) """
+    global STARTED
+    STARTED = started
+    started.put((None, time.time(), os.getpid()))
+    if initializer is not None:
+        initializer(*initargs)
+
+
+class WorkerPool(ProcessPoolExecutor):
+    """ process pool whose busy workers can be killed: the workers announce their process id and the files
+    BatchWorker starts on a queue
+    """
+
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+        self.started = multiprocessing.Queue()
+        self.pids = set()
+        super().__init__(max_workers=max_workers, initializer=WorkerInit,
+                         initargs=(self.started, initializer, initargs))
+
+    def Started(self):
+        """ files started since the last call as list of (file, start time), records the worker process ids """
+        files = []
+        while True:
+            try:
+                f, t, pid = self.started.get_nowait()
+            except queue.Empty:
+                return files
+            self.pids.add(pid)
+            if f is not None:
+                files.append((f, t))
+
+    def Kill(self):
+        """ shut down without waiting for running files, the worker processes are terminated """
+        self.shutdown(wait=False, cancel_futures=True)
+        self.Started()
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:  # already exited
+                pass
+
+
+def BatchWorker(filename, outdir, png=False, stage_log=None, output_format='forcr', root=None, **kwargs):
+    """ process one file in a worker process, errors are returned as status, never raised
+
+    output_format: 'forcr' (forc_store result with parameters and provenance) or 'npz'
+    root: directory the output names are relative to (see OutputStem)
+    the status includes a record (timing, memory, sizes) for each finished processing stage
+    """
+    if STARTED is not None:
+        STARTED.put((filename, time.time(), os.getpid()))
+    start_time = timeit.default_timer()
+    status = {'file': filename, 'ok': False, 'stages': []}
+    sinks = [status['stages'].append]
+    if stage_log:
+        sinks.append(JSONLinesSink(stage_log))
+    try:
+        result = ProcessFORCFile(filename, sinks=sinks, **kwargs)
+        stem = os.path.join(outdir, OutputStem(filename, root))
+        if output_format == 'npz':
+            status['output'] = stem + '.npz'
+            np.savez_compressed(status['output'], **result)
+        else:
+            from forc_store import EXTENSION, Provenance, SaveResult
+            status['output'] = stem + EXTENSION
+            params = {key: value for key, value in kwargs.items() if key not in ('profile', 'profile_dir')}
+            SaveResult(status['output'], result, params=params, provenance=Provenance(filename))
+        if png:
+            from forc_plot import SaveForcFigure  # matplotlib only when images are requested
+            SaveForcFigure(stem + '.png', result)
+        status['ok'] = True
+    except Exception as e:
+        status['error'] = '{}: {}'.format(type(e).__name__, e)
+        status['traceback'] = traceback.format_exc()
+    status['seconds'] = timeit.default_timer() - start_time
+    return status
+
+
+def PrintStatus(status):
+    print('{:<6} {:8.2f}s {} {}'.format('ok' if status['ok'] else 'FAILED', status.get('seconds', 0), status['file'],
+                                        status.get('error', '')))
+
+
+def StartTimes(running, pool):
+    """ start times of running files announced by the workers of pool: {future: (file, attempt, start)} """
+    futures = {f: future for future, (f, a, t) in running.items()}
+    return {futures[f]: running[futures[f]][:2] + (t,) for f, t in pool.Started() if f in futures}
+
+
+def RunBatch(files, outdir, jobs=None, png=False, timeout=None, retries=1, **kwargs):
+    """ process files over a pool of jobs worker processes (all cores by default), returns list of status
+
+    timeout: maximum seconds per file from the moment a worker starts it, enforced from here: the pool is
+    replaced and the workers are killed, so files stuck in compiled code (Qhull, scipy.sparse, numpy) do not
+    hold a worker. Other files running at that time are submitted again.
+    retries: a worker dying (e.g. out of memory) breaks the whole pool, the files running in it are submitted
+    again on a new pool this many times, one at a time so that only the file that kills its worker fails
+    files with the output name of an earlier file (a.forc and a.frc) fail instead of overwriting its result
+    """
+    os.makedirs(outdir, exist_ok=True)
+    jobs = jobs or os.cpu_count()
+    root = InputRoot(files)
+    statuses = []
+    stems = {}
+    for f in files:
+        stem = OutputStem(f, root)
+        if stem in stems:
+            status = {'file': f, 'ok': False, 'stages': [],
+                      'error': 'output name {} is already used by {}'.format(stem, stems[stem])}
+            statuses.append(status)
+            PrintStatus(status)
+        else:
+            stems[stem] = f
+    pending = collections.deque((f, 0) for f in stems.values())  # file, number of pools it broke with
+    running = {}  # future -> file, attempt, start time (None until the worker starts it)
+    pool = WorkerPool(jobs, initializer=WarmUp)
+    try:
+        while pending or running:
+            # retried files run alone
+            while pending and len(running) < jobs and not any(a for f, a, t in running.values()) and \
+                    (pending[0][1] == 0 or not running):
+                f, attempt = pending.popleft()
+                future = pool.submit(BatchWorker, f, outdir, png=png, root=root, **kwargs)
+                running[future] = (f, attempt, None)
+
+            wait_time = None
+            if timeout is not None:
+                running.update(StartTimes(running, pool))
+                starts = [t for f, a, t in running.values() if t is not None]
+                wait_time = min(starts) + timeout - time.time() if starts else POLL
+                if len(starts) < len(running):
+                    wait_time = min(wait_time, POLL)
+                wait_time = max(wait_time, 0)
+            done = wait(running, timeout=wait_time, return_when=FIRST_COMPLETED)[0]
+            broken, died = False, []
+            for future in done:
+                f, attempt, start = running.pop(future)
+                try:
+                    status = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    died.append((f, attempt))
+                    continue
+                statuses.append(status)
+                PrintStatus(status)
+
+            now = time.time()
+            expired = [future for future, (f, a, t) in running.items()
+                       if timeout is not None and t is not None and now - t >= timeout]
+            if not (broken or expired):
+                continue
+            for future in expired:
+                f, attempt, start = running.pop(future)
+                status = {'file': f, 'ok': False, 'stages': [], 'error': 'timeout after {}s'.format(timeout),
+                          'seconds': now - start}
+                statuses.append(status)
+                PrintStatus(status)
+            # files of a broken pool count as attempt, files only stopped for a timeout of another one do not
+            if broken:
+                died.extend((f, attempt) for f, attempt, start in running.values())
+            else:
+                pending.extendleft((f, attempt) for f, attempt, start in running.values())
+            for f, attempt in died:
+                if attempt < retries:
+                    pending.append((f, attempt + 1))
+                else:
+                    status = {'file': f, 'ok': False, 'stages': [], 'error': 'worker died (e.g. out of memory)'}
+                    statuses.append(status)
+                    PrintStatus(status)
+            running.clear()
+            pool.Kill()
+            pool = WorkerPool(jobs, initializer=WarmUp)
+    finally:
+        if running:  # interrupted
+            pool.Kill()
+        else:
+            pool.shutdown()
+    return sorted(statuses, key=lambda s: s['file'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='batch processing of FORC measurement files')
+    parser.add_argument('paths', nargs='+', help='files, directories or glob patterns')
+    parser.add_argument('-o', '--outdir', default='forc_results', help='output directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--timeout', type=float, default=None, help='maximum seconds per file')
+    parser.add_argument('--dialect', default='auto', help='file dialect (default: detect)')
+    parser.add_argument('--drift', action='store_true', help='do drift correction')
+    parser.add_argument('--polyorder', type=int, default=6, help='polynomial order of drift correction')
+    parser.add_argument('--drift-model', choices=('poly', 'spline', 'linear'), default='poly',
+                        help='drift model: polynomial, smoothing spline or piecewise linear')
+    parser.add_argument('--no-mirror', dest='mirror', action='store_false', help='do not mirror FORCs')
+    parser.add_argument('--grid', choices=('linear', 'structured'), default='linear',
+                        help='gridding of moments: triangulation or along/between FORCs (regular protocols)')
+    parser.add_argument('--sf', type=int, default=None,
+                        help='smoothing factor of the Savitzky-Golay derivative kernel (default: fixed 5x5 kernel)')
+    parser.add_argument('--sf-max', type=int, default=None,
+                        help='variable smoothing: SF grows from --sf (default 2) up to this value away from Hu=0, Hc=0')
+    parser.add_argument('--lambda', dest='smoothing_lambda', type=float, default=0.05,
+                        help='variable smoothing: increase of SF per grid step of |Hu| and Hc')
+    parser.add_argument('--nan-aware', action='store_true', help='keep masked grid regions from spreading')
+    parser.add_argument('--float32', dest='dtype', action='store_const', const='float32', default=None,
+                        help='keep the points as float32 datasets (half the memory, use with --grid structured)')
+    parser.add_argument('--profile', choices=('cprofile', 'tracemalloc'), default=None,
+                        help='profile each stage (cProfile .prof files are written to the output directory)')
+    parser.add_argument('--stage-log', default=None, help='append stage records (JSON lines) to this file')
+    parser.add_argument('--png', action='store_true', help='also write PNG images')
+    parser.add_argument('--format', dest='output_format', choices=('forcr', 'npz'), default='forcr',
+                        help='result files: chunked forc_store results with parameters and provenance, or npz')
+    args = parser.parse_args(argv)
+
+    files = FindFiles(args.paths)
+    print('processing {} files with {} workers'.format(len(files), args.jobs or os.cpu_count()))
+    statuses = RunBatch(files, args.outdir, jobs=args.jobs, png=args.png, timeout=args.timeout,
+                        dialect=args.dialect, drift=args.drift, polyorder=args.polyorder, drift_model=args.drift_model,
+                        mirror=args.mirror, grid=args.grid, SF=args.sf, nan_aware=args.nan_aware, SFmax=args.sf_max,
+                        smoothing_lambda=args.smoothing_lambda, dtype=args.dtype, stage_log=args.stage_log,
+                        profile=args.profile, output_format=args.output_format,
+                        profile_dir=args.outdir if args.profile == 'cprofile' else None)
+
+    with open(os.path.join(args.outdir, 'batch_summary.json'), 'w') as f:
+        json.dump(statuses, f, indent=1)
+    # slowest files and their slowest stage, to spot outliers
+    for s in sorted(statuses, key=lambda s: s.get('seconds', 0), reverse=True)[:3]:
+        if s.get('stages'):
+            slowest = max(s['stages'], key=lambda r: r['seconds'])
+            print('slow: {} {:.2f}s (stage {} {:.2f}s)'.format(s['file'], s['seconds'], slowest['stage'],
+                                                                slowest['seconds']))
+    failed = sum(not s['ok'] for s in statuses)
+    print('{} of {} files processed, {} failed'.format(len(statuses) - failed, len(statuses), failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
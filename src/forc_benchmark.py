@@ -0,0 +1,243 @@
+__author__ = 'wack'
+
+# Benchmarks for FORC processing
+# uses synthetic MicroMag files of increasing size to check the scaling of the processing stages
+# stage timings of both pipelines (forc.py and forc_convolution.py) are written as JSON and can be compared
+# against an earlier run to spot regressions
+#
+# the startup suite checks that the processing modules import within a time budget and without matplotlib,
+# pandas or scipy (exit status 1 otherwise)
+#
+# usage: python forc_benchmark.py stages --sizes 1000 10000 100000 -o benchmark.json --compare old.json
+#        python forc_benchmark.py startup --budget 0.5
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+import scipy
+from scipy.interpolate import griddata, CloughTocher2DInterpolator
+
+from forc import importFORCdata, compute_forc_distribution
+from forc_convolution import FastImportFORCData, DriftCorrection, PrepareForcData, GridForcData, ConvolveForcGrid, \
+    GridHcHu, FastTranslateHaHbHcHu
+from forc_grid import OPERATORS, TRIANGULATIONS, CachedDelaunay, rotate_to_hc_hu
+from forc_synthetic import WriteMicroMagFORCFile
+
+DELAUNAY_MAX = 250000  # larger data sets skip the triangulation based stages (memory)
+
+
+def BenchmarkImport(sizes=(1000, 10000, 100000, 1000000), reflect=True, repeat=3):
+    """ time importFORCdata for synthetic files with the given numbers of forc points """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            fname = os.path.join(tmpdir, 'synthetic_{}.forc'.format(size))
+            npoints = WriteMicroMagFORCFile(fname, npoints=size)
+            seconds = min(timeit.repeat(lambda: importFORCdata(fname, reflect=reflect), number=1, repeat=repeat))
+            results.append((npoints, seconds))
+            print("{:>9d} points: {:9.4f}s  {:7.3f}us/point".format(npoints, seconds, seconds / npoints * 1e6))
+    return results
+
+
+def GriddataHcHu(xi, yi, forc, Halen, Hblen):
+    """ Hc, Hu resampling by triangulation of the rotated grid points (previous GridHcHu) """
+    xv, yv = np.meshgrid(xi, yi)
+    fitted = FastTranslateHaHbHcHu(np.array([yv.flatten(), xv.flatten(), forc.flatten()]).T)
+    hc = np.linspace(0, fitted[:, 0].max(), Halen * 2)
+    hu = np.linspace(fitted[:, 1].min(), fitted[:, 1].max(), Hblen * 2)
+    return hc, hu, griddata(fitted[:, :2], fitted[:, 2], tuple(np.meshgrid(hc, hu)), method='linear')
+
+
+def BenchmarkHcHu(sizes=(1000, 10000, 100000), repeat=3):
+    """ time Hc, Hu resampling of the FORC distribution: griddata vs. rotate_to_hc_hu (first and repeated call) """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            fname = os.path.join(tmpdir, 'synthetic_{}.forc'.format(size))
+            npoints = WriteMicroMagFORCFile(fname, npoints=size)
+            dd, fd = FastImportFORCData(fname)
+            fd, Halen, Hblen = PrepareForcData(fd, mirror=True)
+            xi, yi, zi = GridForcData(fd, Halen, Hblen, method='structured')
+            forc = ConvolveForcGrid(zi)
+
+            def Rotate(cold):
+                if cold:
+                    OPERATORS.clear()
+                rotate_to_hc_hu(forc, (xi, yi), hc=Halen * 2, hu=Hblen * 2)
+
+            tgriddata = min(timeit.repeat(lambda: GriddataHcHu(xi, yi, forc, Halen, Hblen), number=1, repeat=repeat))
+            tcold = min(timeit.repeat(lambda: Rotate(True), number=1, repeat=repeat))
+            twarm = min(timeit.repeat(lambda: Rotate(False), number=1, repeat=repeat))
+            results.append((npoints, tgriddata, tcold, twarm))
+            print("{:>9d} points, grid {}x{}: griddata {:9.4f}s  rotate {:9.4f}s  rotate (cached) {:9.4f}s".format(
+                npoints, Halen, Hblen, tgriddata, tcold, twarm))
+    return results
+
+
+def TimeStage(results, pipeline, stage, npoints, func, repeat=1):
+    """ run func repeat times (caches of grid operators cleared), record the best time, returns the last result """
+    times = []
+    for i in range(repeat):
+        TRIANGULATIONS.clear()
+        OPERATORS.clear()
+        start = timeit.default_timer()
+        result = func()
+        times.append(timeit.default_timer() - start)
+    results.append({'pipeline': pipeline, 'stage': stage, 'npoints': npoints, 'seconds': min(times)})
+    print("{:>17} {:<15} {:>9d} points: {:9.4f}s".format(pipeline, stage, npoints, min(times)))
+    return result
+
+
+def BenchmarkForc(results, fname, npoints, repeat=1, SF=2):
+    """ stages of the forc.py pipeline (reflection is part of the import, no drift correction) """
+    dd, fd, Halen, Hblen = TimeStage(results, 'forc', 'import', npoints, lambda: importFORCdata(fname), repeat)
+    if len(fd) > DELAUNAY_MAX:
+        return
+    xi = np.linspace(fd[:, 1].min(), fd[:, 1].max(), Hblen)
+    yi = np.linspace(fd[:, 0].min(), fd[:, 0].max(), Halen)
+
+    def Grid():
+        interpolator = CloughTocher2DInterpolator(CachedDelaunay(fd[:, 1::-1]), fd[:, 2], fill_value=np.nan)
+        return interpolator(tuple(np.meshgrid(xi, yi)))
+
+    zi = TimeStage(results, 'forc', 'grid', npoints, Grid, repeat)
+    fitted = TimeStage(results, 'forc', 'convolve', npoints, lambda: compute_forc_distribution(zi, SF), repeat)
+    TimeStage(results, 'forc', 'rotate', npoints,
+              lambda: rotate_to_hc_hu(fitted[SF:-SF, SF:-SF], (xi[SF:-SF], yi[SF:-SF])), repeat)
+
+
+def BenchmarkConvolution(results, fname, npoints, repeat=1):
+    """ stages of the forc_convolution.py pipeline """
+    dd, fd = TimeStage(results, 'forc_convolution', 'import', npoints, lambda: FastImportFORCData(fname), repeat)
+    fd = TimeStage(results, 'forc_convolution', 'drift', npoints, lambda: DriftCorrection(fd, dd), repeat)
+    fd, Halen, Hblen = TimeStage(results, 'forc_convolution', 'prepare', npoints, lambda: PrepareForcData(fd), repeat)
+    methods = ('structured', 'linear') if 2 * npoints <= DELAUNAY_MAX else ('structured',)
+    for method in methods:
+        xi, yi, zi = TimeStage(results, 'forc_convolution', 'grid_' + method, npoints,
+                               lambda: GridForcData(fd, Halen, Hblen, method=method), repeat)
+    forc = TimeStage(results, 'forc_convolution', 'convolve', npoints, lambda: ConvolveForcGrid(zi), repeat)
+    TimeStage(results, 'forc_convolution', 'rotate', npoints, lambda: GridHcHu(xi, yi, forc, Halen, Hblen), repeat)
+
+
+def BenchmarkStages(sizes=(1000, 10000, 100000, 1000000), repeat=1, **synthetic):
+    """ time every stage of both pipelines on synthetic files (drift and noise included), returns list of records """
+    synthetic = dict({'drift': 0.01, 'noise': 1e-3, 'seed': 0}, **synthetic)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            fname = os.path.join(tmpdir, 'synthetic_{}.forc'.format(size))
+            npoints = WriteMicroMagFORCFile(fname, npoints=size, **synthetic)
+            BenchmarkForc(results, fname, npoints, repeat=repeat)
+            BenchmarkConvolution(results, fname, npoints, repeat=repeat)
+    return results
+
+
+STARTUP_MODULES = ('forc', 'forc_io', 'forc_cache', 'forc_grid', 'forc_filter', 'forc_dataset', 'forc_convolution',
+                   'forc_pipeline', 'forc_uncertainty', 'forc_live', 'forc_synthetic', 'forc_batch', 'forc_plot',
+                   'forc_render', 'forc_series', 'forc_analysis', 'forc_store',
+                   'forc_sweep', 'forc_service')
+HEAVY_MODULES = ('matplotlib', 'pandas', 'scipy')  # loaded on first use only
+STARTUP_BUDGET = 0.5  # seconds for importing one module (numpy included) in a fresh interpreter
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def BenchmarkStartup(modules=STARTUP_MODULES, budget=STARTUP_BUDGET, repeat=3):
+    """ import time of each module in a fresh interpreter, returns list of failures
+
+    a module fails if its best import time exceeds budget seconds or if it loads one of HEAVY_MODULES
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    failures = []
+    for module in modules:
+        script = STARTUP_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+        runs = [json.loads(subprocess.run([sys.executable, '-c', script], cwd=directory, check=True,
+                                          capture_output=True, text=True).stdout) for i in range(repeat)]
+        seconds = min(r['seconds'] for r in runs)
+        loaded = runs[0]['loaded']
+        ok = seconds <= budget and not loaded
+        print("{:<18} {:7.3f}s {}{}".format(module, seconds, 'ok' if ok else 'FAILED',
+                                             ' (loads {})'.format(', '.join(loaded)) if loaded else ''))
+        if not ok:
+            failures.append({'module': module, 'seconds': seconds, 'loaded': loaded})
+    return failures
+
+
+def Environment():
+    """ versions and machine the benchmark ran on """
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def SaveResults(filename, results):
+    with open(filename, 'w') as f:
+        json.dump({'environment': Environment(), 'results': results}, f, indent=1)
+
+
+def CompareResults(old, new, threshold=1.2):
+    """ print stages which got slower than threshold times the old timing, returns list of regressions """
+    before = {(r['pipeline'], r['stage'], r['npoints']): r['seconds'] for r in old['results']}
+    regressions = []
+    for r in new['results']:
+        key = (r['pipeline'], r['stage'], r['npoints'])
+        if key in before and r['seconds'] > threshold * before[key] and r['seconds'] > 0.05:  # ignore timer noise
+            regressions.append(dict(r, before=before[key]))
+            print("REGRESSION {} {} {} points: {:.4f}s -> {:.4f}s".format(key[0], key[1], key[2], before[key],
+                                                                           r['seconds']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks of the FORC processing stages')
+    parser.add_argument('suite', nargs='?', default='stages', choices=('stages', 'import', 'hchu', 'startup'))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help='numbers of forc points')
+    parser.add_argument('--repeat', type=int, default=1, help='repetitions per stage (best time is recorded)')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON result file (stages suite)')
+    parser.add_argument('--compare', default=None, help='earlier JSON result file to check for regressions')
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET, help='seconds per module (startup suite)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.suite == 'import':
+        print("importFORCdata scaling (time per point should stay constant):")
+        BenchmarkImport(sizes=args.sizes, repeat=args.repeat)
+        return 0
+    if args.suite == 'startup':
+        print("module import times (budget {}s):".format(args.budget))
+        return 1 if BenchmarkStartup(budget=args.budget, repeat=max(args.repeat, 3)) else 0
+    if args.suite == 'hchu':
+        print("Hc, Hu resampling of the FORC distribution:")
+        BenchmarkHcHu(sizes=args.sizes, repeat=args.repeat)
+        return 0
+
+    results = BenchmarkStages(sizes=args.sizes, repeat=args.repeat)
+    SaveResults(args.output, results)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        with open(args.output) as f:
+            new = json.load(f)
+        return 1 if CompareResults(old, new) else 0
+    return 0
+
+
+if __name__ == '__main__':  # run benchmarks
+    sys.exit(main())
@@ -0,0 +1,131 @@
+__author__ = 'wack'
+
+# On-disk cache for parsed FORC measurements
+# parsed data frames are stored column wise as .npy files which are memory mapped on load (no parsing, no copies)
+# entries are keyed by the hash of the file content, the file dialect and the parser version
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def FileHash(filename, blocksize=1 << 20):
+    """ sha1 hex digest of the file content """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class FORCCache:
+    """ LRU bounded directory of parsed measurements, one sub directory per entry """
+
+    def __init__(self, directory, maxbytes=1 << 30):
+        self.directory = directory
+        self.maxbytes = maxbytes  # size bound of all entries, least recently used entries are evicted
+        os.makedirs(directory, exist_ok=True)
+
+    def Key(self, filename, dialect, version):
+        """ cache key of a measurement file read with the given dialect and parser version """
+        return hashlib.sha1('{}:{}:{}'.format(FileHash(filename), dialect, version).encode()).hexdigest()
+
+    def Load(self, key):
+        """ returns dictionary of data frames (None for missing ones) or None if key is not cached """
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        import pandas as pd  # imported on first use, slow to import
+        frames = {}
+        for name, columns in meta['frames'].items():
+            if columns is None:
+                frames[name] = None
+                continue
+            # copy on write memory maps: frames can be modified without touching the cached files
+            data = {c: np.load(os.path.join(entry, '{}.{}.npy'.format(name, c)), mmap_mode='c') for c in columns}
+            index = np.load(os.path.join(entry, '{}.index.npy'.format(name)), mmap_mode='c')
+            frames[name] = pd.DataFrame(data, index=index, columns=columns, copy=False)
+
+        os.utime(os.path.join(entry, 'meta.json'))  # mark as recently used
+        log.debug('cache hit %s', key)
+        return frames
+
+    def Store(self, key, frames):
+        """ store dictionary of data frames (or None) under key and evict old entries if needed """
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            return
+
+        tmp = tempfile.mkdtemp(prefix='.' + key, dir=self.directory)  # write complete entry before publishing it
+        meta = {'frames': {}}
+        for name, df in frames.items():
+            if df is None:
+                meta['frames'][name] = None
+                continue
+            meta['frames'][name] = [str(c) for c in df.columns]
+            for c in df.columns:
+                np.save(os.path.join(tmp, '{}.{}.npy'.format(name, c)), df[c].to_numpy())
+            np.save(os.path.join(tmp, '{}.index.npy'.format(name)), df.index.to_numpy())
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp, entry)
+        except OSError:  # stored concurrently by somebody else
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        log.debug('cache store %s', key)
+        self.Evict()
+
+    def Entries(self):
+        """ list of (last use time, size in bytes, path) of all entries """
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(e.stat().st_size for e in os.scandir(entry))
+                entries.append((os.stat(os.path.join(entry, 'meta.json')).st_mtime, size, entry))
+            except OSError:  # incomplete or just evicted
+                continue
+        return entries
+
+    def Evict(self):
+        """ remove least recently used entries until the cache is below its size bound """
+        entries = sorted(self.Entries())
+        total = sum(size for t, size, entry in entries)
+        for t, size, entry in entries:
+            if total <= self.maxbytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            log.debug('cache evicted %s', entry)
+
+    def Clear(self):
+        """ remove all entries """
+        for t, size, entry in self.Entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+if __name__ == '__main__':  # test routine
+    import sys
+    from forc_convolution import FastImportFORCData
+
+    cache = FORCCache(os.path.join(tempfile.gettempdir(), 'forc_cache'))
+    for i in range(2):
+        start_time = time.perf_counter()
+        dd, fd = FastImportFORCData(sys.argv[1], cache=cache)
+        print("Seconds for FastImportFORCData ({}): {}".format(['miss', 'hit'][i], time.perf_counter() - start_time))
@@ -5,16 +5,18 @@ __author__ = 'wack'
 # patched for Python 3.9 2022
 # under development
 
-import io
+import os
 import timeit
 import sys
 
-# import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-from scipy import ndimage, interpolate
-from scipy.interpolate import griddata
+
+from forc_cache import FORCCache
+from forc_dataset import ForcDataset, AsDataset
+from forc_filter import Convolve, MixedDerivativeKernel, NormalizedConvolve, VariableConvolve, \
+    VariableSmoothingFactor
+from forc_grid import GridOperator, StructuredOperator, rotate_to_hc_hu
+from forc_io import ReadMeasurement, SniffDialect
 
 # import scipy
 
@@ -40,145 +42,198 @@ def fitPolySurface( x, y, z):
 '''
 
 
-def FastImportFORCData(filename, dialect='micromag'):
-    f = open(filename)
-
-    hys_df = None
-    msi_df = None
-
-    inc_hysloop = False
-    inc_msi = False
-
-    if dialect == 'micromag':
-        # important to check if those are declared in the header
-        # in this case those must be treated/removed before the forc data
-
-        cl = 0  # current line number
-
-        for line in f:
-            cl += 1  # increase current line number count
-            if "".join(line.split()).startswith('Includeshysteresisloop?Yes'):
-                inc_hysloop = True
-                print('hysteresis loop declared in header line {}'.format(cl))
-            elif "".join(line.split()).startswith('IncludesMsi(H)?Yes'):
-                inc_msi = True
-                print('msi branch declared in header line {}'.format(cl))
-            elif "".join(line.split()).startswith(
-                    'FieldMoment'):  # this marks beginning of data for Munich files (new micromag format?)
-                print('data header (new format) detected in line {}'.format(cl))
-                break  # we are done with header lines
-            elif "".join(line.split()).startswith(
-                    'NData'):  # this is end of header resp. beginning of data for forcopedia fiels (old micromag format?)
-                print('data header (old format) detected in line {}'.format(cl))
-                break  # we are done with header lines
-
-    # elif dialect=='vftb':
-    #    # just skip 34 lines
-    #    for i in range(34):
-    #        f.readline()
-    else:
-        raise Exception("unknown dialect")
-
-    # start reading data into pandas data frame
-    # chunks of data separated by blank lines
-    # skip 1st and last 2 lines from file
-    fdf = pd.read_csv(io.StringIO("".join(f.readlines()[1:-2])), skip_blank_lines=False, header=None,
-                      names=['Field', 'Moment'],
-                      dtype=float, index_col=False)
-    f.close()  # done with reading from file
+FAST_IMPORT_VERSION = 1  # increase whenever the output of FastImportFORCSegments changes (invalidates caches)
 
-    fdf["segment"] = fdf.isnull().all(axis=1).cumsum()  # label chunks separated by NAN = empty line
-    fdf = fdf.dropna()  # remove empty lines
 
-    if inc_hysloop:  # if hysteresis loop is included in data set
-        # -> throw away first drift chunk (chunk_no == 0) and move the next two (chunk_no == 1 & 2) to hysteresis_df
-        hys_df = fdf[fdf.segment.isin([1, 2])]  # copy upfield and downfield hysteresis segment to hys_df
-        fdf = fdf[fdf.segment >= 3]  # drop first three segments (Ms & hysteresis up and downfield)
+def FastImportFORCData(filename, dialect='micromag', cache=None, memmap=False, dtype=None):
+    """ returns drift and forc data frames, cache (FORCCache or directory) avoids parsing the same file again
 
-    if inc_msi:
-        msi_df = fdf[fdf.segment == fdf.segment.min() + 1]  # copy msi segment to hys_df
-        fdf = fdf[fdf.segment > fdf.segment.min() + 1]  # drop msi segment from forc data
+    dtype (np.float32 or np.float64): return ForcDatasets of this precision instead of data frames
+    """
+    if dtype is not None and cache is None:  # datasets straight from the parsed columns, no data frames
+        return ReadMeasurement(filename, dialect=dialect, memmap=memmap, dtype=dtype).Segments()[:2]
+    drift_df, forc_df = FastImportFORCSegments(filename, dialect=dialect, cache=cache, memmap=memmap)[:2]
+    if dtype is None:
+        return drift_df, forc_df
+    return AsDataset(drift_df, dtype=dtype), AsDataset(forc_df, dtype=dtype)  # the cache holds data frames
 
-    # forc data fdf consists of alternating single Ms (drift) values and forc curves as segments
-    # print(fdf)
 
-    # separate forc and Ms data
-    drift_df = fdf[fdf.segment.isin(
-        range(fdf.segment.min(), fdf.segment.max(), 2))].copy()  # get every second segment as drift data
-    forc_df = fdf[fdf.segment.isin(
-        range(fdf.segment.min() + 1, fdf.segment.max(), 2))].copy()  # get every other segment as forc curve
+def FastImportFORCSegments(filename, dialect='micromag', cache=None, memmap=False, chunksize=1 << 20):
+    """ returns drift, forc, hysteresis and msi data frames (the last two None if not in file)
 
-    forc_df.rename(columns={'Field': 'Hb'}, inplace=True)  # rename column "Field" to "Hb"
+    dialect is one of the registered file dialects (forc_io.DIALECTS) or 'auto' to detect it from the file.
+    memmap=True parses the data body from the memory mapped file in chunks of chunksize bytes instead of
+    reading it into memory, for very large files
+    """
+    if dialect == 'auto':
+        dialect = SniffDialect(filename)
 
-    # also return hysteresis and msi?
-    return drift_df, forc_df
+    if cache is not None:
+        if isinstance(cache, (str, os.PathLike)):
+            cache = FORCCache(cache)
+        key = cache.Key(filename, dialect, FAST_IMPORT_VERSION)
+        frames = cache.Load(key)
+        if frames is None:
+            segments = FastImportFORCSegments(filename, dialect=dialect, memmap=memmap, chunksize=chunksize)
+            frames = dict(zip(('drift', 'forc', 'hys', 'msi'), segments))
+            cache.Store(key, frames)
+        return frames['drift'], frames['forc'], frames['hys'], frames['msi']
 
+    return ReadMeasurement(filename, dialect=dialect, memmap=memmap, chunksize=chunksize).Segments()
 
-def DriftCorrection(forc_df, drift_df, polyorder=6):
-    """ Do drift correction of forc data based on drift data """
 
-    # add segment steps needed for drift correction
-    forcs = forc_df.groupby('segment')
+DRIFT_MODELS = ('poly', 'spline', 'linear')
 
-    def SegStep(group):
-        group['segstep'] = np.linspace(group['segment'].iloc[0], group['segment'].iloc[0] + 2, num=len(group),
-                                       endpoint=False)
-        return group
 
-    forc_df = forcs.apply(SegStep)  # add decimal segment steps for each point - needed for drift correction
+def DriftModel(x, y, model='poly', polyorder=6):
+    """ drift moment as function of (fractional) segment number fitted to drift points x, y
 
-    # lets look at the drift data
-    y = drift_df['Moment']
-    x = drift_df['segment']  # segment numbers
-    driftpoly = np.poly1d(np.polyfit(x, y, polyorder))  # fit polynomial to the data
-
-    plt.plot(x, y, 'r.')
-    p = plt.plot(x, driftpoly(x), 'g-')
-
-    # apply drift correction
-    # (see Variforc, Egli 2013, eq 23)
-    forc_df['Moment'] *= driftpoly(1) / driftpoly(forc_df['segstep'])
+    model 'poly': polynomial of polyorder, 'spline': smoothing spline (smoothing by generalized cross validation),
+    'linear': piecewise linear between the drift measurements (constant beyond them)
+    """
+    if model == 'poly':
+        return np.poly1d(np.polyfit(x, y, polyorder))
 
-    # return plot
-    return forc_df
+    # spline and linear need one value per segment: average repeated drift measurements
+    xs, inverse = np.unique(x, return_inverse=True)
+    ys = np.bincount(inverse, weights=y) / np.bincount(inverse)
+    if model == 'linear':
+        return lambda t: np.interp(t, xs, ys)
+    if model == 'spline':
+        from scipy import interpolate
+        if len(xs) < 5:  # too few points for a cubic smoothing spline
+            return lambda t: np.interp(t, xs, ys)
+        return interpolate.make_smoothing_spline(xs, ys)
+    raise ValueError("unknown drift model '{}', use one of {}".format(model, DRIFT_MODELS))
 
 
-def PrepareForcData(forc_df, mirror=True):
-    # add column Ha (first Hb of each FORC)
-    def Ha(group):
-        group['Ha'] = group['Hb'].iloc[0]
-        return group
+def DriftCorrection(forc_df, drift_df, polyorder=6, model='poly', diagnostics=False):
+    """ Do drift correction of forc data based on drift data
 
-    forcs = forc_df.groupby('segment')
-    forc_df = forcs.apply(Ha)  # adding Ha slow!
+    forc_df, drift_df: data frames or ForcDatasets
+    model: 'poly', 'spline' or 'linear', see DriftModel
+    returns drift corrected forc data (with column segstep) and, if diagnostics is True, a dictionary with the
+    drift points, fitted drift, residuals and correction factors (see forc_plot.PlotDriftCorrection)
+    """
+    # add segment steps needed for drift correction: each FORC spans segment ... segment + 2,
+    # position within the segment from cumulative counts
+    segments = np.asarray(forc_df['segment'])
+    order, starts, lengths, segno = CurveIndex(forc_df)
+    rank = np.arange(len(order)) - starts[segno]
+    segstep = np.empty(len(order))
+    segstep[order] = segments[order] + 2 * rank / lengths[segno]
 
-    forcs = forc_df.groupby('segment')
+    # lets look at the drift data
+    y = np.asarray(drift_df['Moment'], dtype=float)
+    x = np.asarray(drift_df['segment'], dtype=float)  # segment numbers
+    drift = DriftModel(x, y, model=model, polyorder=polyorder)
 
-    if mirror:  # mirror each FORC curve # mirroring slow
-        def mirror_forc(group):
-            mirrored_group = group.copy()  # do not mirror first point since identical
-            mirrored_group['segment'] = -group['segment']
-            mirrored_group['Hb'] = 2 * group['Ha'] - group['Hb']  # could be done on whole data frame -> faster?
-            mirrored_group['Moment'] = 2 * group['Moment'].iloc[0] - group['Moment']
-            return pd.concat([mirrored_group.iloc[:0:-1], group])
+    # apply drift correction
+    # (see Variforc, Egli 2013, eq 23)
+    factor = drift(1) / drift(segstep)
+    if isinstance(forc_df, ForcDataset):
+        forc_df = forc_df.Replace(moment=forc_df.moment * factor, segstep=segstep)
+    else:
+        forc_df = forc_df.assign(segstep=segstep)
+        forc_df['Moment'] = forc_df['Moment'].to_numpy() * factor
+
+    if not diagnostics:
+        return forc_df
+    fit = drift(x)
+    return forc_df, {'model': model, 'segment': x, 'moment': y, 'fit': fit, 'residuals': y - fit,
+                     'rms': float(np.sqrt(np.mean((y - fit) ** 2))), 'reference': float(drift(1)),
+                     'segstep': segstep, 'factor': factor}
+
+
+def SegmentIndex(segments):
+    """ vectorized grouping of rows by segment label
+
+    returns the stable sort order of the rows, the start of each segment within the sorted rows,
+    the segment lengths and the segment number (0..n-1) of each sorted row
+    """
+    order = np.argsort(segments, kind='stable')
+    s = segments[order]
+    newseg = np.empty(len(s), dtype=bool)
+    newseg[:1] = True
+    np.not_equal(s[1:], s[:-1], out=newseg[1:])
+    starts = np.flatnonzero(newseg)
+    lengths = np.diff(np.append(starts, len(s)))
+    segno = np.cumsum(newseg) - 1
+    return order, starts, lengths, segno
+
+
+def CurveIndex(forc_df):
+    """ SegmentIndex of a data frame or ForcDataset (whose points are grouped by curve already) """
+    if isinstance(forc_df, ForcDataset):
+        return forc_df.SegmentIndex()
+    return SegmentIndex(forc_df['segment'].to_numpy())
+
+
+def MirrorIndex(order, starts, lengths):
+    """ rows of mirrored FORC data (see SegmentIndex for order, starts, lengths)
+
+    output per FORC: reversed mirrored points without the first (identical) point, then the FORC itself.
+    returns source row of each output point, row of the first point of its FORC and mirrored flag,
+    mirrored moments are 2 * M[anchor] - M[source]
+    """
+    outlengths = 2 * lengths - 1
+    outsegno = np.repeat(np.arange(len(lengths)), outlengths)
+    j = np.arange(len(outsegno)) - np.repeat(np.cumsum(outlengths) - outlengths, outlengths)  # position in output
+    L = lengths[outsegno]
+    mirrored = j < L - 1
+    src = starts[outsegno] + np.where(mirrored, L - 1 - j, j - (L - 1))  # source position in sorted rows
+    return order[src], order[starts[outsegno]], mirrored
 
-        forc_df = forcs.apply(mirror_forc)
 
-    # Halen is number of groups
-    Halen = len(forcs)
-    # Hblen is maximum length of a group
-    Hblen = forcs.size().max()
+def PrepareForcData(forc_df, mirror=True):
+    """ add column Ha and optionally mirror the FORCs, returns forc data, number of FORCs and maximum FORC length
+
+    for a ForcDataset the result is a ForcDataset, mirrored points are part of their curve
+    """
+    if isinstance(forc_df, ForcDataset):
+        return PrepareForcDataset(forc_df, mirror=mirror)
+    order, starts, lengths, segno = SegmentIndex(forc_df['segment'].to_numpy())
+
+    # add column Ha (first Hb of each FORC) by broadcasting the first value of each segment
+    first = order[starts]  # row position of the first point of each FORC
+    Hb = forc_df['Hb'].to_numpy()
+    Ha = np.empty(len(forc_df))
+    Ha[order] = Hb[first][segno]
+    forc_df = forc_df.copy()
+    forc_df['Ha'] = Ha
+
+    if mirror:  # mirror each FORC curve (point reflection at its first point) in one go
+        source, anchor, mirrored = MirrorIndex(order, starts, lengths)
+        M0 = forc_df['Moment'].to_numpy()[anchor]  # moment at Ha for each point
+        forc_df = forc_df.take(source)
+        forc_df['segment'] = np.where(mirrored, -forc_df['segment'].to_numpy(), forc_df['segment'].to_numpy())
+        forc_df['Hb'] = np.where(mirrored, 2 * forc_df['Ha'].to_numpy() - forc_df['Hb'].to_numpy(),
+                                 forc_df['Hb'].to_numpy())
+        forc_df['Moment'] = np.where(mirrored, 2 * M0 - forc_df['Moment'].to_numpy(), forc_df['Moment'].to_numpy())
+
+    # Halen is number of FORCs
+    Halen = len(lengths)
+    # Hblen is maximum length of a FORC (before mirroring)
+    Hblen = lengths.max() if Halen > 0 else 0
 
     forc_df.reset_index(drop=True, inplace=True)
 
     return forc_df, Halen, Hblen
 
 
-def PlotForcCurves(forc_df):
-    # plot for testing
-    for key, grp in forc_df.groupby('segment'):
-        plt.plot(grp['Hb'], grp['Moment'], label="FORC {}".format(key))
-    plt.show()
+def PrepareForcDataset(ds, mirror=True):
+    """ PrepareForcData of a ForcDataset """
+    lengths = ds.lengths
+    Ha = ds.field[ds.offsets[:-1]]  # first Hb of each FORC
+    if mirror:  # same point order as PrepareForcData, the curves become 2 * length - 1 points long
+        source, anchor, mirrored = MirrorIndex(np.arange(len(ds)), ds.offsets[:-1], lengths)
+        Hb, M = ds.field[source], ds.moment[source]
+        Hb = np.where(mirrored, 2 * ds.field[anchor] - Hb, Hb)
+        M = np.where(mirrored, 2 * ds.moment[anchor] - M, M)
+        offsets = np.append(0, np.cumsum(2 * lengths - 1))
+        segstep = None if ds.segstep is None else ds.segstep[source]
+        ds = ds.Replace(field=Hb, moment=M, offsets=offsets, segstep=segstep)
+    return ds.Replace(Ha=Ha), ds.ncurves, lengths.max() if ds.ncurves > 0 else 0
 
 
 def FastTranslateHaHbHcHu(HaHbdata):
@@ -188,9 +243,92 @@ def FastTranslateHaHbHcHu(HaHbdata):
     return np.array([(HaHbdata[:, 1] - HaHbdata[:, 0]) / 2, (HaHbdata[:, 0] + HaHbdata[:, 1]) / 2, HaHbdata[:, 2]]).T
 
 
+# kernel for mixed differentiation in Ha, Hb
+# k = -np.array([[1, 0, -1],
+#              [0, 0, 0],
+#              [-1, 0, 1]])
+FORC_KERNEL = -np.array([[1, 2, 0, -2, -1],
+                         [2, 4, 0, -4, -2],
+                         [0, 0, 0, 0, 0],
+                         [-2, -4, 0, 4, 2],
+                         [-1, -2, 0, 2, 1]])
+FORC_KERNEL = FORC_KERNEL / np.absolute(FORC_KERNEL).sum()  # normalize k to get right scaling of output
+
+
+def ForcGridOperator(forc_df, Halen, Hblen, method='linear', axes=None):
+    """ Hb axis (Hblen values), Ha axis (Halen values) and grid operator for prepared forc data, see GridForcData
+
+    axes: (Hb axis, Ha axis) to grid onto instead of the range of the data (e.g. shared axes of a series)
+    """
+    if isinstance(forc_df, ForcDataset):  # points in float64 for the triangulation and the operator cache
+        fd = np.column_stack((forc_df['Ha'], forc_df['Hb'])).astype(float)
+    else:
+        fd = np.array(forc_df[['Ha', 'Hb']])
+    if axes is not None:
+        xi, yi = (np.asarray(a, dtype=float) for a in axes)
+    else:
+        xi = np.linspace(fd[:, 1].min(), fd[:, 1].max(), Hblen)
+        yi = np.linspace(fd[:, 0].min(), fd[:, 0].max(), Halen)
+
+    # weights are cached for further value arrays on the same points
+    if method == 'structured':
+        curves = np.abs(np.asarray(forc_df['segment']))  # mirrored points belong to their FORC
+        return xi, yi, StructuredOperator(curves, fd[:, 0], fd[:, 1], xi, yi)
+    if method != 'linear':
+        raise ValueError("unknown gridding method '{}'".format(method))
+    return xi, yi, GridOperator(fd[:, [1, 0]], xi, yi)
+
+
+def GridForcData(forc_df, Halen, Hblen, method='linear', axes=None):
+    """ linearly interpolate prepared forc data (columns Ha, Hb, Moment, segment or ForcDataset) to a regular grid
+
+    method 'linear' triangulates the points, 'structured' interpolates along each FORC and then between FORCs
+    (no triangulation, grid points between the measured curves only)
+    axes: (Hb axis, Ha axis) to grid onto, default Hblen resp. Halen values over the range of the data
+    returns Hb axis (Hblen values), Ha axis (Halen values) and gridded moments (rows Ha, columns Hb)
+    """
+    xi, yi, operator = ForcGridOperator(forc_df, Halen, Hblen, method=method, axes=axes)
+    return xi, yi, operator(np.asarray(forc_df['Moment'], dtype=float))
+
+
+def ConvolveForcGrid(zi, k=FORC_KERNEL, SF=None, kind='sg', method='auto', nan_aware=False):
+    """ FORC distribution by convolution of gridded moments with the differentiation kernel k
+
+    SF: use the mixed derivative kernel of this smoothing factor and kind ('sg' or 'binomial') instead of k
+    method: 'direct', 'separable', 'fft' or 'auto' (chosen by kernel size)
+    nan_aware: masked (nan) grid points do not spread into their neighbours, see forc_filter.NormalizedConvolve
+    """
+    if SF is not None:
+        k = MixedDerivativeKernel(SF, kind)
+    if nan_aware:
+        return NormalizedConvolve(zi, k, mode='reflect', method=method)
+    return Convolve(zi, k, mode='reflect', method=method)
+
+
+def VariableConvolveForcGrid(xi, yi, zi, sf0=2, sfmax=10, lambda_u=0.05, lambda_c=0.05, nan_aware=False):
+    """ FORC distribution of gridded moments (Hb axis xi, Ha axis yi) with variable smoothing (VARIFORC like)
+
+    the smoothing factor grows from sf0 at the origin of the Hc, Hu plane by lambda_u per grid step of |Hu| and
+    lambda_c per grid step of Hc up to sfmax, see forc_filter.VariableSmoothingFactor
+    """
+    sf = VariableSmoothingFactor(xi, yi, sf0=sf0, sfmax=sfmax, lambda_u=lambda_u, lambda_c=lambda_c)
+    return VariableConvolve(zi, sf, mode='reflect', nan_aware=nan_aware)
+
+
+def GridHcHu(xi, yi, forc, Halen, Hblen):
+    """ resample FORC distribution on Hb axis xi, Ha axis yi to a regular Hc (>= 0), Hu grid
+
+    returns Hc axis (2 * Halen values), Hu axis (2 * Hblen values) and gridded FORC distribution (rows Hu)
+    """
+    # Hc, Hu is a rotation of the regular Ha, Hb grid -> bilinear resampling, no triangulation needed
+    return rotate_to_hc_hu(forc, (xi, yi), hc=Halen * 2, hu=Hblen * 2)
+
+
 if __name__ == '__main__':  # test routine
+    from forc_plot import PlotForcCurves, PlotForcGrid, Show
+
     np.set_printoptions(threshold=sys.maxsize)
-    dialect = 'micromag'
+    dialect = 'auto'  # detect file dialect (micromag, vftb)
     fname = '../data/FeNi100-A-a-24-M001_005.forc'
     # fname = '../data/FeNi0_heated.forc'  # big ~70k points
     # fname = '../data/140401-Gd2O3_2.forc'
@@ -198,7 +336,7 @@ if __name__ == '__main__':  # test routine
     # fname = "../data/forcopedia/1256D-49R-2-099b.frc"
     # fname = "../data/forcopedia/Bjurbole-L1i3-grad0.1.frc"
     # fname = "../data/forcopedia/Karoonda-10d.frc"
-    # fname = '../data/vftb_forc.frc'#; dialect = 'vftb'  # first vftb forc
+    # fname = '../data/vftb_forc.frc'  # first vftb forc
     # fname = '../data/vftb_full_forc.frc'
 
     initial_time = timeit.default_timer()
@@ -209,141 +347,44 @@ if __name__ == '__main__':  # test routine
     print("Seconds for importFORCdata: {}".format(timeit.default_timer() - start_time))
     print("Number of datapoints: {}".format(len(fd)))
 
-    # fd = DriftCorrection(fd, dd) # do drift correction
+    # fd, drift = DriftCorrection(fd, dd, diagnostics=True)  # do drift correction
+    # PlotDriftCorrection(drift)
     fd, Halen, Hblen = PrepareForcData(fd, mirror=True)  # add Ha column, pot. mirror data
     PlotForcCurves(fd)
 
-    fd = np.array(fd[['Ha', 'Hb', 'Moment']])
-
-    # print( fd)
-
     # plot raw forc data M( Ha, Hb)
-    x = fd[:, 1]  # Hb
-    y = fd[:, 0]  # Ha
-    z = fd[:, 2]
-    # define grid
-
-    minHa, maxHa = min(y), max(y)
-    minHb, maxHb = min(x), max(x)
-
-    # print(x,y,z)
-    print(minHa, maxHa)
-    print(minHb, maxHb)
-
-    xi = np.linspace(minHb, maxHb, Hblen)
-    yi = np.linspace(minHa, maxHa, Halen)
-    # grid the data
-    # zi = griddata(x,y,z,xi,yi,interp='linear')  # linearly interpolate values to regular grid
-
-    f = interpolate.LinearNDInterpolator(fd[:, [1, 0]], z, fill_value=np.nan)  # bilinear
-    # f = interpolate.NearestNDInterpolator(fd[:, [1, 0]], z)  # nearest neighborhood
-    # f = interpolate.SmoothBivariateSpline( x, y, z, s=1, kx=3, ky=3)
-
-    # f2 = interpolate.interp2d( x, y, z, kind='linear', fill_value = np.nan)
-    # zi = f2(xi, yi)
-
-    mg_xn, mg_yn = np.meshgrid(xi, yi)
-    zi = f(mg_xn, mg_yn)
-
-    # print( 'finding bicubic spline representation...')
-    # tck = interpolate.bisplrep(x, y, z, s=0, kx=3, ky=3)  # bicubic splines
-    # print('interpolating spline to grid')
-    # zi = interpolate.bisplev(mg_xn[:,0], mg_yn[0,:], tck)  # gives always zero!?
-
-    # xi, yi, zi are regular gridded forc values
+    # interpolate to regular grid: xi, yi, zi are regular gridded forc values
+    xi, yi, zi = GridForcData(fd, Halen, Hblen)
+    print(yi[0], yi[-1])
+    print(xi[0], xi[-1])
 
     # contour the gridded data
     start_time = timeit.default_timer()
     print("starting plotting figure 1 at {}s ....".format(start_time - initial_time))
-    plt.contourf(xi, yi, zi, 50, cmap=plt.cm.get_cmap("jet"))
-
-    # plt.imshow( zi, origin='lower', extent=(minHb, maxHb, minHa, maxHa), cmap='jet')
-    plt.colorbar()  # draw colorbar
-    plt.xlabel('Hb')
-    plt.ylabel('Ha')
-    plt.title('FORC raw data (magnetic moments)')
-    plt.axis('equal')
+    PlotForcGrid(xi, yi, zi, title='FORC raw data (magnetic moments)', figure=1)
 
     # now run convolution on regular gridded (interpolated) forc data
-    # define a kernel for differentiation in xy
-    # k = -np.array([[1, 0, -1],
-    #              [0, 0, 0],
-    #              [-1, 0, 1]])
-
-    k = -np.array([[1, 2, 0, -2, -1],
-                   [2, 4, 0, -4, -2],
-                   [0, 0, 0, 0, 0],
-                   [-2, -4, 0, 4, 2],
-                   [-1, -2, 0, 2, 1]])
-
-    k = k / np.absolute(k).sum()  # normalize k to get right scaling of output
-
-    raw_forc = zi
-    # print(raw_forc.shape)
-
     start_time = timeit.default_timer()
     print("starting data convolution at {}s ....".format(start_time - initial_time))
-    conv_forc = ndimage.convolve(raw_forc, k, mode='reflect')
+    conv_forc = ConvolveForcGrid(zi, FORC_KERNEL)
     print("Seconds for data convolution: {}".format(timeit.default_timer() - start_time))
 
     start_time = timeit.default_timer()
     print("starting plotting figure 2 at {}s ....".format(start_time - initial_time))
-    plt.figure(2)
-    # contour the gridded data
-    plt.contourf(xi, yi, conv_forc, 50, cmap=plt.cm.get_cmap("jet"))
-    # print(zi)
-    # plt.imshow( zi, origin='lower', extent=(minHb, maxHb, minHa, maxHa), cmap='RdBu')
-    plt.colorbar()  # draw colorbar
-    plt.xlabel('Hb')
-    plt.ylabel('Ha')
-    plt.title('FORC processed')
-    plt.axis('equal')
-
-    xv, yv = np.meshgrid(xi, yi)
-
-    print("starting TranslateHaHbHcHu....")
-    start_time = timeit.default_timer()
-    fittedFORCdata = FastTranslateHaHbHcHu(np.array([yv.flatten(), xv.flatten(), conv_forc.flatten()]).T)
-    print("Seconds for TranslateHaHbHcHu: {}".format(timeit.default_timer() - start_time))
-    #
-    x, y, z = fittedFORCdata[:, 0], fittedFORCdata[:, 1], fittedFORCdata[:, 2]
-    # # define grid
-    #
-    xi = np.linspace(0, max(x), Halen * 2)  # Hc space
-    yi = np.linspace(min(y), max(y), Hblen * 2)  # Hu space
-
-    # # grid the data
+    PlotForcGrid(xi, yi, conv_forc, title='FORC processed', figure=2)
+
+    # translate to Hc, Hu and grid the data
     start_time = timeit.default_timer()
     print("starting gridding data at {}s ....".format(start_time - initial_time))
-    grid = np.meshgrid(xi, yi)
-    # grid the data
-    points = np.column_stack((x, y))
-    zi = griddata(points, z, tuple(grid), method='linear', fill_value=np.nan)
-    print(zi)
-    print("done")
+    xi, yi, zi = GridHcHu(xi, yi, conv_forc, Halen, Hblen)
+    print("Seconds for TranslateHaHbHcHu and gridding: {}".format(timeit.default_timer() - start_time))
 
     start_time = timeit.default_timer()
     print("starting plotting figure 3 at {}s ....".format(start_time - initial_time))
-    plt.figure(3)
-    # # contour the gridded data
-    cs = plt.contourf(xi, yi, zi, 50, cmap=plt.cm.get_cmap("jet"))
-    plt.contour(cs, levels=cs.levels[::5], colors='black')  # add contour lines
-    plt.axhline(0, color='black')
-    # plt.imshow( zi, origin='lower', extent=(minHb, maxHb, minHa, maxHa), cmap='RdBu')
-    plt.colorbar(cs)  # draw colorbar
-    # # plot data points.
-    plt.xlabel('Hc')
-    plt.ylabel('Hu')
-    # # show data points
-    # #plt.scatter( x, y)
-    plt.title('FORC processed (Hu,Hc)')
-    plt.axis('equal')
-    #
-    # #plt.xlim( [0, 0.1])
-    # #plt.ylim( [-0.1, 0.03])
-    # #plt.savefig( fname + '.png')
+    PlotForcGrid(xi, yi, zi, title='FORC processed (Hu,Hc)', xlabel='Hc', ylabel='Hu', figure=3, contourlines=True,
+                 axhline=True)
 
     start_time = timeit.default_timer()
     print("finished after {}s total. showing plots.".format(start_time - initial_time))
 
-    plt.show()
+    Show('forc_convolution')
@@ -0,0 +1,159 @@
+__author__ = 'wack'
+
+# Compact FORC data container
+# the points of all curves (FORCs or drift measurements) are stored in contiguous column arrays sorted by
+# curve, curve i occupies rows offsets[i] ... offsets[i + 1] - 1 (CSR like). Per curve values (segment label,
+# Ha) are stored once per curve. Field and moment columns are float32 or float64.
+# Import, drift correction, preparation and gridding of forc_convolution accept a ForcDataset instead of a
+# data frame, d['Hb'], d['Moment'], d['segment'], ... give the same columns as the data frame would.
+# float32 halves the memory, use it with structured gridding: the triangulation of regular FORC lattices for
+# linear gridding is degenerate and its triangles change with the rounding of the field values
+
+import numpy as np
+
+PRECISIONS = (np.float32, np.float64)
+
+
+class ForcDataset:
+    """ curves as column arrays field, moment with curve offsets, per curve labels and Ha """
+
+    __slots__ = ('field', 'moment', 'offsets', 'labels', 'Ha', 'segstep', 'fieldname')
+
+    def __init__(self, field, moment, offsets, labels=None, Ha=None, segstep=None, fieldname='Hb', dtype=None):
+        dtype = np.result_type(field, moment) if dtype is None else np.dtype(dtype)
+        if dtype not in PRECISIONS:
+            raise ValueError('precision must be one of {}, not {}'.format(PRECISIONS, dtype))
+        self.field = np.ascontiguousarray(field, dtype=dtype)
+        self.moment = np.ascontiguousarray(moment, dtype=dtype)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if self.offsets[0] != 0 or self.offsets[-1] != len(self.field) or len(self.field) != len(self.moment):
+            raise ValueError('offsets do not match the column lengths')
+        ncurves = len(self.offsets) - 1
+        self.labels = np.arange(ncurves) if labels is None else np.asarray(labels, dtype=np.int64)
+        self.Ha = None if Ha is None else np.asarray(Ha, dtype=dtype)  # reversal field of each curve
+        self.segstep = None if segstep is None else np.ascontiguousarray(segstep, dtype=float)  # per point
+        self.fieldname = fieldname  # column name of field: 'Hb' (forc) or 'Field' (drift)
+
+    @classmethod
+    def FromFrame(cls, df, dtype=np.float64):
+        """ dataset of a data frame with columns Hb or Field, Moment and segment (rows grouped by segment) """
+        fieldname = 'Hb' if 'Hb' in df else 'Field'
+        segments = df['segment'].to_numpy()
+        order = np.argsort(segments, kind='stable')
+        if np.all(order == np.arange(len(order))):  # usual case: already sorted, no reordering copy
+            order = slice(None)
+        s = segments[order]
+        starts = np.flatnonzero(np.append(True, s[1:] != s[:-1])) if len(s) else np.empty(0, dtype=np.int64)
+        Ha = df['Ha'].to_numpy()[order][starts] if 'Ha' in df else None
+        segstep = df['segstep'].to_numpy()[order] if 'segstep' in df else None
+        return cls(df[fieldname].to_numpy()[order], df['Moment'].to_numpy()[order], np.append(starts, len(s)),
+                   labels=s[starts], Ha=Ha, segstep=segstep, fieldname=fieldname, dtype=dtype)
+
+    @classmethod
+    def FromSegments(cls, field, moment, segment, fieldname='Hb', dtype=np.float64):
+        """ dataset of point columns with non decreasing segment numbers (file order), no data frame needed """
+        segment = np.asarray(segment)
+        starts = np.flatnonzero(np.append(True, segment[1:] != segment[:-1])) if len(segment) else \
+            np.empty(0, dtype=np.int64)
+        return cls(field, moment, np.append(starts, len(segment)), labels=segment[starts], fieldname=fieldname,
+                   dtype=dtype)
+
+    def ToFrame(self):
+        """ data frame with the columns of the dataset """
+        import pandas as pd
+        columns = {self.fieldname: self.field, 'Moment': self.moment, 'segment': self['segment']}
+        if self.Ha is not None:
+            columns['Ha'] = self['Ha']
+        if self.segstep is not None:
+            columns['segstep'] = self.segstep
+        return pd.DataFrame(columns)
+
+    def Replace(self, **columns):
+        """ new dataset sharing all arrays except the given ones (field, moment, offsets, labels, Ha, segstep) """
+        values = {name: getattr(self, name) for name in ('field', 'moment', 'offsets', 'labels', 'Ha', 'segstep')}
+        values.update(columns)
+        return ForcDataset(fieldname=self.fieldname, dtype=self.dtype, **values)
+
+    def Astype(self, dtype):
+        """ dataset with field, moment and Ha in precision dtype """
+        return ForcDataset(self.field, self.moment, self.offsets, self.labels, self.Ha, self.segstep,
+                           fieldname=self.fieldname, dtype=dtype)
+
+    @property
+    def dtype(self):
+        return self.field.dtype
+
+    @property
+    def ncurves(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        arrays = (self.field, self.moment, self.offsets, self.labels, self.Ha, self.segstep)
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    def __len__(self):
+        return len(self.field)
+
+    def __contains__(self, name):
+        if name in ('Ha', 'segstep'):
+            return getattr(self, name) is not None
+        return name in ('Hb', 'Field', 'Moment', 'segment')
+
+    def __getitem__(self, name):
+        """ point column by data frame name: Hb (or Field), Moment, segment, Ha, segstep """
+        if name in ('Hb', 'Field'):
+            return self.field
+        if name == 'Moment':
+            return self.moment
+        if name == 'segment':
+            return np.repeat(self.labels, self.lengths)
+        if name == 'Ha' and self.Ha is not None:
+            return np.repeat(self.Ha, self.lengths)
+        if name == 'segstep' and self.segstep is not None:
+            return self.segstep
+        raise KeyError(name)
+
+    def CurveIndex(self):
+        """ curve number (0 ... ncurves - 1) of each point """
+        return np.repeat(np.arange(self.ncurves), self.lengths)
+
+    def SegmentIndex(self):
+        """ order, starts, lengths, segment numbers as forc_convolution.SegmentIndex, without sorting """
+        return np.arange(len(self)), self.offsets[:-1], self.lengths, self.CurveIndex()
+
+    def Curve(self, i):
+        """ field and moment of curve i (views, no copies) """
+        a, b = self.offsets[i], self.offsets[i + 1]
+        return self.field[a:b], self.moment[a:b]
+
+    def Curves(self):
+        """ iterate over (label, field, moment) of all curves """
+        for i, label in enumerate(self.labels):
+            yield (label,) + self.Curve(i)
+
+    def __repr__(self):
+        return '<ForcDataset {} curves, {} points, {}>'.format(self.ncurves, len(self), self.dtype)
+
+
+def AsDataset(data, dtype=np.float64):
+    """ ForcDataset of data frame or dataset data in precision dtype """
+    if isinstance(data, ForcDataset):
+        return data if data.dtype == dtype else data.Astype(dtype)
+    return ForcDataset.FromFrame(data, dtype=dtype)
+
+
+if __name__ == '__main__':  # test routine
+    import sys
+    from forc_convolution import FastImportFORCData
+
+    fname = sys.argv[1] if len(sys.argv) > 1 else '../data/FeNi100-A-a-24-M001_005.forc'
+    dd, fd = FastImportFORCData(fname, dialect='auto')
+    for dtype in PRECISIONS:
+        ds = AsDataset(fd, dtype=dtype)
+        print('{}: {:.1f} MB (data frame {:.1f} MB)'.format(ds, ds.nbytes / 2 ** 20,
+                                                          fd.memory_usage(index=True).sum() / 2 ** 20))
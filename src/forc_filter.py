@@ -0,0 +1,189 @@
+__author__ = 'wack'
+
+# FORC convolution engine
+# mixed derivative kernels d2/dHa dHb for any smoothing factor and their application to gridded moments:
+# direct, separable (rank one kernels) or FFT based convolution, chosen by kernel size
+# nan aware (normalized) convolution keeps masked grid regions from spreading into their neighbours
+# variable smoothing (VARIFORC like, Egli 2013): the smoothing factor grows with distance from the Hu=0 ridge and
+# the Hc=0 axis, pixels are bucketed by smoothing factor and each bucket is convolved with its kernel from the bank
+# all functions work on single grids (rows Ha, columns Hb) and on stacks of grids (..., Ha, Hb)
+
+from functools import lru_cache
+
+import numpy as np
+
+DIRECT_MAX = 49  # non separable kernels with up to this many weights are convolved directly, larger ones by FFT
+SEPARABLE_MAX = 65  # separable kernels up to this width are convolved as two 1d passes, wider ones by FFT
+
+# boundary modes of ndimage and the matching np.pad modes for the FFT path
+PAD_MODES = {'reflect': 'symmetric', 'mirror': 'reflect', 'nearest': 'edge', 'wrap': 'wrap', 'constant': 'constant'}
+
+
+def Binomial(n):
+    """ normalized binomial smoothing weights of length n """
+    from scipy.special import comb
+    b = comb(n - 1, np.arange(n))
+    return b / b.sum()
+
+
+@lru_cache(maxsize=None)
+def MixedDerivativeKernel(SF=2, kind='sg'):
+    """ (2*SF+1)^2 convolution kernel of the FORC distribution -0.5 * d2M / dHa dHb
+
+    kind 'sg': Savitzky-Golay weights, same result as fitPolySurface on complete (2*SF+1)^2 subareas
+               (derivative in units of grid steps)
+    kind 'binomial': binomial smoothed central differences normalized to sum(abs(k)) = 1,
+                     SF=2 gives FORC_KERNEL of forc_convolution
+    """
+    if SF < 1:
+        raise ValueError('smoothing factor SF must be at least 1')
+    if kind == 'sg':
+        # over a symmetric square subarea x*y is orthogonal to the other polynomial terms,
+        # so its least squares coefficient is sum(x * y * z) / sum(x**2 * y**2)
+        x = np.arange(-SF, SF + 1, dtype=float)
+        k = -0.5 * np.outer(x, x) / (x @ x) ** 2
+    elif kind == 'binomial':
+        d = np.convolve(Binomial(2 * SF - 1), [1, 0, -1])
+        k = -np.outer(d, d)
+        k /= np.absolute(k).sum()
+    else:
+        raise ValueError("unknown kernel kind '{}'".format(kind))
+    k.setflags(write=False)  # cached, must not be changed by callers
+    return k
+
+
+def KernelScale(k):
+    """ factor converting the convolution of gridded moments with kernel k to -0.5 * d2M / dHa dHb in grid steps
+
+    1 for the Savitzky-Golay kernels, the binomial kernels (and FORC_KERNEL) are normalized differently.
+    Divide the result by the Ha and Hb steps for moment per field squared.
+    """
+    k = np.asarray(k, dtype=float)
+    # response of the convolution to M = i * j (d2M / di dj = 1), constant and linear terms cancel
+    i = k.shape[0] // 2 - np.arange(k.shape[0])
+    j = k.shape[1] // 2 - np.arange(k.shape[1])
+    return -0.5 / (i @ k @ j)
+
+
+def SeparableFactors(k, rtol=1e-10):
+    """ column and row vectors c, r with k = outer(c, r) if k has rank one, else None """
+    u, s, vt = np.linalg.svd(k)
+    if len(s) > 1 and s[1] > rtol * s[0]:
+        return None
+    return u[:, 0] * np.sqrt(s[0]), vt[0] * np.sqrt(s[0])
+
+
+def ChooseMethod(k):
+    """ fastest convolution method for kernel k: 'direct', 'separable' or 'fft' """
+    if max(k.shape) <= SEPARABLE_MAX and SeparableFactors(k) is not None:
+        return 'separable'
+    return 'direct' if k.size <= DIRECT_MAX else 'fft'
+
+
+def Convolve(z, k, mode='reflect', method='auto', cval=0.0):
+    """ convolve grid(s) z (..., rows, columns) with 2d kernel k, same result as ndimage.convolve """
+    from scipy import ndimage, signal  # imported on first use, slow to import
+    z = np.asarray(z, dtype=float)
+    k = np.asarray(k, dtype=float)
+    if method == 'auto':
+        method = ChooseMethod(k)
+
+    if method == 'direct':
+        return ndimage.convolve(z, k.reshape((1,) * (z.ndim - 2) + k.shape), mode=mode, cval=cval)
+    if method == 'separable':
+        factors = SeparableFactors(k)
+        if factors is None:
+            raise ValueError('kernel is not separable')
+        c, r = factors
+        z = ndimage.convolve1d(z, c, axis=-2, mode=mode, cval=cval)
+        return ndimage.convolve1d(z, r, axis=-1, mode=mode, cval=cval)
+    if method == 'fft':
+        # pad like ndimage (kernel centre at index shape // 2), then keep the valid part
+        after = np.array(k.shape) // 2
+        before = np.array(k.shape) - 1 - after
+        pad = [(0, 0)] * (z.ndim - 2) + list(zip(before, after))
+        kwargs = {'constant_values': cval} if mode == 'constant' else {}
+        padded = np.pad(z, pad, mode=PAD_MODES[mode], **kwargs)
+        return signal.fftconvolve(padded, k.reshape((1,) * (z.ndim - 2) + k.shape), mode='valid', axes=(-2, -1))
+    raise ValueError("unknown convolution method '{}'".format(method))
+
+
+def NormalizedConvolve(z, k, mode='reflect', method='auto', min_certainty=0.5):
+    """ nan aware convolution of grid(s) z with kernel k
+
+    nan values are replaced by a normalized binomial average of their valid neighbours within the footprint of k
+    (0 if there are none) before convolving. Points whose kernel support contains no nan get the same value as
+    Convolve(z, k), points near nan values depend on these filled in values. Points which are nan themselves or
+    whose valid points in the kernel support have less than min_certainty of sum(abs(k)) stay nan.
+    """
+    z = np.asarray(z, dtype=float)
+    valid = ~np.isnan(z)
+    if valid.all():
+        return Convolve(z, k, mode=mode, method=method)
+
+    # applicability: binomial weights with the footprint of k (separable, cheap for any size)
+    a = np.outer(Binomial(k.shape[0]), Binomial(k.shape[1]))
+    w = valid.astype(float)
+    num = Convolve(np.where(valid, z, 0), a, mode=mode, method=method)
+    den = Convolve(w, a, mode=mode, method=method)
+    filled = np.where(valid, z, np.divide(num, den, out=np.zeros(z.shape), where=den > 1e-12))
+
+    certainty = Convolve(w, np.absolute(k), mode=mode, method=method) / np.absolute(k).sum()
+    result = Convolve(filled, k, mode=mode, method=method)
+    result[~valid | (certainty < min_certainty - 1e-12)] = np.nan
+    return result
+
+
+def VariableSmoothingFactor(xi, yi, sf0=2, sfmax=10, lambda_u=0.05, lambda_c=0.05):
+    """ integer smoothing factor for each point of the grid with Hb axis xi (columns) and Ha axis yi (rows)
+
+    SF = sf0 + lambda_u * |Hu| + lambda_c * Hc (Hu, Hc in grid steps), limited to sf0 ... sfmax
+    """
+    step = min(abs(xi[1] - xi[0]), abs(yi[1] - yi[0]))
+    Hb, Ha = np.meshgrid(xi, yi)
+    Hu, Hc = (Ha + Hb) / 2 / step, (Hb - Ha) / 2 / step
+    sf = sf0 + lambda_u * np.absolute(Hu) + lambda_c * np.absolute(Hc)
+    return np.clip(np.rint(sf), sf0, sfmax).astype(int)
+
+
+def VariableConvolve(z, sf, mode='reflect', method='auto', nan_aware=False):
+    """ FORC distribution of grid(s) z with a smoothing factor per grid point (sf, same shape as the grid)
+
+    uses the Savitzky-Golay kernels of MixedDerivativeKernel, whose values do not depend on SF for smooth data.
+    Each SF bucket is convolved only over its bounding box (plus kernel margin) and composited into the result.
+    """
+    z = np.asarray(z, dtype=float)
+    sf = np.asarray(sf)
+    if sf.shape != z.shape[-2:]:
+        raise ValueError('smoothing factor shape {} does not match grid {}'.format(sf.shape, z.shape))
+    convolve = NormalizedConvolve if nan_aware else Convolve
+
+    result = np.full(z.shape, np.nan)
+    for s in np.unique(sf):
+        bucket = sf == s
+        rows, cols = np.flatnonzero(bucket.any(axis=1)), np.flatnonzero(bucket.any(axis=0))
+        # kernel margin around the bounding box, the true grid boundary is handled by mode
+        r0, r1 = max(rows[0] - s, 0), min(rows[-1] + s + 1, sf.shape[0])
+        c0, c1 = max(cols[0] - s, 0), min(cols[-1] + s + 1, sf.shape[1])
+        part = convolve(z[..., r0:r1, c0:c1], MixedDerivativeKernel(int(s)), mode=mode, method=method)
+        b = bucket[r0:r1, c0:c1]
+        result[..., r0:r1, c0:c1][..., b] = part[..., b]
+    return result
+
+
+if __name__ == '__main__':  # test routine
+    import timeit
+
+    z = np.random.default_rng(0).normal(size=(1500, 1500))
+    for SF in (2, 3, 5, 7, 10, 15):
+        k = MixedDerivativeKernel(SF)
+        times = {m: min(timeit.repeat(lambda: Convolve(z, k, method=m), number=1, repeat=3))
+                 for m in ('separable', 'fft', 'direct') if m != 'direct' or SF <= 7}
+        print("SF={:2d} auto={:9s} ".format(SF, ChooseMethod(k)) +
+              '  '.join('{} {:.3f}s'.format(m, t) for m, t in times.items()))
+
+    xi = yi = np.linspace(-0.1, 0.1, z.shape[0])
+    sf = VariableSmoothingFactor(xi, yi, sf0=2, sfmax=10)
+    start = timeit.default_timer()
+    VariableConvolve(z, sf)
+    print("variable SF {}..{}: {:.3f}s".format(sf.min(), sf.max(), timeit.default_timer() - start))
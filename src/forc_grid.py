@@ -0,0 +1,260 @@
+__author__ = 'wack'
+
+# Gridding of FORC data
+# linear interpolation from scattered (Ha, Hb) or (Hc, Hu) points to regular grids as a sparse matrix:
+# triangulation and barycentric weights are computed once per point set and target grid and can then be
+# applied to any number of value arrays (raw and drift corrected moments, bootstrap resamples, ...)
+# regular FORC protocols can skip the triangulation: curves are interpolated along Hb, then across Ha
+# Hc, Hu is a fixed 45 degree rotation of Ha, Hb: regular grids are resampled bilinearly without triangulation
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def ArrayKey(*arrays):
+    """ hash key of the content of numpy arrays """
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a, dtype=float)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+class LRUDict(OrderedDict):
+    """ dictionary keeping only the maxsize most recently used entries, Get is safe to use from several threads """
+
+    def __init__(self, maxsize=8):
+        super().__init__()
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+
+    def Get(self, key, factory):
+        """ value of key, created by factory() if not present
+
+        factory runs outside of the lock, if two threads create the same value the first one stored is kept
+        """
+        with self.lock:
+            if key in self:
+                self.move_to_end(key)
+                return self[key]
+        value = factory()
+        with self.lock:
+            if key in self:  # created by another thread meanwhile
+                self.move_to_end(key)
+                return self[key]
+            self[key] = value
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+        return value
+
+
+TRIANGULATIONS = LRUDict(maxsize=8)  # Delaunay triangulations by point set
+OPERATORS = LRUDict(maxsize=16)  # grid operators by point set and target grid
+
+
+def SparseMatrix(*args, **kwargs):
+    """ scipy.sparse.csr_matrix (scipy.sparse is imported on first use) """
+    from scipy import sparse
+    return sparse.csr_matrix(*args, **kwargs)
+
+
+def CachedDelaunay(points):
+    """ Delaunay triangulation of points (n, 2), reused for identical point sets """
+    from scipy.spatial import Delaunay
+    points = np.ascontiguousarray(points, dtype=float)
+    return TRIANGULATIONS.Get(ArrayKey(points), lambda: Delaunay(points))
+
+
+class SparseGridOperator:
+    """ interpolation to a regular grid (axes xi, yi) given by a sparse matrix (grid points x data points) """
+
+    def __init__(self, matrix, xi, yi, outside):
+        self.matrix = matrix
+        self.xi = np.asarray(xi, dtype=float)  # grid columns
+        self.yi = np.asarray(yi, dtype=float)  # grid rows
+        self.outside = outside  # flattened grid points without data
+        self.npoints = matrix.shape[1]
+
+    @property
+    def shape(self):
+        return len(self.yi), len(self.xi)
+
+    def __call__(self, values, fill_value=np.nan):
+        """ interpolate values (..., npoints) to the grid, returns array (..., len(yi), len(xi)) """
+        values = np.asarray(values, dtype=float)
+        batch = values.shape[:-1]
+        result = (self.matrix @ values.reshape(-1, self.npoints).T).T
+        result[:, self.outside] = fill_value
+        return result.reshape(batch + self.shape)
+
+
+class LinearGridOperator(SparseGridOperator):
+    """ piecewise linear interpolation of values at scattered points to a regular grid
+
+    gives the same values as scipy.interpolate.LinearNDInterpolator / griddata(method='linear')
+    """
+
+    def __init__(self, points, xi, yi, tri=None):
+        # the triangulation is not kept: cached operators must not hold on to it beyond TRIANGULATIONS
+        tri = CachedDelaunay(points) if tri is None else tri
+
+        mg_x, mg_y = np.meshgrid(xi, yi)
+        targets = np.column_stack((mg_x.ravel(), mg_y.ravel()))
+        simplex = tri.find_simplex(targets)
+        inside = np.flatnonzero(simplex >= 0)
+
+        # barycentric coordinates of grid points within their triangle
+        transform = tri.transform[simplex[inside]]
+        b = np.einsum('ijk,ik->ij', transform[:, :2], targets[inside] - transform[:, 2])
+        weights = np.column_stack((b, 1 - b.sum(axis=1)))
+
+        rows = np.repeat(inside, 3)
+        columns = tri.simplices[simplex[inside]].ravel()
+        matrix = SparseMatrix((weights.ravel(), (rows, columns)), shape=(len(targets), len(tri.points)))
+        # grid points outside of the convex hull of the points
+        super().__init__(matrix, xi, yi, simplex < 0)
+
+
+def LinearWeights(x, xq, starts, ends):
+    """ linear interpolation of sorted sections x[starts[i]:ends[i]] at positions xq (nsections, nq)
+
+    returns lower and upper index, weight of the upper point and validity (xq within section)
+    """
+    lo = np.empty(xq.shape, dtype=np.int64)
+    for i, (a, b) in enumerate(zip(starts, ends)):  # one vectorized search per section
+        lo[i] = a + np.searchsorted(x[a:b], xq[i], side='right') - 1
+    first, last = starts[:, np.newaxis], ends[:, np.newaxis] - 1
+    valid = (xq >= x[first]) & (xq <= x[last])
+    lo = np.clip(lo, first, np.maximum(last - 1, first))
+    hi = np.minimum(lo + 1, last)
+    dx = x[hi] - x[lo]
+    w = np.divide(xq - x[lo], dx, out=np.zeros(xq.shape), where=dx > 0)
+    return lo, hi, w, valid
+
+
+class StructuredGridOperator(SparseGridOperator):
+    """ gridding of FORC data using its curve structure, no triangulation
+
+    each curve (points with the same label in curves, one Ha each) is interpolated linearly along Hb onto the
+    grid columns xi, then neighbouring curves are interpolated linearly along Ha onto the grid rows yi.
+    Grid points outside of the measured curves are masked.
+    """
+
+    def __init__(self, curves, Ha, Hb, xi, yi):
+        xi = np.asarray(xi, dtype=float)
+        yi = np.asarray(yi, dtype=float)
+        Hb = np.asarray(Hb, dtype=float)
+        curves = np.asarray(curves)
+
+        # sort points by curve and Hb (usually already sorted)
+        order = np.lexsort((Hb, curves))
+        c = curves[order]
+        newcurve = np.append(True, c[1:] != c[:-1])
+        starts = np.flatnonzero(newcurve)
+        ends = np.append(starts[1:], len(c))
+
+        # curves sorted by Ha
+        curveHa = np.asarray(Ha, dtype=float)[order][starts]
+        corder = np.argsort(curveHa, kind='stable')
+        curveHa, starts, ends = curveHa[corder], starts[corder], ends[corder]
+
+        # 1d interpolation of all curves along Hb
+        hb = Hb[order]
+        lo, hi, wb, validb = LinearWeights(hb, np.broadcast_to(xi, (len(starts), len(xi))), starts, ends)
+
+        # 1d interpolation between curves along Ha
+        ja, ka, wa, valida = LinearWeights(curveHa, yi[np.newaxis, :], np.array([0]), np.array([len(curveHa)]))
+        ja, ka, wa, valida = ja[0], ka[0], wa[0][:, np.newaxis], valida[0][:, np.newaxis]
+        valid = valida & (validb[ja] | (wa == 1)) & (validb[ka] | (wa == 0))
+
+        # combine into sparse matrix, four points for each grid point
+        rows = np.arange(len(yi) * len(xi)).reshape(len(yi), len(xi))
+        weights = np.stack(((1 - wa) * (1 - wb[ja]), (1 - wa) * wb[ja], wa * (1 - wb[ka]), wa * wb[ka]))
+        columns = np.stack((lo[ja], hi[ja], lo[ka], hi[ka]))
+        use = valid & (weights != 0)
+        matrix = SparseMatrix((weights[use], (np.broadcast_to(rows, use.shape)[use], order[columns[use]])),
+                              shape=(len(yi) * len(xi), len(Hb)))
+        super().__init__(matrix, xi, yi, ~valid.ravel())
+
+
+def RegularIndex(axis, values):
+    """ fractional index of values on the evenly spaced axis """
+    axis = np.asarray(axis, dtype=float)
+    if len(axis) < 2:
+        raise ValueError('axis needs at least two values')
+    step = (axis[-1] - axis[0]) / (len(axis) - 1)
+    if not np.allclose(np.diff(axis), step, rtol=1e-6, atol=0):
+        raise ValueError('axis is not evenly spaced')
+    return (values - axis[0]) / step
+
+
+class RotationGridOperator(SparseGridOperator):
+    """ bilinear resampling of a regular Ha (rows, axis yi), Hb (columns, axis xi) grid to a regular Hc, Hu grid
+
+    Hb = Hu + Hc and Ha = Hu - Hc, so each Hc, Hu grid point lies in a known cell of the Ha, Hb grid
+    """
+
+    def __init__(self, xi, yi, hc, hu):
+        mg_hc, mg_hu = np.meshgrid(hc, hu)
+        col = RegularIndex(xi, mg_hu + mg_hc).ravel()  # fractional Hb index
+        row = RegularIndex(yi, mg_hu - mg_hc).ravel()  # fractional Ha index
+        nx, ny = len(xi), len(yi)
+
+        eps = 1e-9  # rounding of points on the grid boundary
+        outside = (col < -eps) | (col > nx - 1 + eps) | (row < -eps) | (row > ny - 1 + eps)
+        c0 = np.clip(np.floor(col), 0, nx - 2).astype(np.int64)
+        r0 = np.clip(np.floor(row), 0, ny - 2).astype(np.int64)
+        wc = np.clip(col - c0, 0, 1)
+        wr = np.clip(row - r0, 0, 1)
+
+        # four corners of the cell for each target point, zero weights are dropped so that nan values
+        # in neighbouring cells do not spread
+        weights = np.stack(((1 - wr) * (1 - wc), (1 - wr) * wc, wr * (1 - wc), wr * wc))
+        columns = np.stack((r0 * nx + c0, r0 * nx + c0 + 1, (r0 + 1) * nx + c0, (r0 + 1) * nx + c0 + 1))
+        rows = np.broadcast_to(np.arange(len(col)), weights.shape)
+        use = ~outside & (weights != 0)
+        matrix = SparseMatrix((weights[use], (rows[use], columns[use])), shape=(len(col), nx * ny))
+        super().__init__(matrix, hc, hu, outside)
+
+
+def rotate_to_hc_hu(grid, axes, hc=None, hu=None):
+    """ resample grid (..., rows Ha, columns Hb) on regular axes (Hb, Ha) to a regular Hc, Hu grid
+
+    hc, hu are the target axes or their number of points (default 2 * number of Ha resp. Hb values over
+    the covered range with Hc >= 0)
+    returns Hc axis, Hu axis and resampled grid (..., rows Hu, columns Hc), nan outside of the Ha, Hb grid
+    """
+    xi, yi = (np.asarray(a, dtype=float) for a in axes)
+    grid = np.asarray(grid, dtype=float)
+    if grid.shape[-2:] != (len(yi), len(xi)):
+        raise ValueError('grid shape {} does not match axes ({}, {})'.format(grid.shape, len(yi), len(xi)))
+
+    if hc is None:
+        hc = 2 * len(yi)
+    if np.ndim(hc) == 0:
+        hc = np.linspace(0, (xi.max() - yi.min()) / 2, hc)
+    if hu is None:
+        hu = 2 * len(xi)
+    if np.ndim(hu) == 0:
+        hu = np.linspace((xi.min() + yi.min()) / 2, (xi.max() + yi.max()) / 2, hu)
+    hc, hu = np.asarray(hc, dtype=float), np.asarray(hu, dtype=float)
+
+    key = ArrayKey(xi, yi, hc, hu) + ':rotation'
+    operator = OPERATORS.Get(key, lambda: RotationGridOperator(xi, yi, hc, hu))
+    return hc, hu, operator(grid.reshape(grid.shape[:-2] + (-1,)))
+
+
+def GridOperator(points, xi, yi):
+    """ LinearGridOperator for points and target grid axes, reused for identical inputs """
+    points = np.ascontiguousarray(points, dtype=float)
+    return OPERATORS.Get(ArrayKey(points, xi, yi), lambda: LinearGridOperator(points, xi, yi))
+
+
+def StructuredOperator(curves, Ha, Hb, xi, yi):
+    """ StructuredGridOperator for curve labels, points and target grid axes, reused for identical inputs """
+    key = ArrayKey(curves, Ha, Hb, xi, yi) + ':structured'
+    return OPERATORS.Get(key, lambda: StructuredGridOperator(curves, Ha, Hb, xi, yi))
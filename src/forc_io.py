@@ -0,0 +1,391 @@
+__author__ = 'wack'
+
+# Reading of FORC measurement files
+# file dialects (MicroMag, VFTB) are registered readers with a header sniffer and a vectorized body parser,
+# all of them return a FORCMeasurement.
+# The data body is parsed in chunks directly from the (memory mapped) file buffer,
+# segment boundaries (empty lines) are detected on the raw bytes
+
+import io
+import logging
+import mmap
+import re
+
+import numpy as np
+
+from forc_dataset import ForcDataset
+
+log = logging.getLogger(__name__)
+
+COMMA_TO_BLANK = bytes.maketrans(b',', b' ')
+
+
+def ScanMicroMagHeader(lines):
+    """ consume MicroMag header lines up to the data header line
+
+    returns dictionary with the declared inclusion of a hysteresis loop and msi branch and the file format
+    """
+    header = {'hysteresis loop': False, 'msi': False, 'format': None}
+
+    # important to check if those are declared in the header
+    # in this case those must be treated/removed before the forc data
+
+    cl = 0  # current line number
+
+    for line in lines:
+        cl += 1  # increase current line number count
+        if "".join(line.split()).startswith('Includeshysteresisloop?Yes'):
+            header['hysteresis loop'] = True
+            log.debug('hysteresis loop declared in header line %d', cl)
+        elif "".join(line.split()).startswith('IncludesMsi(H)?Yes'):
+            header['msi'] = True
+            log.debug('msi branch declared in header line %d', cl)
+        elif "".join(line.split()).startswith(
+                'FieldMoment'):  # this marks beginning of data for Munich files (new micromag format?)
+            log.debug('data header (new format) detected in line %d', cl)
+            header['format'] = 'new'
+            break  # we are done with header lines
+        elif "".join(line.split()).startswith(
+                'NData'):  # this is end of header resp. beginning of data for forcopedia fiels (old micromag format?)
+            log.debug('data header (old format) detected in line %d', cl)
+            header['format'] = 'old'
+            break  # we are done with header lines
+
+    return header
+
+
+def FooterStart(mm, start, nlines):
+    """ byte offset of the first of the last nlines lines of mm (not before start) """
+    end = len(mm)
+    for i in range(nlines):
+        if end <= start:
+            break
+        end = max(mm.rfind(b'\n', start, end - 1) + 1, start)  # start of last line in [start, end)
+    return end
+
+
+def DataLines(a):
+    """ line lengths and non empty line flags of bytes array a (uint8) containing complete lines """
+    lineends = np.flatnonzero(a == ord('\n')) + 1
+    if len(lineends) == 0 or lineends[-1] != len(a):  # last line without newline
+        lineends = np.append(lineends, len(a))
+    linestarts = np.append(0, lineends[:-1])
+    # number of printable (non whitespace) characters in each line, empty lines mark segment boundaries
+    nprintable = np.add.reduceat(a > ord(' '), linestarts, dtype=np.int64)
+    nprintable[lineends == linestarts] = 0  # reduceat gives first element for empty ranges
+    return lineends - linestarts, nprintable > 0
+
+
+def ParseBodyChunk(buf, names, whitespace=False):
+    """ parse bytes of complete lines, returns (values of non empty lines, line flags of DataLines)
+
+    values are comma separated, whitespace=True also accepts blanks and tabs as separators (only the first
+    len(names) columns are used then)
+    """
+    import pandas as pd  # imported on first use, slow to import
+    a = np.frombuffer(buf, dtype=np.uint8)
+    linelengths, dataline = DataLines(a)
+
+    if np.all(dataline):
+        text = bytes(buf)
+    else:  # copy only non empty lines (within this chunk) to the parser
+        text = a[np.repeat(dataline, linelengths)].tobytes()
+
+    if len(text) == 0:
+        values = pd.DataFrame({c: np.empty(0) for c in names})
+    elif whitespace:
+        values = pd.read_csv(io.BytesIO(text.translate(COMMA_TO_BLANK)), sep=r'\s+', header=None, names=names,
+                             usecols=range(len(names)), dtype=float, index_col=False)
+    else:
+        values = pd.read_csv(io.BytesIO(text), skip_blank_lines=False, header=None, names=names, dtype=float,
+                             index_col=False)
+    return values, dataline
+
+
+def ReleasePages(mm, a, b):
+    """ tell the kernel that mapped bytes a..b are not needed anymore (keeps resident memory low) """
+    if hasattr(mm, 'madvise'):  # memory mapped file (and not bytes)
+        pagestart = a - a % mmap.PAGESIZE
+        mm.madvise(mmap.MADV_DONTNEED, pagestart, b - pagestart)
+
+
+def ReadBody(filename, start, skipfooter=2, names=('Field', 'Moment'), chunksize=1 << 20, memmap=False,
+             whitespace=False):
+    """ read data body of a file starting at byte offset start, without the last skipfooter lines
+
+    the file is parsed in chunks of about chunksize bytes, directly from the memory mapped file for memmap=True
+    (otherwise from the file content read into memory). The result is a data frame with the given columns
+    and column 'segment' (running number of blocks separated by empty lines), indexed by the line number
+    within the body. Empty lines are not included.
+    """
+    import pandas as pd
+    names = list(names)
+    with open(filename, 'rb') as f:
+        if start >= f.seek(0, io.SEEK_END):
+            return pd.DataFrame({c: np.empty(0) for c in names + ['segment']}).astype({'segment': np.int64})
+        if memmap:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:  # bytes offer the same find and slicing interface
+            f.seek(0)
+            mm = f.read()
+
+    try:
+        end = FooterStart(mm, start, skipfooter)
+
+        # split body into chunks of complete lines
+        bounds = [start]
+        while bounds[-1] < end:
+            b = min(bounds[-1] + chunksize, end)
+            if b < end:
+                nl = mm.rfind(b'\n', bounds[-1], b)
+                if nl == -1:  # very long line, extend chunk to its end
+                    nl = mm.find(b'\n', b, end)
+                b = end if nl == -1 else nl + 1
+            bounds.append(b)
+
+        # first pass: count data lines to preallocate output arrays
+        ndata = 0
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            buf = np.frombuffer(mm, dtype=np.uint8, count=b - a, offset=a)  # no copy
+            ndata += np.count_nonzero(DataLines(buf)[1])
+            del buf  # release buffer export before releasing pages / closing
+            ReleasePages(mm, a, b)
+        columns = {c: np.empty(ndata) for c in names}
+        segment = np.empty(ndata, dtype=np.int64)
+        index = np.empty(ndata, dtype=np.int64)
+
+        # second pass: parse chunks into the output arrays
+        pos = 0  # position in output arrays
+        lineoffset = 0  # number of lines in previous chunks
+        segoffset = 0  # number of empty lines in previous chunks
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            values, dataline = ParseBodyChunk(mm[a:b], names, whitespace=whitespace)
+            lines = np.flatnonzero(dataline)
+            n = len(lines)
+            for c in names:
+                columns[c][pos:pos + n] = values[c].to_numpy()
+            segment[pos:pos + n] = segoffset + np.cumsum(~dataline)[lines]
+            index[pos:pos + n] = lineoffset + lines
+            pos += n
+            lineoffset += len(dataline)
+            segoffset += np.count_nonzero(~dataline)
+            ReleasePages(mm, a, b)
+    finally:
+        if memmap:
+            mm.close()
+
+    fdf = pd.DataFrame(columns, index=index, copy=False)
+    fdf['segment'] = segment
+    return fdf
+
+
+def DataStart(filename, scanheader, skiplines=1):
+    """ byte offset of the data body, scanheader consumes header lines (str) up to the data header line
+
+    returns offset after skiplines further lines and the result of scanheader
+    """
+    with open(filename, 'rb') as f:
+        header = scanheader(line.decode('latin-1') for line in iter(f.readline, b''))
+        for i in range(skiplines):
+            f.readline()  # skip line(s) after data header
+        return f.tell(), header
+
+
+def SplitSegments(fdf, inc_hysloop=False, inc_msi=False):
+    """ split data into drift, forc, hysteresis and msi data frames
+
+    fdf contains columns Field, Moment, segment, segments are alternating single Ms (drift) values and
+    forc curves, optionally preceded by hysteresis loop and msi segments
+    """
+    hys_df = None
+    msi_df = None
+
+    fdf = fdf.dropna()  # remove empty lines
+
+    if inc_hysloop:  # if hysteresis loop is included in data set
+        # -> throw away first drift chunk (chunk_no == 0) and move the next two (chunk_no == 1 & 2) to hysteresis_df
+        hys_df = fdf[fdf.segment.isin([1, 2])]  # copy upfield and downfield hysteresis segment to hys_df
+        fdf = fdf[fdf.segment >= 3]  # drop first three segments (Ms & hysteresis up and downfield)
+
+    if inc_msi:
+        msi_df = fdf[fdf.segment == fdf.segment.min() + 1]  # copy msi segment to hys_df
+        fdf = fdf[fdf.segment > fdf.segment.min() + 1]  # drop msi segment from forc data
+
+    # forc data fdf consists of alternating single Ms (drift) values and forc curves as segments
+    # print(fdf)
+
+    # separate forc and Ms data
+    drift_df = fdf[fdf.segment.isin(
+        range(fdf.segment.min(), fdf.segment.max(), 2))].copy()  # get every second segment as drift data
+    forc_df = fdf[fdf.segment.isin(
+        range(fdf.segment.min() + 1, fdf.segment.max(), 2))].copy()  # get every other segment as forc curve
+
+    forc_df.rename(columns={'Field': 'Hb'}, inplace=True)  # rename column "Field" to "Hb"
+
+    return drift_df, forc_df, hys_df, msi_df
+
+
+def SplitDatasets(fdf, inc_hysloop=False, inc_msi=False, dtype=np.float64):
+    """ as SplitSegments, but drift and forc are ForcDatasets of precision dtype built directly from the columns
+    of fdf (hysteresis and msi stay data frames). Saves the data frame copies of the split for large files
+    """
+    field, moment, segment = (fdf[c].to_numpy() for c in ('Field', 'Moment', 'segment'))
+    valid = ~(np.isnan(field) | np.isnan(moment))  # empty lines
+    hys_df = msi_df = None
+
+    if inc_hysloop:  # segments 1 and 2 are the hysteresis branches, the first three segments are dropped
+        hys_df = fdf[valid & np.isin(segment, [1, 2])]
+        valid &= segment >= 3
+
+    if inc_msi:  # segment after the first remaining one is the msi branch
+        first = segment[valid].min()
+        msi_df = fdf[valid & (segment == first + 1)]
+        valid &= segment > first + 1
+
+    # alternating single Ms (drift) values and forc curves, the last segment (footer) is left out as in SplitSegments
+    first, last = segment[valid].min(), segment[valid].max()
+    valid &= segment < last
+    drift = valid & ((segment - first) % 2 == 0)
+    forc = valid & ((segment - first) % 2 == 1)
+
+    return (ForcDataset.FromSegments(field[drift], moment[drift], segment[drift], fieldname='Field', dtype=dtype),
+            ForcDataset.FromSegments(field[forc], moment[forc], segment[forc], fieldname='Hb', dtype=dtype),
+            hys_df, msi_df)
+
+
+class FORCMeasurement:
+    """ parsed FORC measurement: drift, forc, hysteresis and msi data frames and header information """
+
+    def __init__(self, drift, forc, hys=None, msi=None, header=None, dialect=None, filename=None):
+        # data frames or, if read with a dtype, ForcDatasets
+        self.drift = drift  # single Ms measurements before each FORC (columns Field, Moment, segment)
+        self.forc = forc  # FORC curves (columns Hb, Moment, segment)
+        self.hys = hys  # hysteresis loop branches or None
+        self.msi = msi  # msi branch or None
+        self.header = {} if header is None else header
+        self.dialect = dialect
+        self.filename = filename
+
+    def Segments(self):
+        """ drift, forc, hysteresis and msi data frames """
+        return self.drift, self.forc, self.hys, self.msi
+
+    def __repr__(self):
+        return '<FORCMeasurement {} ({}): {} forc points, {} drift points>'.format(
+            self.filename, self.dialect, len(self.forc), len(self.drift))
+
+
+DIALECTS = {}  # registered file dialects, name -> reader class
+VFTB_SNIFF_LINES = 3  # data lines needed to recognize a VFTB file
+
+
+def RegisterDialect(reader):
+    """ class decorator to register a reader for a file dialect
+
+    readers provide a name, Sniff(head) telling whether the first bytes head of a file belong to the dialect
+    and Read(filename, memmap, chunksize, dtype) returning a FORCMeasurement (drift and forc as ForcDatasets of
+    precision dtype unless dtype is None)
+    """
+    DIALECTS[reader.name] = reader
+    return reader
+
+
+def SniffDialect(filename, nbytes=4096):
+    """ name of the dialect of a file detected from its first bytes """
+    with open(filename, 'rb') as f:
+        head = f.read(nbytes)
+    for name, reader in DIALECTS.items():
+        if reader.Sniff(head):
+            return name
+    raise Exception("unknown dialect")
+
+
+def ReadMeasurement(filename, dialect='auto', memmap=False, chunksize=1 << 20, dtype=None):
+    """ read a FORC measurement file with the reader of its dialect (detected for 'auto')
+
+    dtype (np.float32 or np.float64): drift and forc as ForcDatasets of this precision instead of data frames
+    """
+    if dialect == 'auto':
+        dialect = SniffDialect(filename)
+    if dialect not in DIALECTS:
+        raise Exception("unknown dialect")
+    return DIALECTS[dialect].Read(filename, memmap=memmap, chunksize=chunksize, dtype=dtype)
+
+
+@RegisterDialect
+class MicroMagReader:
+    """ MicroMag 2900/3900 files, new (Munich, 'Field Moment' data header) and old (forcopedia, 'NData') format """
+    name = 'micromag'
+
+    @staticmethod
+    def Sniff(head):
+        return head.lstrip().startswith(b'MicroMag') or re.search(rb'^\s*NData', head, re.MULTILINE) is not None
+
+    @staticmethod
+    def Read(filename, memmap=False, chunksize=1 << 20, dtype=None):
+        # skip line after data header and the last 2 lines of the file
+        start, header = DataStart(filename, ScanMicroMagHeader)
+        fdf = ReadBody(filename, start, skipfooter=2, chunksize=chunksize, memmap=memmap)
+        if dtype is None:
+            segments = SplitSegments(fdf, header['hysteresis loop'], header['msi'])
+        else:
+            segments = SplitDatasets(fdf, header['hysteresis loop'], header['msi'], dtype=dtype)
+        return FORCMeasurement(*segments, header=header, dialect=MicroMagReader.name, filename=filename)
+
+
+@RegisterDialect
+class VFTBReader:
+    """ VFTB (Mag-Instruments) files: free text header, then blank, tab or comma separated columns field, moment,
+    (further columns are ignored), data segments separated by empty lines as in MicroMag files
+    """
+    name = 'vftb'
+
+    @staticmethod
+    def Sniff(head):
+        """ free text header followed by lines of the same number (at least two) of numeric columns, blank lines
+        between data segments. MicroMag files look alike and are claimed by their reader first """
+        columns, ndata = None, 0
+        for line in head.splitlines()[:-1]:  # the last line of head may be cut off
+            values = line.replace(b',', b' ').split()
+            if not values:  # empty line in the header or segment break
+                continue
+            try:
+                ncolumns = len([float(v) for v in values])
+            except ValueError:
+                if ndata:  # text after the first data line
+                    return False
+                continue
+            if ncolumns < 2 or columns not in (None, ncolumns):
+                return False
+            columns = ncolumns
+            ndata += 1
+        return ndata >= VFTB_SNIFF_LINES
+
+    @staticmethod
+    def ScanHeader(f):
+        """ header lines (key: value) of open binary file f, leaves f at start of first numeric line """
+        header = {'lines': []}
+        for line in iter(f.readline, b''):
+            try:  # data lines consist of at least two numbers
+                isdata = len([float(v) for v in line.replace(b',', b' ').split()]) >= 2
+            except ValueError:
+                isdata = False
+            if not isdata:
+                sl = line.decode('latin-1').strip()
+                header['lines'].append(sl)
+                if ':' in sl:
+                    key, value = sl.split(':', 1)
+                    header[key.strip()] = value.strip()
+                continue
+            f.seek(-len(line), io.SEEK_CUR)  # data starts with this line
+            break
+        return header
+
+    @staticmethod
+    def Read(filename, memmap=False, chunksize=1 << 20, dtype=None):
+        with open(filename, 'rb') as f:
+            header = VFTBReader.ScanHeader(f)
+            start = f.tell()
+        fdf = ReadBody(filename, start, skipfooter=0, chunksize=chunksize, memmap=memmap, whitespace=True)
+        segments = SplitSegments(fdf) if dtype is None else SplitDatasets(fdf, dtype=dtype)
+        return FORCMeasurement(*segments, header=header, dialect=VFTBReader.name, filename=filename)
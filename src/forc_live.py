@@ -0,0 +1,289 @@
+__author__ = 'wack'
+
+# Live processing of a running FORC measurement
+# tails a growing MicroMag or VFTB file, parses only the newly appended bytes and updates the FORC diagram
+# whenever a FORC curve is complete: the new curve becomes one row of the gridded M(Ha, Hb) (regular FORC
+# protocol, one grid row per FORC) and only the band of rows within reach of the kernel is convolved again.
+#
+# usage: python forc_live.py measurement.forc -o latest.npz
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from forc_convolution import FORC_KERNEL
+from forc_filter import Convolve, MixedDerivativeKernel, NormalizedConvolve
+from forc_io import DIALECTS, ScanMicroMagHeader
+
+
+def ParseValues(line):
+    """ first two numbers (field, moment) of a comma, tab or blank separated data line, None for other lines """
+    try:
+        values = [float(v) for v in line.replace(b',', b' ').split()[:2]]
+    except ValueError:
+        return None
+    return values if len(values) == 2 else None
+
+
+class LiveFORCReader:
+    """ incremental parser of a growing FORC file, segments are returned once they are complete """
+
+    def __init__(self, filename, dialect='auto'):
+        self.filename = filename
+        self.dialect = None if dialect == 'auto' else dialect
+        self.offset = 0  # bytes of the file consumed so far
+        self.partial = b''  # incomplete last line
+        self.headerlines = []
+        self.header = None  # set once the header is complete
+        self.skiplines = 0
+        self.first = 0  # first drift segment (after hysteresis loop and msi segments)
+        self.segment = 0  # current segment number (count of empty lines in the data body)
+        self.rows = []  # values of the current segment
+        self.finished = False  # end of file marker seen
+
+    def Poll(self):
+        """ parse data appended since the last call, returns list of new complete segments (kind, number, values)
+
+        kind is 'drift' or 'forc' (other segments are skipped), values is an array of rows (field, moment)
+        """
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()  # not terminated yet
+
+        if self.dialect is None:
+            head = b'\n'.join(self.headerlines + lines)
+            for name, reader in DIALECTS.items():
+                if reader.Sniff(head):
+                    self.dialect = name
+                    break
+            else:
+                if len(head) > 4096:
+                    raise Exception("unknown dialect")
+                self.headerlines.extend(lines)  # wait for more of the header
+                return []
+            lines = self.headerlines + lines
+            self.headerlines = []
+
+        segments = []
+        for line in lines:
+            if self.finished:
+                break
+            if self.header is None:
+                self.ScanHeader(line)
+                if self.header is None or self.dialect != 'vftb':
+                    continue  # vftb: first data line ends the header
+            if self.skiplines > 0:
+                self.skiplines -= 1
+                continue
+            if line.startswith(b'MicroMag 2900/3900 Data File ends'):
+                self.finished = True
+                break
+            if not line.strip():  # empty line: next segment
+                self.CloseSegment(segments)
+                self.segment += 1
+                continue
+            values = ParseValues(line)
+            if values is not None:
+                self.rows.append(values)
+        return segments
+
+    def ScanHeader(self, line):
+        """ collect header lines until the data starts """
+        if self.dialect == 'vftb':
+            if ParseValues(line) is None:
+                self.headerlines.append(line)
+                return
+            self.header = {'lines': [l.decode('latin-1').strip() for l in self.headerlines]}
+            return
+
+        self.headerlines.append(line)
+        compact = b''.join(line.split())
+        if compact.startswith(b'FieldMoment') or compact.startswith(b'NData'):
+            self.header = ScanMicroMagHeader(l.decode('latin-1') for l in self.headerlines)
+            self.skiplines = 1  # line after the data header
+            # forc data start after the hysteresis loop (3 segments) and msi (2 segments), see SplitSegments
+            self.first = 3 * self.header['hysteresis loop'] + 2 * self.header['msi']
+
+    def CloseSegment(self, segments):
+        if self.rows and self.segment >= self.first:
+            kind = 'drift' if (self.segment - self.first) % 2 == 0 else 'forc'
+            segments.append((kind, self.segment, np.array(self.rows)))
+        self.rows = []
+
+
+class LiveFORCGrid:
+    """ gridded moments and FORC distribution of a growing measurement, one grid row per FORC
+
+    columns are Hb values in steps of the field step of the first FORC, ending at its last field. Rows are in
+    order of measurement, the published diagram is sorted by Ha.
+    """
+
+    def __init__(self, mirror=True, SF=None, nan_aware=False, drift=False):
+        self.mirror = mirror
+        self.kernel = FORC_KERNEL if SF is None else MixedDerivativeKernel(SF)
+        self.nan_aware = nan_aware
+        self.drift = drift  # scale each FORC by first drift moment / preceding drift moment
+        self.drift0 = None
+        self.lastdrift = None
+        self.Ha = []
+        # row buffers grow by doubling, self.M and self.forc are views of the rows in use
+        self.Mbuf = np.empty((0, 0))
+        self.forcbuf = np.empty((0, 0))
+        self.Hmax = self.dH = None
+        self.descending = None  # Ha decreasing from FORC to FORC
+
+    @property
+    def M(self):
+        return self.Mbuf[:len(self.Ha)]
+
+    @property
+    def forc(self):
+        return self.forcbuf[:len(self.Ha)]
+
+    def Columns(self):
+        """ Hb value of each grid column """
+        return self.Hmax - self.dH * np.arange(self.Mbuf.shape[1])[::-1]
+
+    def AddDrift(self, values):
+        moment = values[:, 1].mean()
+        if self.drift0 is None:
+            self.drift0 = moment
+        self.lastdrift = moment
+
+    def AddForc(self, values):
+        """ add a FORC (rows Hb, moment), returns the range of grid rows whose FORC distribution changed """
+        Hb, M = values[:, 0], values[:, 1]
+        if self.drift and self.lastdrift:
+            M = M * self.drift0 / self.lastdrift
+        Ha = Hb[0]
+        if self.mirror:  # point reflection at the first point, as PrepareForcData
+            Hb = np.concatenate((2 * Ha - Hb[:0:-1], Hb))
+            M = np.concatenate((2 * M[0] - M[:0:-1], M))
+
+        if self.dH is None:
+            self.Hmax = Hb.max()
+            self.dH = np.median(np.diff(values[:, 0])) if len(values) > 1 else 1.0
+        if self.descending is None and self.Ha:
+            self.descending = Ha < self.Ha[0]
+
+        # more columns needed: grow to the left by doubling, everything is convolved again
+        n = len(self.Ha)
+        needed = int(np.ceil((self.Hmax - Hb.min()) / self.dH - 1e-6)) + 1
+        grown = needed > self.Mbuf.shape[1]
+        if grown:
+            ncols = max(needed, 2 * self.Mbuf.shape[1])
+            self.Mbuf = np.pad(self.Mbuf, ((0, 0), (ncols - self.Mbuf.shape[1], 0)), constant_values=np.nan)
+            self.forcbuf = np.full(self.Mbuf.shape, np.nan)
+        if n == len(self.Mbuf):  # more rows needed
+            self.Mbuf = np.vstack((self.Mbuf, np.full((max(n, 16), self.Mbuf.shape[1]), np.nan)))
+            self.forcbuf = np.vstack((self.forcbuf, np.full((max(n, 16), self.Mbuf.shape[1]), np.nan)))
+
+        # new row: curve interpolated to the columns within its field range
+        Hbcols = self.Columns()
+        inside = (Hbcols >= Hb.min()) & (Hbcols <= Hb.max())  # as StructuredGridOperator
+        self.Mbuf[n] = np.nan
+        self.Mbuf[n, inside] = np.interp(Hbcols[inside], Hb, M)
+        self.Ha.append(Ha)
+
+        if grown:
+            return self.Update(0, n + 1)
+        h = self.kernel.shape[0] // 2
+        return self.Update(max(n - h, 0), n + 1)
+
+    def Update(self, lo, hi):
+        """ convolve again rows lo ... hi - 1, input band with kernel margin """
+        h = self.kernel.shape[0] // 2
+        a, b = max(lo - h, 0), min(hi + h, len(self.Ha))
+        # rows in measurement order: flip the kernel for descending Ha
+        k = self.kernel[::-1] if self.descending else self.kernel
+        convolve = NormalizedConvolve if self.nan_aware else Convolve
+        self.forcbuf[lo:hi] = convolve(self.Mbuf[a:b], k, mode='reflect')[lo - a:hi - a]
+        return lo, hi
+
+    def Diagram(self):
+        """ Hb axis, Ha axis (ascending), gridded moments and FORC distribution """
+        order = np.argsort(self.Ha, kind='stable')
+        used = np.flatnonzero(~np.isnan(self.M).all(axis=0))  # skip unused columns of the buffer
+        c = used[0] if len(used) else 0
+        return self.Columns()[c:], np.array(self.Ha)[order], self.M[order, c:], self.forc[order, c:]
+
+
+class LiveFORCProcessor:
+    """ follow a running measurement, publish the FORC diagram after each new FORC
+
+    callback(result) is called with a dictionary Hb, Ha, M, forc, nforcs, finished; output (.npz) is replaced
+    atomically with the latest result
+    """
+
+    def __init__(self, filename, dialect='auto', callback=None, output=None, **gridargs):
+        self.reader = LiveFORCReader(filename, dialect=dialect)
+        self.grid = LiveFORCGrid(**gridargs)
+        self.callback = callback
+        self.output = output
+
+    def Step(self):
+        """ process newly appended data, returns number of new FORCs """
+        nforcs = 0
+        for kind, number, values in self.reader.Poll():
+            if kind == 'drift':
+                self.grid.AddDrift(values)
+            else:
+                self.grid.AddForc(values)
+                nforcs += 1
+        if nforcs:
+            self.Publish()
+        return nforcs
+
+    def Publish(self):
+        Hb, Ha, M, forc = self.grid.Diagram()
+        result = {'Hb': Hb, 'Ha': Ha, 'M': M, 'forc': forc, 'nforcs': len(Ha), 'finished': self.reader.finished}
+        if self.output:
+            tmp = self.output + '.tmp.npz'
+            np.savez(tmp, **result)
+            os.replace(tmp, self.output)
+        if self.callback:
+            self.callback(result)
+
+    def Run(self, poll=1.0, idle_timeout=None):
+        """ poll the file every poll seconds until the end of file marker or idle_timeout seconds without data """
+        last = time.monotonic()
+        while not self.reader.finished:
+            if self.Step():
+                last = time.monotonic()
+            elif idle_timeout is not None and time.monotonic() - last > idle_timeout:
+                break
+            else:
+                time.sleep(poll)
+        return self.grid.Diagram()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='live processing of a running FORC measurement')
+    parser.add_argument('filename', help='growing MicroMag or VFTB file')
+    parser.add_argument('-o', '--output', default=None, help='npz file with the latest diagram')
+    parser.add_argument('--dialect', default='auto', help='file dialect (default: detect)')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds between checks of the file')
+    parser.add_argument('--idle-timeout', type=float, default=None, help='stop after seconds without new data')
+    parser.add_argument('--sf', type=int, default=None, help='smoothing factor (default: fixed 5x5 kernel)')
+    parser.add_argument('--drift', action='store_true', help='scale FORCs by their preceding drift measurement')
+    parser.add_argument('--no-mirror', dest='mirror', action='store_false', help='do not mirror FORCs')
+    args = parser.parse_args(argv)
+
+    def Report(result):
+        print('{} FORCs, max |forc| {:.3g}'.format(result['nforcs'], np.nanmax(np.absolute(result['forc']),
+                                                                                  initial=0)))
+
+    processor = LiveFORCProcessor(args.filename, dialect=args.dialect, callback=Report, output=args.output,
+                                  mirror=args.mirror, SF=args.sf, drift=args.drift)
+    processor.Run(poll=args.poll, idle_timeout=args.idle_timeout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
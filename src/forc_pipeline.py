@@ -0,0 +1,212 @@
+__author__ = 'wack'
+
+# Processing pipeline with stage level instrumentation
+# a pipeline is a list of named stages working on a shared state dictionary, for each stage a record with
+# timing, peak memory of the process (and how far the stage raised it), sizes and nan fractions of its inputs and
+# outputs is sent to pluggable sinks (logging, JSON lines file or any callable), optionally with a cProfile or
+# tracemalloc capture of the stage
+
+import cProfile
+import json
+import logging
+import os
+import pstats
+import sys
+import timeit
+import tracemalloc
+
+import numpy as np
+
+try:
+    import resource  # unix only
+except ImportError:
+    resource = None
+
+from forc_convolution import FastImportFORCData, DriftCorrection, PrepareForcData, GridForcData, ConvolveForcGrid, \
+    VariableConvolveForcGrid, GridHcHu
+from forc_dataset import ForcDataset
+
+log = logging.getLogger(__name__)
+
+PROFILERS = (None, 'cprofile', 'tracemalloc')
+
+
+class Stage:
+    """ processing step: func(*inputs from state) returns the outputs (tuple for several outputs) """
+
+    def __init__(self, name, func, inputs, outputs):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+
+
+def Describe(value):
+    """ JSON serializable size information of a stage input or output """
+    if type(value).__name__ == 'DataFrame':  # no pandas import for other values
+        d = {'type': 'DataFrame', 'shape': list(value.shape), 'nbytes': int(value.memory_usage(index=True).sum())}
+        floats = [c for c in value.columns if value[c].dtype.kind == 'f']  # column by column, no copy of the frame
+        if floats:
+            nans = sum(int(value[c].isna().to_numpy().sum()) for c in floats)
+            d['nan_fraction'] = nans / (len(value) * len(floats)) if len(value) else 0.0
+        return d
+    if isinstance(value, ForcDataset):
+        d = {'type': 'ForcDataset', 'shape': [len(value), value.ncurves], 'nbytes': int(value.nbytes),
+             'dtype': str(value.dtype)}
+        d['nan_fraction'] = float(np.isnan(value.moment).mean()) if len(value) else 0.0
+        return d
+    if isinstance(value, np.ndarray):
+        d = {'type': 'ndarray', 'shape': list(value.shape), 'nbytes': int(value.nbytes)}
+        if value.dtype.kind == 'f':
+            d['nan_fraction'] = float(np.isnan(value).mean()) if value.size else 0.0
+        return d
+    if isinstance(value, (bool, int, float, str, np.integer, np.floating)):
+        return {'type': type(value).__name__, 'value': value.item() if hasattr(value, 'item') else value}
+    return {'type': type(value).__name__}
+
+
+def MaxRSS():
+    """ peak resident memory of the process in MB (None if not available) """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10, 1)  # bytes on macOS, kB elsewhere
+
+
+def ProfileSummary(profiler, n=10):
+    """ n functions with the largest cumulative time of a cProfile run """
+    stats = pstats.Stats(profiler).stats
+    top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:n]
+    return [{'function': '{}:{}({})'.format(*key), 'calls': value[1], 'cumtime': value[3]} for key, value in top]
+
+
+class LoggingSink:
+    """ stage records as log messages """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or log
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, '%s %s: %.4fs, max rss %s MB (+%s MB)', record.get('file', ''), record['stage'],
+                        record['seconds'], record['maxrss_mb'], record['maxrss_growth_mb'])
+
+
+class JSONLinesSink:
+    """ stage records appended to a file, one JSON object per line """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __call__(self, record):
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class Pipeline:
+    """ run stages in order, send a record for each stage to all sinks (callables taking the record dictionary)
+
+    profile: None, 'cprofile' (top functions in the record, .prof files in profile_dir if given) or
+    'tracemalloc' (peak of traced memory and largest allocations in the record)
+    """
+
+    def __init__(self, stages, sinks=(), profile=None, profile_dir=None):
+        if profile not in PROFILERS:
+            raise ValueError("unknown profiler '{}', use one of {}".format(profile, PROFILERS))
+        self.stages = list(stages)
+        self.sinks = list(sinks)
+        self.profile = profile
+        self.profile_dir = profile_dir
+
+    def Run(self, context=None, **state):
+        """ run all stages on the initial state (keyword arguments), returns the final state
+
+        context: dictionary added to every record (e.g. the file name)
+        """
+        tracing = self.profile == 'tracemalloc' and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        try:
+            for stage in self.stages:
+                self.RunStage(stage, state, context or {})
+        finally:
+            if tracing:
+                tracemalloc.stop()
+        return state
+
+    def RunStage(self, stage, state, context):
+        args = [state[name] for name in stage.inputs]
+        record = dict(context, stage=stage.name, inputs={name: Describe(state[name]) for name in stage.inputs})
+
+        profiler = cProfile.Profile() if self.profile == 'cprofile' else None
+        if self.profile == 'tracemalloc':
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        maxrss = MaxRSS()
+        start = timeit.default_timer()
+        if profiler:
+            profiler.enable()
+        try:
+            result = stage.func(*args)
+        finally:
+            if profiler:
+                profiler.disable()
+        record['seconds'] = timeit.default_timer() - start
+
+        if len(stage.outputs) == 1:
+            result = (result,)
+        state.update(zip(stage.outputs, result))
+
+        # the peak resident memory of the process only grows, maxrss_growth_mb is how far this stage raised it
+        record['maxrss_mb'] = MaxRSS()
+        record['maxrss_growth_mb'] = None if maxrss is None else round(record['maxrss_mb'] - maxrss, 1)
+        record['outputs'] = {name: Describe(state[name]) for name in stage.outputs}
+        if self.profile == 'tracemalloc':
+            record['peak_mb'] = (tracemalloc.get_traced_memory()[1] - before) / 2 ** 20
+            top = tracemalloc.take_snapshot().statistics('lineno')[:5]
+            record['allocations'] = [{'line': str(s.traceback), 'mb': s.size / 2 ** 20} for s in top]
+        if profiler:
+            record['profile'] = ProfileSummary(profiler)
+            if self.profile_dir:
+                stem = os.path.splitext(os.path.basename(str(context.get('file', 'pipeline'))))[0]
+                profiler.dump_stats(os.path.join(self.profile_dir, '{}.{}.prof'.format(stem, stage.name)))
+
+        for sink in self.sinks:
+            sink(record)
+
+
+def ForcConvolutionPipeline(dialect='auto', drift=False, polyorder=6, drift_model='poly', mirror=True, grid='linear',
+                            SF=None, nan_aware=False, SFmax=None, smoothing_lambda=0.05, dtype=None, **kwargs):
+    """ pipeline of forc_convolution: import, drift correction, prepare, grid, convolve, rotate to Hc, Hu
+
+    initial state: filename, final state includes Hb, Ha, M, forc, Hc, Hu, forc_hchu.
+    dtype: process the points as ForcDatasets of this precision instead of data frames
+    kwargs are passed to Pipeline (sinks, profile, profile_dir)
+    """
+    stages = [Stage('import', lambda f: FastImportFORCData(f, dialect=dialect, dtype=dtype),
+                    ['filename'], ['dd', 'fd'])]
+    if drift:
+        stages.append(Stage('drift', lambda fd, dd: DriftCorrection(fd, dd, polyorder=polyorder, model=drift_model),
+                            ['fd', 'dd'], ['fd']))
+    stages.append(Stage('prepare', lambda fd: PrepareForcData(fd, mirror=mirror), ['fd'], ['fd', 'Halen', 'Hblen']))
+    stages.append(Stage('grid', lambda fd, Halen, Hblen: GridForcData(fd, Halen, Hblen, method=grid),
+                        ['fd', 'Halen', 'Hblen'], ['Hb', 'Ha', 'M']))
+    if SFmax is not None:  # variable smoothing from SF (default 2) to SFmax
+        stages.append(Stage('convolve', lambda Hb, Ha, M: VariableConvolveForcGrid(
+            Hb, Ha, M, sf0=SF or 2, sfmax=SFmax, lambda_u=smoothing_lambda, lambda_c=smoothing_lambda,
+            nan_aware=nan_aware), ['Hb', 'Ha', 'M'], ['forc']))
+    else:
+        stages.append(Stage('convolve', lambda M: ConvolveForcGrid(M, SF=SF, nan_aware=nan_aware), ['M'], ['forc']))
+    stages.append(Stage('rotate', GridHcHu, ['Hb', 'Ha', 'forc', 'Halen', 'Hblen'], ['Hc', 'Hu', 'forc_hchu']))
+    return Pipeline(stages, **kwargs)
+
+
+if __name__ == '__main__':  # test routine
+    logging.basicConfig(level=logging.INFO)
+    fname = sys.argv[1] if len(sys.argv) > 1 else '../data/FeNi100-A-a-24-M001_005.forc'
+    records = []
+    pipeline = ForcConvolutionPipeline(drift=True, sinks=[LoggingSink(), records.append], profile='tracemalloc')
+    pipeline.Run(context={'file': fname}, filename=fname)
+    for r in records:
+        print('{:<10} {:8.4f}s  peak {:8.1f} MB  outputs {}'.format(r['stage'], r['seconds'], r['peak_mb'],
+                                                                 ', '.join(r['outputs'])))
@@ -0,0 +1,112 @@
+__author__ = 'wack'
+
+# Plotting of FORC data (optional, needs matplotlib)
+# the processing modules do not import matplotlib, all plotting lives here.
+# Figures written to files (SaveForcFigure) use the Agg canvas directly and never load pyplot or a GUI backend.
+# Headless mode (environment variable FORC_HEADLESS=1): interactive plots are drawn with the Agg backend and
+# Show saves them as PNG files instead of opening windows
+
+import os
+
+import numpy as np
+
+
+def Headless():
+    """ True if no windows should be opened (FORC_HEADLESS=1) """
+    return os.environ.get('FORC_HEADLESS', '0') not in ('', '0')
+
+
+def Pyplot():
+    """ matplotlib.pyplot, on the non interactive Agg backend in headless mode """
+    import matplotlib
+    if Headless():
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def Show(prefix='figure'):
+    """ show all figures, in headless mode save them to prefix_<number>.png instead """
+    plt = Pyplot()
+    if not Headless():
+        plt.show()
+        return
+    for n in plt.get_fignums():
+        plt.figure(n).savefig('{}_{}.png'.format(prefix, n))
+    plt.close('all')
+
+
+def PlotDriftCorrection(diagnostics):
+    """ plot drift measurements and fitted drift from the diagnostics of forc_convolution.DriftCorrection """
+    plt = Pyplot()
+    x = diagnostics['segment']
+    plt.plot(x, diagnostics['moment'], 'r.')
+    plt.plot(x, diagnostics['fit'], 'g-')
+
+
+def PlotForcCurves(forc_df):
+    """ plot each FORC of a data frame or ForcDataset """
+    plt = Pyplot()
+    segments = np.asarray(forc_df['segment'])
+    Hb, M = np.asarray(forc_df['Hb']), np.asarray(forc_df['Moment'])
+    for key in np.unique(segments):
+        curve = segments == key
+        plt.plot(Hb[curve], M[curve], label="FORC {}".format(key))
+    Show('forc_curves')
+
+
+def PlotForcGrid(xi, yi, zi, title='', xlabel='Hb', ylabel='Ha', figure=None, levels=50, contourlines=False,
+                 axhline=False, equal=True, style='image'):
+    """ plot of a gridded FORC quantity (rows yi, columns xi) on a (new) pyplot figure
+
+    style 'image': raster (imshow, fast for large grids), 'contourf': filled contours with levels levels
+    contourlines: overlay contour lines (every 5th level, 10 levels for images), only computed if asked for
+    """
+    plt = Pyplot()
+    plt.figure(figure)
+    if style == 'contourf':
+        cs = plt.contourf(xi, yi, zi, levels, cmap='jet')
+        lines = cs.levels[::5]
+    elif style == 'image':
+        dx, dy = (xi[-1] - xi[0]) / max(len(xi) - 1, 1) / 2, (yi[-1] - yi[0]) / max(len(yi) - 1, 1) / 2
+        cs = plt.imshow(zi, origin='lower', extent=(xi[0] - dx, xi[-1] + dx, yi[0] - dy, yi[-1] + dy), cmap='jet',
+                        interpolation='nearest', aspect='auto')
+        lines = max(levels // 5, 1)
+    else:
+        raise ValueError("unknown plot style '{}'".format(style))
+    if contourlines:
+        plt.contour(xi, yi, zi, levels=lines, colors='black')  # add contour lines
+    if axhline:
+        plt.axhline(0, color='black')
+    plt.colorbar(cs)  # draw colorbar
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    plt.title(title)
+    if equal:
+        plt.axis('equal')
+    return cs
+
+
+def SaveForcFigure(filename, result):
+    """ save raw moments, FORC distribution in Ha, Hb and in Hc, Hu as one figure (no pyplot, Agg canvas)
+
+    result: dictionary with Hb, Ha, M, forc, Hc, Hu, forc_hchu as returned by forc_batch.ProcessFORCFile
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(15, 4.5))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(1, 3)
+    panels = ((result['Hb'], result['Ha'], result['M'], 'Hb', 'Ha', 'FORC raw data (magnetic moments)'),
+              (result['Hb'], result['Ha'], result['forc'], 'Hb', 'Ha', 'FORC processed'),
+              (result['Hc'], result['Hu'], result['forc_hchu'], 'Hc', 'Hu', 'FORC processed (Hu,Hc)'))
+    for ax, (x, y, z, xlabel, ylabel, title) in zip(axes, panels):
+        im = ax.imshow(z, origin='lower', extent=(x[0], x[-1], y[0], y[-1]), aspect='auto', cmap='jet',
+                       interpolation='nearest')
+        fig.colorbar(im, ax=ax)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.set_title(title)
+    fig.tight_layout()
+    fig.savefig(filename)
@@ -0,0 +1,260 @@
+__author__ = 'wack'
+
+# Raster rendering of FORC diagrams
+# grids are mapped to colours with a fixed colormap lookup table and written as PNG directly from numpy
+# (no matplotlib needed), or as annotated figures with imshow on the Agg canvas (no pyplot, no GUI backend).
+# Contour lines are only computed when asked for. Downsampled previews and batch export of many result
+# files (.forcr or .npz of forc_batch, .npz of forc_live) on a process pool.
+#
+# usage: python forc_render.py results/*.forcr -o png --preview 256
+#        python forc_render.py results -o png --figure --contours 10 --key forc
+
+import argparse
+import os
+import struct
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+from forc_store import OpenResult, RESULT_EXTENSIONS
+
+LUT_SIZE = 256
+
+# piecewise linear colormaps (position, value) per channel, same definition as matplotlib
+SEGMENTS = {
+    'jet': {'red': ((0.0, 0), (0.35, 0), (0.66, 1), (0.89, 1), (1.0, 0.5)),
+            'green': ((0.0, 0), (0.125, 0), (0.375, 1), (0.64, 1), (0.91, 0), (1.0, 0)),
+            'blue': ((0.0, 0.5), (0.11, 1), (0.34, 1), (0.65, 0), (1.0, 0))},
+    'gray': {'red': ((0.0, 0), (1.0, 1)), 'green': ((0.0, 0), (1.0, 1)), 'blue': ((0.0, 0), (1.0, 1))},
+}
+
+# grids of result files and their axes (columns, rows)
+AXES = {'M': ('Hb', 'Ha'), 'forc': ('Hb', 'Ha'), 'forc_hchu': ('Hc', 'Hu')}
+TITLES = {'M': 'FORC raw data (magnetic moments)', 'forc': 'FORC processed', 'forc_hchu': 'FORC processed (Hu,Hc)'}
+
+
+@lru_cache(maxsize=None)
+def ColormapLUT(name='jet', size=LUT_SIZE):
+    """ lookup table (size, 4) uint8 RGBA of a colormap, built in ones without matplotlib """
+    if name in SEGMENTS:
+        x = np.linspace(0, 1, size)
+        channels = [np.interp(x, *zip(*SEGMENTS[name][c])) for c in ('red', 'green', 'blue')]
+        lut = np.column_stack(channels + [np.ones(size)])
+    else:
+        import matplotlib
+        lut = matplotlib.colormaps[name].resampled(size)(np.arange(size))
+    lut = np.rint(lut * 255).astype(np.uint8)
+    lut.setflags(write=False)  # cached, must not be changed by callers
+    return lut
+
+
+def ColorLimits(z, vmin=None, vmax=None, symmetric=False):
+    """ colour range of grid z, symmetric around 0 if symmetric is True """
+    finite = z[np.isfinite(z)]
+    if symmetric and vmin is None and vmax is None:
+        vmax = np.absolute(finite).max() if finite.size else 1.0
+        return -vmax, vmax
+    if vmin is None:
+        vmin = finite.min() if finite.size else 0.0
+    if vmax is None:
+        vmax = finite.max() if finite.size else 1.0
+    return vmin, vmax
+
+
+def RenderIndex(z, ncolors=LUT_SIZE, vmin=None, vmax=None, symmetric=False):
+    """ colour index (0 ... ncolors - 1, nan: ncolors) of grid z, first row at the bottom as with origin='lower' """
+    z = np.asarray(z, dtype=float)
+    vmin, vmax = ColorLimits(z, vmin, vmax, symmetric)
+    scale = ncolors / (vmax - vmin) if vmax > vmin else 0.0
+    # same binning as matplotlib colormaps: [vmin, vmax] in ncolors equal bins
+    valid = np.isfinite(z)
+    index = np.clip(((np.where(valid, z, vmin) - vmin) * scale).astype(np.int64), 0, ncolors - 1)
+    index[~valid] = ncolors
+    return index[::-1]
+
+
+def RenderRGBA(z, cmap='jet', vmin=None, vmax=None, symmetric=False, nan_color=(255, 255, 255, 0)):
+    """ RGBA image (rows, columns, 4) uint8 of grid z (first row at the bottom as with origin='lower') """
+    lut = ColormapLUT(cmap)
+    return np.vstack((lut, [nan_color])).astype(np.uint8)[RenderIndex(z, len(lut), vmin, vmax, symmetric)]
+
+
+def Downsample(z, factor):
+    """ block mean of grid z over factor x factor blocks, nan values are ignored (all nan blocks stay nan) """
+    if factor <= 1:
+        return np.asarray(z, dtype=float)
+    z = np.asarray(z, dtype=float)
+    rows, cols = -(-z.shape[0] // factor) * factor, -(-z.shape[1] // factor) * factor
+    padded = np.full((rows, cols), np.nan)
+    padded[:z.shape[0], :z.shape[1]] = z
+    blocks = padded.reshape(rows // factor, factor, cols // factor, factor)
+    valid = np.isfinite(blocks)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    return np.divide(total, count, out=np.full(count.shape, np.nan), where=count > 0)
+
+
+def Preview(z, maxsize=256):
+    """ downsampled grid with at most maxsize rows and columns """
+    return Downsample(z, int(np.ceil(max(np.shape(z)) / maxsize)))
+
+
+def PNGChunk(kind, data):
+    """ PNG chunk: length, type, data and CRC """
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def WritePNG(filename, image, palette=None, level=1):
+    """ write image as PNG: RGBA (rows, columns, 4) uint8 or colour indices (rows, columns) with palette (n <= 256, 4)
+
+    filename: path or binary file object
+    zlib compression level 0 ... 9, low levels are much faster for noisy FORC diagrams
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    channels = 1 if palette is not None else 4
+    rows = np.zeros((height, width * channels + 1), dtype=np.uint8)  # filter type 0 byte before each row
+    rows[:, 1:] = image.reshape(height, width * channels)
+    colortype = 3 if palette is not None else 6  # indexed colours or RGBA
+    chunks = [b'\x89PNG\r\n\x1a\n', PNGChunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, colortype, 0, 0, 0))]
+    if palette is not None:
+        palette = np.asarray(palette, dtype=np.uint8)
+        chunks += [PNGChunk(b'PLTE', palette[:, :3].tobytes()), PNGChunk(b'tRNS', palette[:, 3].tobytes())]
+    chunks += [PNGChunk(b'IDAT', zlib.compress(rows.tobytes(), level)), PNGChunk(b'IEND', b'')]
+    if hasattr(filename, 'write'):
+        filename.write(b''.join(chunks))
+        return
+    with open(filename, 'wb') as f:
+        f.write(b''.join(chunks))
+
+
+def RenderRaster(filename, z, scale=1, preview=None, cmap='jet', nan_color=(255, 255, 255, 0), **kwargs):
+    """ write grid z as indexed colour PNG (filename: path or binary file object) with one pixel per grid point
+    (scale x scale pixels)
+
+    the colormap has LUT_SIZE - 1 colours, the last palette entry is nan_color. kwargs see RenderIndex
+    preview: downsample to at most preview pixels per side first
+    """
+    if preview:
+        z = Preview(z, preview)
+    lut = ColormapLUT(cmap, LUT_SIZE - 1)
+    index = RenderIndex(z, len(lut), **kwargs)
+    if scale > 1:
+        index = index.repeat(scale, axis=0).repeat(scale, axis=1)
+    WritePNG(filename, index, palette=np.vstack((lut, [nan_color])))
+
+
+def RegularAxis(axis):
+    """ True if axis values are evenly spaced """
+    d = np.diff(axis)
+    return len(d) == 0 or np.allclose(d, d[0], rtol=1e-6, atol=0)
+
+
+def RenderFigure(filename, x, y, z, title='', xlabel='Hb', ylabel='Ha', cmap='jet', vmin=None, vmax=None,
+                 symmetric=False, contours=None, preview=None, figsize=(6, 4.5), dpi=100):
+    """ annotated figure of grid z (rows y, columns x) with colorbar, drawn on the Agg canvas
+
+    imshow for regular axes, pcolormesh otherwise. contours: number of contour line levels (None: no contours)
+    preview: downsample to at most preview points per side first
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    z = np.asarray(z, dtype=float)
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if preview:
+        factor = int(np.ceil(max(z.shape) / preview))
+        z = Downsample(z, factor)
+        x, y = Downsample(x[np.newaxis], factor)[0], Downsample(y[np.newaxis], factor)[0]  # block centres
+    vmin, vmax = ColorLimits(z, vmin, vmax, symmetric)
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if RegularAxis(x) and RegularAxis(y):
+        dx = (x[-1] - x[0]) / max(len(x) - 1, 1) / 2
+        dy = (y[-1] - y[0]) / max(len(y) - 1, 1) / 2
+        im = ax.imshow(z, origin='lower', extent=(x[0] - dx, x[-1] + dx, y[0] - dy, y[-1] + dy), aspect='auto',
+                       cmap=cmap, vmin=vmin, vmax=vmax, interpolation='nearest')
+    else:
+        im = ax.pcolormesh(x, y, np.ma.masked_invalid(z), cmap=cmap, vmin=vmin, vmax=vmax, shading='nearest')
+    if contours:
+        ax.contour(x, y, z, levels=contours, colors='black', linewidths=0.5)
+    fig.colorbar(im, ax=ax)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    fig.savefig(filename)
+
+
+def RenderResult(filename, outdir, key='forc_hchu', figure=False, **kwargs):
+    """ render grid key of a result file (.npz or .forcr) to outdir/<name>.<key>.png, returns the PNG file name
+    """
+    with OpenResult(filename) as result:  # only the rendered grid and its axes are read
+        z = np.asarray(result[key])
+        x, y = (np.asarray(result[a]) for a in AXES[key])
+    png = os.path.join(outdir, '{}.{}.png'.format(os.path.splitext(os.path.basename(filename))[0], key))
+    if figure:
+        xlabel, ylabel = AXES[key]
+        RenderFigure(png, x, y, z, title=TITLES[key], xlabel=xlabel, ylabel=ylabel, **kwargs)
+    else:
+        RenderRaster(png, z, **kwargs)
+    return png
+
+
+def RenderTask(filename, outdir, key, figure, kwargs):
+    """ RenderResult with positional arguments for pool.map """
+    return RenderResult(filename, outdir, key=key, figure=figure, **kwargs)
+
+
+def ExportBatch(files, outdir, key='forc_hchu', figure=False, jobs=None, **kwargs):
+    """ render many result files on a pool of jobs processes (1: no pool), returns list of PNG file names
+
+    kwargs are passed to RenderFigure (figure=True) or RenderRaster
+    """
+    os.makedirs(outdir, exist_ok=True)
+    if jobs == 1:
+        return [RenderResult(f, outdir, key=key, figure=figure, **kwargs) for f in files]
+    n = len(files)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # large chunks: rendering one diagram is short compared to the task overhead
+        chunksize = max(1, n // (4 * (jobs or os.cpu_count() or 1)))
+        return list(pool.map(RenderTask, files, [outdir] * n, [key] * n, [figure] * n, [kwargs] * n,
+                             chunksize=chunksize))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='render FORC result files (.npz, .forcr) to PNG')
+    parser.add_argument('paths', nargs='+', help='result files or directories')
+    parser.add_argument('-o', '--outdir', default='forc_png', help='output directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--key', choices=sorted(AXES), default='forc_hchu', help='grid to render')
+    parser.add_argument('--figure', action='store_true', help='annotated figure with axes and colorbar')
+    parser.add_argument('--contours', type=int, default=None, help='number of contour line levels (figures)')
+    parser.add_argument('--preview', type=int, default=None, help='downsample to at most this many pixels per side')
+    parser.add_argument('--scale', type=int, default=1, help='pixels per grid point (raster output)')
+    parser.add_argument('--cmap', default='jet', help='colormap')
+    parser.add_argument('--symmetric', action='store_true', help='colour range symmetric around zero')
+    args = parser.parse_args(argv)
+
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(RESULT_EXTENSIONS)))
+        else:
+            files.append(path)
+    kwargs = {'cmap': args.cmap, 'symmetric': args.symmetric, 'preview': args.preview}
+    if args.figure:
+        kwargs['contours'] = args.contours
+    else:
+        kwargs['scale'] = args.scale
+    written = ExportBatch(files, args.outdir, key=args.key, figure=args.figure, jobs=args.jobs, **kwargs)
+    print('wrote {} images to {}'.format(len(written), args.outdir))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
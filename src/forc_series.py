@@ -0,0 +1,185 @@
+__author__ = 'wack'
+
+# Series of FORC measurements (temperature or heating series, several specimens)
+# all specimens are gridded onto shared Ha, Hb axes, then the stack of grids (specimen, Ha, Hb) goes through
+# convolution and Hc, Hu rotation as one 3d array. Difference maps against a reference specimen and summary
+# statistics are computed for the whole stack at once.
+#
+# usage: python forc_series.py FeNi100.forc FeNi0_heated.forc -o series.forcr --reference 0
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from forc_convolution import FastImportFORCData, DriftCorrection, PrepareForcData, GridForcData, ConvolveForcGrid, \
+    VariableConvolveForcGrid, GridHcHu
+from forc_store import EXTENSION, Provenance, SaveResult
+
+
+def LoadSpecimen(filename, dialect='auto', drift=False, polyorder=6, drift_model='poly', mirror=True, dtype=None):
+    """ prepared forc data of one file (see PrepareForcData), number of FORCs, FORC length and saturation moment
+
+    the saturation moment is the maximum |M| of the measured (not mirrored) points
+    """
+    dd, fd = FastImportFORCData(filename, dialect=dialect, dtype=dtype)
+    if drift:
+        fd = DriftCorrection(fd, dd, polyorder=polyorder, model=drift_model)
+    Ms = float(np.absolute(np.asarray(fd['Moment'], dtype=float)).max())
+    return PrepareForcData(fd, mirror=mirror) + (Ms,)
+
+
+def SharedAxes(specimens, maxlen=2000):
+    """ Hb and Ha axes covering all specimens (list of prepared forc data, Halen, Hblen, ...)
+
+    the range is the union of all specimens, the step is the finest step of their own grids
+    (range / (length - 1) as in GridForcData), at most maxlen values per axis
+    """
+    axes = []
+    for column, lengths in (('Hb', [s[2] for s in specimens]), ('Ha', [s[1] for s in specimens])):
+        ranges = [(np.min(s[0][column]), np.max(s[0][column])) for s in specimens]
+        low, high = min(r[0] for r in ranges), max(r[1] for r in ranges)
+        steps = [(b - a) / (n - 1) for (a, b), n in zip(ranges, lengths) if n > 1 and b > a]
+        count = int(np.rint((high - low) / min(steps))) + 1 if steps else 2
+        axes.append(np.linspace(low, high, int(np.clip(count, 2, maxlen))))
+    return axes[0], axes[1]
+
+
+def SeriesStatistics(hc, hu, stack, reference=0):
+    """ summary statistics of a stack of Hc, Hu FORC distributions (specimen, Hu, Hc), one value per specimen
+
+    total: integral over the Hc, Hu plane, peak: maximum and its Hc, Hu position, positive: fraction of the
+    absolute integral from positive values, rms_difference and correlation: against the reference specimen
+    on pixels valid in both
+    """
+    n = len(stack)
+    flat = stack.reshape(n, -1)
+    valid = np.isfinite(flat)
+    z = np.where(valid, flat, 0)
+    cell = abs(hc[1] - hc[0]) * abs(hu[1] - hu[0]) if len(hc) > 1 and len(hu) > 1 else 1.0
+
+    peak = np.where(valid, flat, -np.inf).argmax(axis=1)
+    has_data = valid.any(axis=1)
+    row, col = np.unravel_index(peak, stack.shape[1:])
+    absolute = np.absolute(z).sum(axis=1)
+
+    # against the reference on pixels valid in both
+    both = valid & valid[reference]
+    count = both.sum(axis=1)
+    a, b = np.where(both, z, 0), np.where(both, z[reference], 0)
+    mean_a = a.sum(axis=1) / np.maximum(count, 1)
+    mean_b = b.sum(axis=1) / np.maximum(count, 1)
+    da, db = np.where(both, a - mean_a[:, None], 0), np.where(both, b - mean_b[:, None], 0)
+    norm = np.sqrt((da ** 2).sum(axis=1) * (db ** 2).sum(axis=1))
+
+    nan = np.full(n, np.nan)
+    return {'total': z.sum(axis=1) * cell,
+            'peak': np.where(has_data, z[np.arange(n), peak], nan),
+            'peak_hc': np.where(has_data, hc[col], nan),
+            'peak_hu': np.where(has_data, hu[row], nan),
+            'positive': np.divide(np.where(z > 0, z, 0).sum(axis=1), absolute, out=nan.copy(), where=absolute > 0),
+            'rms_difference': np.sqrt(np.divide(((a - b) ** 2).sum(axis=1), count, out=nan.copy(), where=count > 0)),
+            'correlation': np.divide((da * db).sum(axis=1), norm, out=nan.copy(), where=norm > 0),
+            'valid_fraction': valid.mean(axis=1)}
+
+
+def ProcessSeries(files, reference=0, normalize=True, dialect='auto', drift=False, polyorder=6, drift_model='poly',
+                  mirror=True, grid='linear', SF=None, nan_aware=False, SFmax=None, smoothing_lambda=0.05,
+                  dtype=None, maxlen=2000, jobs=1):
+    """ process a series of FORC files on shared axes as one stack
+
+    reference: index of the specimen the difference maps and comparison statistics refer to
+    normalize: divide each specimen by its saturation moment (maximum |M|) so that specimens of different
+               mass can be compared
+    jobs: number of worker processes for import and preparation (1: no pool, None: all cores)
+    further options as forc_pipeline.ForcConvolutionPipeline
+    returns dictionary with files, names, axes Hb, Ha, Hc, Hu, stacks M, forc, forc_hchu, difference (forc_hchu minus
+    the reference), Ms, normalized, series mean and std maps and per specimen statistics (see SeriesStatistics)
+    """
+    files = list(files)
+    options = {'dialect': dialect, 'drift': drift, 'polyorder': polyorder, 'drift_model': drift_model,
+               'mirror': mirror, 'dtype': dtype}
+    if jobs == 1:
+        specimens = [LoadSpecimen(f, **options) for f in files]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            specimens = list(pool.map(LoadSpecimen, files, *[[value] * len(files) for value in options.values()]))
+
+    xi, yi = SharedAxes(specimens, maxlen=maxlen)
+    M = np.stack([GridForcData(s[0], len(yi), len(xi), method=grid, axes=(xi, yi))[2] for s in specimens])
+    Ms = np.array([s[3] for s in specimens])
+    if normalize:
+        M = M / Ms[:, np.newaxis, np.newaxis]
+
+    # one stacked computation for all specimens
+    if SFmax is not None:
+        forc = VariableConvolveForcGrid(xi, yi, M, sf0=SF or 2, sfmax=SFmax, lambda_u=smoothing_lambda,
+                                        lambda_c=smoothing_lambda, nan_aware=nan_aware)
+    else:
+        forc = ConvolveForcGrid(M, SF=SF, nan_aware=nan_aware)
+    hc, hu, forc_hchu = GridHcHu(xi, yi, forc, len(yi), len(xi))
+
+    # series mean and standard deviation of each pixel over the specimens with data there
+    valid = np.isfinite(forc_hchu)
+    count = valid.sum(axis=0)
+    mean = np.divide(np.where(valid, forc_hchu, 0).sum(axis=0), count, out=np.full(count.shape, np.nan),
+                     where=count > 0)
+    variance = np.divide(np.where(valid, (forc_hchu - mean) ** 2, 0).sum(axis=0), count,
+                         out=np.full(count.shape, np.nan), where=count > 0)
+    return {'files': files, 'names': [os.path.splitext(os.path.basename(f))[0] for f in files],
+            'Hb': xi, 'Ha': yi, 'M': M, 'forc': forc,
+            'Hc': hc, 'Hu': hu, 'forc_hchu': forc_hchu,
+            'Ms': Ms, 'normalized': normalize,
+            'reference': reference, 'difference': forc_hchu - forc_hchu[reference],
+            'mean': mean, 'std': np.sqrt(variance),
+            'statistics': SeriesStatistics(hc, hu, forc_hchu, reference=reference)}
+
+
+def SaveSeries(filename, series, params=None):
+    """ save the result of ProcessSeries as .forcr (forc_store, with parameters params and the provenance of
+    the specimen files) or npz (other extensions), statistics as arrays stat_<name>
+    """
+    arrays = {key: value for key, value in series.items() if key not in ('statistics', 'files')}
+    arrays.update({'stat_' + key: value for key, value in series['statistics'].items()})
+    if filename.endswith(EXTENSION):
+        SaveResult(filename, arrays, params=params,
+                   provenance=Provenance(specimens=[Provenance(f) for f in series['files']]))
+    else:
+        np.savez_compressed(filename, **arrays)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='process a series of FORC files on shared axes')
+    parser.add_argument('files', nargs='+', help='FORC files of the series')
+    parser.add_argument('-o', '--output', default='series.forcr',
+                        help='result file with stacks and statistics (.forcr or .npz)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='worker processes for import (default: 1)')
+    parser.add_argument('--reference', type=int, default=0, help='index of the reference specimen')
+    parser.add_argument('--no-normalize', dest='normalize', action='store_false',
+                        help='do not divide by the saturation moment of each specimen')
+    parser.add_argument('--dialect', default='auto', help='file dialect (default: detect)')
+    parser.add_argument('--drift', action='store_true', help='do drift correction')
+    parser.add_argument('--no-mirror', dest='mirror', action='store_false', help='do not mirror FORCs')
+    parser.add_argument('--grid', choices=('linear', 'structured'), default='linear', help='gridding method')
+    parser.add_argument('--sf', type=int, default=None, help='smoothing factor (default: fixed 5x5 kernel)')
+    parser.add_argument('--nan-aware', action='store_true', help='keep masked grid regions from spreading')
+    args = parser.parse_args(argv)
+
+    params = {'reference': args.reference, 'normalize': args.normalize, 'dialect': args.dialect, 'drift': args.drift,
+              'mirror': args.mirror, 'grid': args.grid, 'SF': args.sf, 'nan_aware': args.nan_aware}
+    series = ProcessSeries(args.files, jobs=args.jobs, **params)
+    SaveSeries(args.output, series, params=params)
+    stats = series['statistics']
+    print('{:<30} {:>10} {:>10} {:>10} {:>10} {:>8}'.format('specimen', 'total', 'peak Hc', 'peak Hu', 'rms diff',
+                                                            'corr'))
+    for i, name in enumerate(series['names']):
+        print('{:<30} {:10.4g} {:10.4g} {:10.4g} {:10.4g} {:8.3f}'.format(
+            name, stats['total'][i], stats['peak_hc'][i], stats['peak_hu'][i], stats['rms_difference'][i],
+            stats['correlation'][i]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,338 @@
+__author__ = 'wack'
+
+# FORC processing service
+# long running asyncio HTTP server (TCP on localhost or a unix socket) that keeps the modules, worker processes
+# and their caches loaded. Files are uploaded as request body or given as path below --root, the processing
+# (import, drift correction, prepare, grid, convolve, rotate) runs on a bounded process pool. Identical requests
+# (same file content and options) share one computation and recent results are kept in memory, requests
+# beyond --max-pending running computations are rejected with 503 (backpressure). Computations running longer
+# than --timeout are stopped (504), a worker dying (e.g. out of memory) or a timeout replaces the whole pool.
+#
+# GET  /health                                  service status as JSON
+# POST /process?format=png&SF=3                 body: content of a FORC file
+# GET  /process?path=run1/FeNi.forc&format=npz  file below --root
+#   format: npz (arrays Hb, Ha, M, forc, Hc, Hu, forc_hchu), png (key, preview, scale, cmap, symmetric as in
+#   forc_render) or json (parameters of forc_analysis), processing options as forc_batch (dialect, drift,
+#   polyorder, drift_model, mirror, grid, SF, nan_aware, SFmax, smoothing_lambda, dtype)
+#
+# usage: python forc_service.py --port 8765 -j 4 --root /data/forc
+#        curl --data-binary @FeNi100.forc "http://127.0.0.1:8765/process?format=png" -o FeNi100.png
+
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import urllib.parse
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+
+import numpy as np
+
+from forc_batch import ProcessFORCFile, WarmUp, WorkerPool
+from forc_cache import FileHash
+from forc_grid import LRUDict
+
+log = logging.getLogger(__name__)
+
+
+def Flag(text):
+    """ boolean query parameter """
+    if text.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if text.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError("'{}' is not a boolean".format(text))
+
+
+# processing options (forc_pipeline.ForcConvolutionPipeline) and their query parameter types
+OPTIONS = {'dialect': str, 'drift': Flag, 'polyorder': int, 'drift_model': str, 'mirror': Flag, 'grid': str,
+           'SF': int, 'nan_aware': Flag, 'SFmax': int, 'smoothing_lambda': float, 'dtype': str}
+RENDER_OPTIONS = {'key': str, 'preview': int, 'scale': int, 'cmap': str, 'symmetric': Flag}
+FORMATS = {'npz': 'application/octet-stream', 'png': 'image/png', 'json': 'application/json'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def ProcessRequest(source, data, options):
+    """ process file source or, if data is given, the uploaded content data (in a pool worker) """
+    if data is None:
+        return ProcessFORCFile(source, **options)
+    f, tmp = tempfile.mkstemp(suffix='.forc')
+    try:
+        with os.fdopen(f, 'wb') as upload:
+            upload.write(data)
+        return ProcessFORCFile(tmp, **options)
+    finally:
+        os.remove(tmp)
+
+
+def Encode(result, fmt, query):
+    """ response body of a result dictionary in format fmt (npz, png or json) """
+    buffer = io.BytesIO()
+    if fmt == 'npz':
+        np.savez(buffer, **result)
+    elif fmt == 'png':
+        from forc_render import AXES, RenderRaster
+        render = ParseOptions(query, RENDER_OPTIONS)
+        key = render.pop('key', 'forc_hchu')
+        if key not in AXES:
+            raise HTTPError(400, "unknown key '{}', use one of {}".format(key, sorted(AXES)))
+        RenderRaster(buffer, result[key], **render)
+    else:
+        from forc_analysis import AnalyseForc
+        from forc_filter import MixedDerivativeKernel
+        SF = ParseOptions(query, OPTIONS).get('SF')
+        parameters = AnalyseForc(result['Hc'], result['Hu'], result['forc_hchu'], hb=result['Hb'], ha=result['Ha'],
+                                 forc=result['forc'], k=None if SF is None else MixedDerivativeKernel(SF))
+        values = {key: float(value) if np.isfinite(value) else None for key, value in parameters.items()}
+        buffer.write(json.dumps(values).encode())
+    return buffer.getvalue()
+
+
+def ParseOptions(query, types):
+    """ typed options of the query parameters named in types """
+    options = {}
+    for name, kind in types.items():
+        if name in query:
+            try:
+                options[name] = kind(query[name])
+            except ValueError as e:
+                raise HTTPError(400, 'bad value for {}: {}'.format(name, e))
+    return options
+
+
+class ForcService:
+    """ request handling, deduplication and result cache of the service
+
+    jobs: worker processes (default: all cores), max_pending: computations running or queued on the pool before
+    new ones are rejected, max_upload: bytes per request body, root: directory path requests may read from
+    (None: uploads only), cache_size: number of results kept in memory, timeout: maximum seconds of a
+    computation (None: no limit)
+    """
+
+    def __init__(self, jobs=None, max_pending=16, max_upload=64 << 20, root=None, cache_size=32, timeout=300):
+        self.jobs = jobs or os.cpu_count()
+        self.pool = self.NewPool()
+        self.generation = 0  # number of pool replacements
+        self.last_restart = None
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_upload = max_upload
+        self.root = None if root is None else os.path.realpath(root)
+        self.inflight = {}  # key -> future of the running computation
+        self.results = LRUDict(maxsize=cache_size)
+        self.counts = {'requests': 0, 'computed': 0, 'shared': 0, 'cached': 0, 'rejected': 0, 'failed': 0,
+                       'timeouts': 0, 'worker_deaths': 0}
+
+    def NewPool(self):
+        return WorkerPool(max_workers=self.jobs, initializer=WarmUp)
+
+    def RestartPool(self, reason):
+        """ replace the pool by a new one, its workers are killed (running computations fail and are retried) """
+        log.warning('replacing worker pool: %s', reason)
+        self.pool.Kill()
+        self.pool = self.NewPool()
+        self.generation += 1
+        self.last_restart = reason
+
+    def Status(self):
+        return dict(self.counts, pending=len(self.inflight), max_pending=self.max_pending, jobs=self.jobs,
+                    cached_results=len(self.results), timeout=self.timeout, pool_restarts=self.generation,
+                    last_restart=self.last_restart)
+
+    def ResolvePath(self, path):
+        """ real path of a path request, only files below root """
+        if self.root is None:
+            raise HTTPError(403, 'path requests are disabled (start the service with --root)')
+        full = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([full, self.root]) != self.root:
+            raise HTTPError(403, 'path outside of the service root')
+        if not os.path.isfile(full):
+            raise HTTPError(404, 'no such file: {}'.format(path))
+        return full
+
+    async def Result(self, source, data, options):
+        """ result arrays of a request and how they were obtained (computed, shared or cached) """
+        loop = asyncio.get_running_loop()
+        digest = hashlib.sha1(data).hexdigest() if data is not None else \
+            await loop.run_in_executor(None, FileHash, source)
+        key = (digest, json.dumps(options, sort_keys=True))
+        if key in self.results:
+            return self.results.Get(key, None), 'cached'
+        if key in self.inflight:  # identical request is being processed: wait for its result
+            return await self.Wait(self.inflight[key]), 'shared'
+        if len(self.inflight) >= self.max_pending:
+            self.counts['rejected'] += 1
+            raise HTTPError(503, 'busy: {} computations pending'.format(len(self.inflight)))
+
+        self.inflight[key] = asyncio.ensure_future(self.Compute(source, data, options))
+        try:
+            result = await self.Wait(self.inflight[key])
+        except HTTPError:
+            self.counts['failed'] += 1
+            raise
+        finally:
+            del self.inflight[key]
+        self.results.Get(key, lambda: result)
+        return result, 'computed'
+
+    def Submit(self, func, *args):
+        """ run func(*args) on the pool, a pool broken by a worker that died while idle is replaced first """
+        loop = asyncio.get_running_loop()
+        try:
+            return loop.run_in_executor(self.pool, func, *args)
+        except BrokenProcessPool:
+            self.counts['worker_deaths'] += 1
+            self.RestartPool('worker died')
+            return loop.run_in_executor(self.pool, func, *args)
+
+    async def Compute(self, source, data, options, attempts=2):
+        """ ProcessRequest on the pool within the time limit
+
+        a broken pool (worker died, or killed for the timeout of another computation) is replaced and the
+        computation is submitted again, up to attempts times
+        """
+        for attempt in range(attempts):
+            generation = self.generation
+            future = self.Submit(ProcessRequest, source, data, options)
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())  # abandoned after a timeout
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                self.counts['timeouts'] += 1
+                if generation == self.generation:
+                    self.RestartPool('timeout after {}s'.format(self.timeout))
+                raise HTTPError(504, 'processing took longer than {}s'.format(self.timeout))
+            except BrokenProcessPool:
+                if generation == self.generation:
+                    self.counts['worker_deaths'] += 1
+                    self.RestartPool('worker died')
+        raise HTTPError(500, 'worker process died processing this file (e.g. out of memory)')
+
+    async def Wait(self, task):
+        """ result of a computation, not cancelled if one of the clients waiting for it goes away """
+        try:
+            return await asyncio.shield(task)
+        except HTTPError:
+            raise
+        except Exception as e:
+            raise HTTPError(422, '{}: {}'.format(type(e).__name__, e))
+
+    async def Process(self, method, query, body):
+        fmt = query.get('format', 'npz')
+        if fmt not in FORMATS:
+            raise HTTPError(400, "unknown format '{}', use one of {}".format(fmt, sorted(FORMATS)))
+        options = ParseOptions(query, OPTIONS)
+        if 'path' in query:
+            source, data = self.ResolvePath(query['path']), None
+        elif method == 'POST' and body:
+            source, data = None, body
+        else:
+            raise HTTPError(400, 'send the file content as POST body or give a path')
+        result, how = await self.Result(source, data, options)
+        self.counts[how] += 1
+        content = await asyncio.get_running_loop().run_in_executor(None, Encode, result, fmt, query)
+        return 200, FORMATS[fmt], content, {'X-Forc-Result': how}
+
+    async def Handle(self, reader, writer):
+        """ one HTTP request per connection """
+        headers = {}
+        try:
+            try:
+                method, url, body = await self.ReadRequest(reader)
+                self.counts['requests'] += 1
+                target = urllib.parse.urlsplit(url)
+                query = dict(urllib.parse.parse_qsl(target.query))
+                if target.path == '/health':
+                    status, kind, content = 200, FORMATS['json'], json.dumps(self.Status()).encode()
+                elif target.path == '/process' and method in ('GET', 'POST'):
+                    status, kind, content, headers = await self.Process(method, query, body)
+                else:
+                    raise HTTPError(404, 'unknown resource {} {}'.format(method, target.path))
+            except HTTPError as e:
+                status, kind, content = e.status, FORMATS['json'], json.dumps({'error': str(e)}).encode()
+                if e.status == 503:
+                    headers = {'Retry-After': '1'}
+            except Exception as e:
+                log.exception('request failed')
+                status, kind, content = 500, FORMATS['json'], json.dumps({'error': str(e)}).encode()
+            head = ['HTTP/1.1 {} {}'.format(status, HTTPStatus(status).phrase), 'Content-Type: ' + kind,
+                    'Content-Length: {}'.format(len(content)), 'Connection: close']
+            head += ['{}: {}'.format(name, value) for name, value in headers.items()]
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + content)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # client went away
+        finally:
+            writer.close()
+
+    async def ReadRequest(self, reader):
+        """ method, target and body of an HTTP request """
+        line = await reader.readline()
+        try:
+            method, url, version = line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(400, 'malformed request line')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > self.max_upload:
+            raise HTTPError(413, 'request body larger than {} bytes'.format(self.max_upload))
+        body = await reader.readexactly(length) if length else b''
+        return method, url, body
+
+    async def Serve(self, host='127.0.0.1', port=8765, unix=None):
+        """ serve on host:port or on the unix socket unix until cancelled """
+        if unix:
+            server = await asyncio.start_unix_server(self.Handle, path=unix)
+        else:
+            server = await asyncio.start_server(self.Handle, host=host, port=port)
+        log.info('serving on %s with %d workers', unix or '{}:{}'.format(host, port), self.jobs)
+        async with server:
+            await server.serve_forever()
+
+    def Close(self):
+        self.pool.Kill()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='FORC processing service (HTTP on localhost or a unix socket)')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: localhost only)')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port')
+    parser.add_argument('--unix', default=None, help='listen on this unix socket instead of TCP')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--max-pending', type=int, default=16, help='computations before requests are rejected')
+    parser.add_argument('--max-upload', type=int, default=64, help='maximum request body in MB')
+    parser.add_argument('--root', default=None, help='directory path requests may read files from')
+    parser.add_argument('--cache-size', type=int, default=32, help='number of results kept in memory')
+    parser.add_argument('--timeout', type=float, default=300, help='maximum seconds per computation (0: no limit)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    service = ForcService(jobs=args.jobs, max_pending=args.max_pending, max_upload=args.max_upload << 20,
+                          root=args.root, cache_size=args.cache_size, timeout=args.timeout or None)
+    try:
+        asyncio.run(service.Serve(host=args.host, port=args.port, unix=args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.Close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
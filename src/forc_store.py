@@ -0,0 +1,292 @@
+__author__ = 'wack'
+
+# Persistent FORC results (.forcr files)
+# one file holds the result arrays of a processing run (raw grid M, FORC distribution forc, Hc, Hu diagram
+# forc_hchu, their axes, series stacks ...), the processing parameters and the provenance (source file and its
+# hash, time, versions). Grids are stored in compressed chunks (zlib), slicing an opened result only reads and
+# decompresses the chunks it touches. Axes and other small arrays are stored uncompressed and memory mapped,
+# text arrays (names) in the header.
+#
+# layout: magic, data blocks (64 byte aligned), JSON header, footer (header offset, header length, magic)
+#
+# usage: python forc_store.py results/*.npz -o results   convert npz results of forc_batch / forc_series
+#        python forc_store.py --info result.forcr
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+from forc_grid import LRUDict
+
+MAGIC = b'FORCRES1'
+FOOTER = struct.Struct('<QQ8s')  # header offset, header length, magic
+ALIGN = 64
+EXTENSION = '.forcr'
+RESULT_EXTENSIONS = ('.npz', EXTENSION)
+CHUNK = 128  # chunk length of the last two (grid) dimensions, leading dimensions (stacks) are chunked by 1
+MIN_COMPRESS = 4096  # arrays smaller than this many bytes are stored uncompressed
+
+
+def DefaultChunks(shape):
+    """ chunk shape of an array: grids in CHUNK x CHUNK tiles, one tile per specimen of a stack """
+    if len(shape) < 2:
+        return tuple(shape)
+    return (1,) * (len(shape) - 2) + tuple(min(n, CHUNK) or 1 for n in shape[-2:])
+
+
+def Provenance(source=None, **extra):
+    """ provenance record: source file and its sha1, creation time, program, versions and host """
+    from forc_cache import FileHash
+    record = {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'program': ' '.join(sys.argv),
+              'python': platform.python_version(), 'numpy': np.__version__, 'host': platform.node()}
+    if source is not None:
+        record.update({'source': os.path.abspath(source), 'sha1': FileHash(source)})
+    record.update(extra)
+    return record
+
+
+def SaveResult(filename, arrays, params=None, provenance=None, compress=True, level=1, chunks=None):
+    """ write arrays (dictionary name -> array), processing parameters and provenance (JSON serializable
+    dictionaries) to filename
+
+    compress: store grids in zlib compressed chunks (False: all arrays uncompressed, fully memory mappable)
+    chunks: dictionary name -> chunk shape for arrays not chunked by DefaultChunks
+    """
+    chunks = chunks or {}
+    header = {'arrays': {}, 'params': params or {}, 'provenance': provenance or {}}
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        for name, value in arrays.items():
+            a = np.asarray(value)
+            if a.dtype.kind in 'USO':  # text, kept in the header
+                header['arrays'][name] = {'values': a.tolist(), 'shape': a.shape}
+                continue
+            f.write(b'\0' * (-f.tell() % ALIGN))
+            entry = {'dtype': a.dtype.str, 'shape': a.shape, 'offset': f.tell()}
+            if compress and a.nbytes >= MIN_COMPRESS:
+                entry['chunks'] = tuple(chunks.get(name, DefaultChunks(a.shape)))
+                entry['level'] = level
+                sizes = []
+                for block in ChunkSlices(a.shape, entry['chunks']):
+                    data = zlib.compress(np.ascontiguousarray(a[block]).tobytes(), level)
+                    f.write(data)
+                    sizes.append(len(data))
+                entry['sizes'] = sizes
+            else:
+                f.write(np.ascontiguousarray(a).tobytes())
+            header['arrays'][name] = entry
+        offset = f.tell()
+        data = json.dumps(header).encode()
+        f.write(data)
+        f.write(FOOTER.pack(offset, len(data), MAGIC))
+    os.replace(tmp, filename)  # readers never see a partly written file
+
+
+def ChunkSlices(shape, chunks):
+    """ slices of all chunks of an array in C order """
+    ranges = [range(0, n, c) for n, c in zip(shape, chunks)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(s, min(s + c, n)) for s, c, n in zip(starts, chunks, shape))
+
+
+class ResultArray:
+    """ array of a result file, slicing reads only the needed chunks, np.asarray(a) reads everything """
+
+    def __init__(self, result, name, entry):
+        self.result = result
+        self.name = name
+        self.dtype = np.dtype(entry['dtype'])
+        self.shape = tuple(entry['shape'])
+        self.offset = entry['offset']
+        self.chunks = tuple(entry['chunks']) if 'chunks' in entry else None
+        if self.chunks is not None:
+            self.starts = np.concatenate([[self.offset], self.offset + np.cumsum(entry['sizes'])])
+            self.grid = tuple(-(-n // c) for n, c in zip(self.shape, self.chunks))  # chunks per dimension
+            self.cache = LRUDict(maxsize=64)  # decompressed chunks
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def compressed(self):
+        return self.chunks is not None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return '<ResultArray {} {} {}{}>'.format(self.name, self.shape, self.dtype,
+                                                 ' chunks {}'.format(self.chunks) if self.compressed else '')
+
+    def __array__(self, dtype=None, copy=None):
+        a = self[...]
+        return a if dtype is None else a.astype(dtype)
+
+    def Memmap(self):
+        """ read only memory map of an uncompressed array """
+        if self.compressed:
+            raise ValueError('{} is stored compressed and cannot be memory mapped'.format(self.name))
+        return np.memmap(self.result.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+    def Chunk(self, index):
+        """ decompressed chunk with chunk grid index (tuple) """
+        def Read():
+            number = np.ravel_multi_index(index, self.grid)
+            data = self.result.Read(self.starts[number], self.starts[number + 1] - self.starts[number])
+            shape = [min(c, n - i * c) for i, c, n in zip(index, self.chunks, self.shape)]
+            return np.frombuffer(zlib.decompress(data), dtype=self.dtype).reshape(shape)
+        return self.cache.Get(index, Read)
+
+    def __getitem__(self, key):
+        if not self.compressed:
+            return np.array(self.Memmap()[key])
+        # bounding box of the selection per dimension, read chunk by chunk, then apply steps and integer indices
+        key = Normalize(key, self.ndim)
+        for k, n in zip(key, self.shape):
+            if not isinstance(k, slice) and not -n <= k < n:
+                raise IndexError('index {} is out of bounds for size {}'.format(k, n))
+        box = [(s.indices(n) if isinstance(s, slice) else (s % n, s % n + 1, 1)) for s, n in zip(key, self.shape)]
+        low = [min(a, a + (len(range(a, b, c)) - 1) * c) if len(range(a, b, c)) else 0 for a, b, c in box]
+        high = [max(a, a + (len(range(a, b, c)) - 1) * c) + 1 if len(range(a, b, c)) else 0 for a, b, c in box]
+        out = np.empty([h - l for l, h in zip(low, high)], dtype=self.dtype)
+        if out.size:
+            first = [l // c for l, c in zip(low, self.chunks)]
+            last = [(h - 1) // c for h, c in zip(high, self.chunks)]
+            for index in itertools.product(*[range(a, b + 1) for a, b in zip(first, last)]):
+                origin = [i * c for i, c in zip(index, self.chunks)]
+                chunk = self.Chunk(index)
+                src = tuple(slice(max(l - o, 0), min(h - o, n)) for l, h, o, n in zip(low, high, origin, chunk.shape))
+                dst = tuple(slice(s.start + o - l, s.stop + o - l) for s, o, l in zip(src, origin, low))
+                out[dst] = chunk[src]
+        local = tuple(slice(a - l, None if b - l < 0 else b - l, c) if isinstance(s, slice) else a - l
+                      for s, (a, b, c), l in zip(key, box, low))
+        return out[local]
+
+
+def Normalize(key, ndim):
+    """ index key as tuple of one slice or integer per dimension """
+    key = key if isinstance(key, tuple) else (key,)
+    if any(k is Ellipsis for k in key):
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+    key = key + (slice(None),) * (ndim - len(key))
+    for k in key:
+        if not isinstance(k, (slice, int, np.integer)):
+            raise IndexError('only integers, slices and ... can index result arrays, not {!r}'.format(k))
+    if len(key) > ndim:
+        raise IndexError('too many indices for array with {} dimensions'.format(ndim))
+    return key
+
+
+class ForcResult:
+    """ opened result file: result[name] is a ResultArray (or array of text), params and provenance dictionaries
+
+    usable like the NpzFile of np.load: files, in, context manager
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        try:
+            self.file.seek(-FOOTER.size, os.SEEK_END)
+            offset, length, magic = FOOTER.unpack(self.file.read(FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError('{} is not a FORC result file'.format(filename))
+            header = json.loads(self.Read(offset, length))
+        except Exception:
+            self.file.close()
+            raise
+        self.params = header['params']
+        self.provenance = header['provenance']
+        self.arrays = {}
+        for name, entry in header['arrays'].items():
+            if 'values' in entry:
+                self.arrays[name] = np.array(entry['values']).reshape(entry['shape'])
+            else:
+                self.arrays[name] = ResultArray(self, name, entry)
+
+    def Read(self, offset, length):
+        self.file.seek(int(offset))
+        return self.file.read(int(length))
+
+    @property
+    def files(self):
+        return list(self.arrays)
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def Load(self, names=None):
+        """ dictionary of (all or the given) arrays read into memory """
+        return {name: np.asarray(self.arrays[name]) for name in (names or self.arrays)}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return '<ForcResult {}: {}>'.format(self.filename, ', '.join(self.arrays))
+
+
+def OpenResult(filename):
+    """ result file of forc_batch or forc_series: ForcResult for .forcr, np.load for .npz """
+    if filename.endswith(EXTENSION):
+        return ForcResult(filename)
+    return np.load(filename)
+
+
+def ConvertResult(filename, outdir=None, **kwargs):
+    """ convert a npz result to .forcr (in outdir, default next to it), returns the new file name """
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    output = os.path.join(outdir or os.path.dirname(filename), stem + EXTENSION)
+    with np.load(filename) as result:
+        arrays = {key: result[key] for key in result.files}
+    SaveResult(output, arrays, provenance=Provenance(converted_from=os.path.abspath(filename)), **kwargs)
+    return output
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='convert FORC results to .forcr files or show their content')
+    parser.add_argument('files', nargs='+', help='npz results to convert (.forcr files with --info)')
+    parser.add_argument('-o', '--outdir', default=None, help='output directory (default: next to the input)')
+    parser.add_argument('--level', type=int, default=1, help='zlib compression level')
+    parser.add_argument('--info', action='store_true', help='print arrays, parameters and provenance')
+    args = parser.parse_args(argv)
+
+    if args.info:
+        for filename in args.files:
+            with ForcResult(filename) as result:
+                print(filename)
+                for name, a in result.arrays.items():
+                    print('  {:<12} {}'.format(name, a if isinstance(a, ResultArray) else a.tolist()))
+                print('  params     ', json.dumps(result.params))
+                print('  provenance ', json.dumps(result.provenance))
+        return 0
+
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+    for filename in args.files:
+        print(ConvertResult(filename, args.outdir, level=args.level))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
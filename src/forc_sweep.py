@@ -0,0 +1,295 @@
+__author__ = 'wack'
+
+# Memoized parameter sweeps
+# every point of a parameter grid is a chain of stages (import -> drift -> prepare -> grid -> convolve -> rotate),
+# a stage only depends on its own parameters and its inputs. Stage results are keyed by the key of their inputs
+# plus their parameters, so points of the sweep share all stages upstream of the first changed parameter and
+# each distinct stage runs once. Results are kept in a memory bounded LRU cache that survives between sweeps,
+# independent stages run on a thread or process pool.
+#
+# usage: python forc_sweep.py ../data/FeNi100-A-a-24-M001_005.forc --drift --sf 2 3 4 5 6 --polyorder 2 4 6 -o sweep
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sys
+import timeit
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from forc_cache import FileHash
+from forc_convolution import FastImportFORCData, DriftCorrection, PrepareForcData, GridForcData, ConvolveForcGrid, \
+    VariableConvolveForcGrid, GridHcHu
+from forc_pipeline import Describe
+
+# parameters of a sweep point, the same defaults as forc_pipeline.ForcConvolutionPipeline
+# resolution: grid lengths relative to the number of FORCs (Ha) and the longest FORC (Hb)
+DEFAULTS = {'dialect': 'auto', 'dtype': None, 'drift': False, 'polyorder': 6, 'drift_model': 'poly', 'mirror': True,
+            'grid': 'linear', 'resolution': 1, 'SF': None, 'nan_aware': False, 'SFmax': None,
+            'smoothing_lambda': 0.05}
+RESULTS = ('Hb', 'Ha', 'M', 'forc', 'Hc', 'Hu', 'forc_hchu')
+
+
+def ImportStage(filename, dialect, dtype):
+    return FastImportFORCData(filename, dialect=dialect, dtype=dtype)
+
+
+def DriftStage(fd, dd, polyorder, drift_model):
+    return DriftCorrection(fd, dd, polyorder=polyorder, model=drift_model)
+
+
+def PrepareStage(fd, mirror):
+    return PrepareForcData(fd, mirror=mirror)
+
+
+def GridStage(fd, Halen, Hblen, grid, resolution):
+    return GridForcData(fd, max(int(round(Halen * resolution)), 2), max(int(round(Hblen * resolution)), 2),
+                        method=grid)
+
+
+def ConvolveStage(Hb, Ha, M, SF, nan_aware, SFmax, smoothing_lambda):
+    if SFmax is not None:
+        return VariableConvolveForcGrid(Hb, Ha, M, sf0=SF or 2, sfmax=SFmax, lambda_u=smoothing_lambda,
+                                        lambda_c=smoothing_lambda, nan_aware=nan_aware)
+    return ConvolveForcGrid(M, SF=SF, nan_aware=nan_aware)
+
+
+def RotateStage(Hb, Ha, forc):
+    return GridHcHu(Hb, Ha, forc, len(Ha), len(Hb))  # Hc, Hu grid twice the Ha, Hb grid as in forc.py
+
+
+class SweepStage:
+    """ stage of a sweep: func(*inputs, **params) returns the outputs (tuple for several outputs)
+
+    params: names of the sweep parameters the stage depends on, active(point): False skips the stage
+    (its outputs are passed through unchanged)
+    """
+
+    def __init__(self, name, func, inputs, outputs, params=(), active=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.params = tuple(params)
+        self.active = active
+
+
+STAGES = (SweepStage('import', ImportStage, ['filename'], ['dd', 'fd'], ['dialect', 'dtype']),
+          SweepStage('drift', DriftStage, ['fd', 'dd'], ['fd'], ['polyorder', 'drift_model'],
+                     active=lambda point: point['drift']),
+          SweepStage('prepare', PrepareStage, ['fd'], ['fd', 'Halen', 'Hblen'], ['mirror']),
+          SweepStage('grid', GridStage, ['fd', 'Halen', 'Hblen'], ['Hb', 'Ha', 'M'], ['grid', 'resolution']),
+          SweepStage('convolve', ConvolveStage, ['Hb', 'Ha', 'M'], ['forc'],
+                     ['SF', 'nan_aware', 'SFmax', 'smoothing_lambda']),
+          SweepStage('rotate', RotateStage, ['Hb', 'Ha', 'forc'], ['Hc', 'Hu', 'forc_hchu']))
+
+
+def ParameterGrid(grid, defaults=DEFAULTS):
+    """ list of parameter dictionaries of all combinations of the values in grid (name -> list of values) """
+    unknown = set(grid) - set(defaults)
+    if unknown:
+        raise ValueError('unknown sweep parameters {}, use {}'.format(sorted(unknown), sorted(defaults)))
+    names = list(grid)
+    return [dict(defaults, **dict(zip(names, values))) for values in itertools.product(*(grid[n] for n in names))]
+
+
+def StageKey(name, params, inputs):
+    """ key of a stage result: stage name, its parameter values and the keys of its inputs """
+    text = json.dumps([name, sorted(params.items()), inputs], default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class StageCache:
+    """ stage results by key, least recently used ones are evicted above maxbytes """
+
+    def __init__(self, maxbytes=1 << 30):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()  # key -> (value, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def Get(self, key):
+        """ cached value of key (marked as recently used) or None """
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def Put(self, key, value):
+        if key in self.entries:
+            return
+        size = sum(Describe(v).get('nbytes', 0) for v in value)
+        self.entries[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.maxbytes and len(self.entries) > 1:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+
+    def Clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+class Node:
+    """ one stage run of the sweep DAG: stage, its parameters and the (key, output index) of each input """
+
+    def __init__(self, key, stage, params, inputs):
+        self.key = key
+        self.stage = stage
+        self.params = params
+        self.inputs = inputs
+
+    @property
+    def parents(self):
+        return {key for key, index in self.inputs if key is not None}
+
+
+class Sweep:
+    """ memoized parameter sweep over the processing of a FORC file
+
+    cache: StageCache shared between runs (default: new one of maxbytes)
+    jobs: worker threads or processes (executor 'thread' or 'process') for independent stages, 1: no pool
+    sinks: callables receiving a record (stage, params, seconds, cached) for each stage of the DAG
+    """
+
+    def __init__(self, stages=STAGES, cache=None, maxbytes=1 << 30, jobs=1, executor='thread', sinks=()):
+        if executor not in ('thread', 'process'):
+            raise ValueError("unknown executor '{}', use 'thread' or 'process'".format(executor))
+        self.stages = list(stages)
+        self.cache = StageCache(maxbytes) if cache is None else cache
+        self.jobs = jobs
+        self.executor = executor
+        self.sinks = list(sinks)
+
+    def Graph(self, filename, points):
+        """ DAG of the sweep points: nodes by key (in topological order) and the source of each result per point """
+        nodes = OrderedDict()
+        sources = []
+        filekey = FileHash(filename)
+        for point in points:
+            state = {'filename': (None, filename, filekey)}  # name -> (node key, output index or value, key)
+            for stage in self.stages:
+                if stage.active is not None and not stage.active(point):
+                    continue
+                params = {name: point[name] for name in stage.params}
+                inputs = [state[name] for name in stage.inputs]
+                key = StageKey(stage.name, params, [source[2] for source in inputs])
+                if key not in nodes:
+                    nodes[key] = Node(key, stage, params, [source[:2] for source in inputs])
+                state.update((name, (key, i, '{}:{}'.format(key, i))) for i, name in enumerate(stage.outputs))
+            sources.append({name: state[name][:2] for name in RESULTS})
+        return nodes, sources
+
+    def Run(self, filename, points):
+        """ process filename for each parameter dictionary of points (see ParameterGrid), returns for each point
+        a dictionary with its params and the result arrays Hb, Ha, M, forc, Hc, Hu, forc_hchu
+        """
+        points = [dict(DEFAULTS, **point) for point in points]
+        nodes, sources = self.Graph(filename, points)
+        done = {}
+        pending = OrderedDict(nodes)
+        pool = None
+        if self.jobs != 1:
+            pool = (ThreadPoolExecutor if self.executor == 'thread' else ProcessPoolExecutor)(max_workers=self.jobs)
+        try:
+            running = {}
+            while pending or running:
+                for key, node in list(pending.items()):
+                    if not node.parents <= set(done):
+                        continue
+                    del pending[key]
+                    value = self.cache.Get(key)
+                    if value is not None:
+                        done[key] = value
+                        self.Record(node, 0.0, True)
+                        continue
+                    # inputs are outputs of parent nodes or (key None) initial values
+                    args = [index if k is None else done[k][index] for k, index in node.inputs]
+                    if pool is None:
+                        start = timeit.default_timer()
+                        self.Finish(node, node.stage.func(*args, **node.params), timeit.default_timer() - start, done)
+                    else:
+                        running[pool.submit(TimedCall, node.stage.func, args, node.params)] = node
+                if running:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        result, seconds = future.result()
+                        self.Finish(running.pop(future), result, seconds, done)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        return [dict({name: done[key][index] for name, (key, index) in source.items()}, params=point)
+                for point, source in zip(points, sources)]
+
+    def Finish(self, node, result, seconds, done):
+        if len(node.stage.outputs) == 1:
+            result = (result,)
+        done[node.key] = tuple(result)
+        self.cache.Put(node.key, done[node.key])
+        self.Record(node, seconds, False)
+
+    def Record(self, node, seconds, cached):
+        record = {'stage': node.stage.name, 'params': node.params, 'seconds': seconds, 'cached': cached}
+        for sink in self.sinks:
+            sink(record)
+
+
+def TimedCall(func, args, kwargs):
+    """ func(*args, **kwargs) and its run time in seconds (in a pool worker) """
+    start = timeit.default_timer()
+    result = func(*args, **kwargs)
+    return result, timeit.default_timer() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='memoized parameter sweep over the processing of a FORC file')
+    parser.add_argument('file', help='FORC file')
+    parser.add_argument('-o', '--outdir', default=None, help='write each point as .forcr result to this directory')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='workers for independent stages (default: 1)')
+    parser.add_argument('--processes', action='store_true', help='use worker processes instead of threads')
+    parser.add_argument('--dialect', default='auto', help='file dialect (default: detect)')
+    parser.add_argument('--drift', action='store_true', help='do drift correction')
+    parser.add_argument('--sf', type=int, nargs='+', default=[None], help='smoothing factors')
+    parser.add_argument('--polyorder', type=int, nargs='+', default=[6], help='polynomial orders of drift correction')
+    parser.add_argument('--resolution', type=float, nargs='+', default=[1], help='grid resolutions (x FORC count)')
+    parser.add_argument('--grid', nargs='+', choices=('linear', 'structured'), default=['linear'],
+                        help='gridding methods')
+    args = parser.parse_args(argv)
+
+    points = ParameterGrid({'dialect': [args.dialect], 'drift': [args.drift], 'SF': args.sf,
+                            'polyorder': args.polyorder, 'resolution': args.resolution, 'grid': args.grid})
+    records = []
+    sweep = Sweep(jobs=args.jobs, executor='process' if args.processes else 'thread', sinks=[records.append])
+    start = timeit.default_timer()
+    results = sweep.Run(args.file, points)
+    seconds = timeit.default_timer() - start
+
+    print('{} points in {:.2f}s'.format(len(results), seconds))
+    for stage in sweep.stages:
+        runs = [r for r in records if r['stage'] == stage.name and not r['cached']]
+        if runs:
+            print('{:<10} {:4} runs {:8.3f}s'.format(stage.name, len(runs), sum(r['seconds'] for r in runs)))
+    if args.outdir:
+        from forc_store import EXTENSION, Provenance, SaveResult
+        os.makedirs(args.outdir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(args.file))[0]
+        provenance = Provenance(args.file)
+        for i, result in enumerate(results):
+            params = result.pop('params')
+            SaveResult(os.path.join(args.outdir, '{}.{:03d}{}'.format(stem, i, EXTENSION)), result, params=params,
+                       provenance=provenance)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+__author__ = 'wack'
+
+# Synthetic FORC data sets
+# writes MicroMag (and VFTB) formatted FORC files of configurable size for testing and benchmarking
+# moments from a Preisach model with a mixture of gaussian switching field distributions, optional
+# hysteresis loop and Msi sections, linear drift of the magnetization and gaussian measurement noise
+
+import numpy as np
+
+
+def NForcsForPoints(npoints):
+    """ number of FORCs needed to get roughly npoints data points (triangular FORC protocol) """
+    # n forcs with 1, 2, ... n points each -> n * (n + 1) / 2 points
+    return max(2, int(np.ceil((np.sqrt(8 * npoints + 1) - 1) / 2)))
+
+
+def SyntheticMoment(Ha, Hb, Ms=1e-5, Hc=0.03, sigma=0.01, chi=1e-6, Hu=0.0, components=None):
+    """ magnetic moment M(Ha, Hb) of a Preisach model with gaussian switching fields
+
+    components: list of (weight, Hc, Hu, sigma) for a mixture of populations, default one population Hc, Hu, sigma
+    """
+    from scipy.special import ndtr
+    if components is None:
+        components = [(1.0, Hc, Hu, sigma)]
+    total = sum(c[0] for c in components)
+
+    pdown = 0
+    for weight, hc, hu, s in components:
+        # hysterons switch down at beta ~ N(Hu - Hc, s) and up at alpha ~ N(Hu + Hc, s)
+        # after saturation, descent to Ha and ascent to Hb a hysteron is down if beta > Ha and alpha > Hb
+        pdown = pdown + weight / total * ndtr((hu - hc - Ha) / s) * ndtr((hu + hc - Hb) / s)
+    return Ms * (1 - 2 * pdown) + chi * Hb
+
+
+def SyntheticFORCs(nforcs, Hmin=-0.1, Hmax=0.1, **kwargs):
+    """ returns list of (Hb, M) arrays, one for each FORC, all with the same field step """
+    Has = np.linspace(Hmax, Hmin, nforcs, endpoint=False)[::-1]  # reversal fields
+    dH = Has[1] - Has[0]
+    curves = []
+    for Ha in Has:
+        Hb = Ha + dH * np.arange(int(round((Hmax - Ha) / dH)) + 1)
+        curves.append((Hb, SyntheticMoment(Ha, Hb, **kwargs)))
+    return curves
+
+
+def SyntheticSegments(nforcs, Hmin=-0.1, Hmax=0.1, hysteresis=False, msi=False, drift=0.0, noise=0.0, seed=None,
+                      **kwargs):
+    """ list of (field, moment) segments in measurement order
+
+    optional Ms point with hysteresis branches and Ms point with Msi(H) curve, then a drift (Ms) point before
+    each FORC and a final drift point. drift: relative linear change of the magnetization over the whole
+    measurement, noise: standard deviation of gaussian noise relative to Ms. kwargs are passed to SyntheticMoment
+    """
+    curves = SyntheticFORCs(nforcs, Hmin=Hmin, Hmax=Hmax, **kwargs)
+    dH = curves[1][0][0] - curves[0][0][0]
+    Ms = SyntheticMoment(Hmax, Hmax, **kwargs)  # drift measurement at saturating field
+    saturation = (np.array([Hmax]), np.array([Ms]))
+
+    segments = []
+    if hysteresis:
+        H = np.linspace(Hmax, Hmin, int(round((Hmax - Hmin) / dH)) + 1)
+        segments += [saturation,
+                     (H, SyntheticMoment(H, H, **kwargs)),  # descending branch: reversal at each field
+                     (H[::-1], SyntheticMoment(Hmin, H[::-1], **kwargs))]  # ascending branch from Hmin
+    if msi:
+        H = np.linspace(0, Hmax, int(round(Hmax / dH)) + 1)
+        # rough initial magnetization of a demagnetized state: mean of both hysteresis branches
+        msicurve = (SyntheticMoment(H, H, **kwargs) + SyntheticMoment(Hmin, H, **kwargs)) / 2 - Ms
+        segments += [saturation, (H, msicurve)]
+    for curve in curves:
+        segments += [saturation, curve]
+    segments.append(saturation)
+
+    # drift and noise over the measurement time (point count)
+    rng = np.random.default_rng(seed)
+    npoints = sum(len(H) for H, M in segments)
+    t = 0
+    measured = []
+    for H, M in segments:
+        time = (t + np.arange(len(H))) / max(npoints - 1, 1)
+        measured.append((H, M * (1 + drift * time) + rng.normal(0, noise * abs(Ms), len(H))))
+        t += len(H)
+    return measured
+
+
+def WriteMicroMagFORCFile(filename, npoints=None, nforcs=None, Hmin=-0.1, Hmax=0.1, hysteresis=False, msi=False,
+                          **kwargs):
+    """ write synthetic FORCs in (new) MicroMag format, either npoints or nforcs must be given
+
+    returns number of FORC points, kwargs are passed to SyntheticSegments (drift, noise, seed) and
+    SyntheticMoment (model parameters)
+    """
+    if nforcs is None:
+        nforcs = NForcsForPoints(npoints)
+
+    segments = SyntheticSegments(nforcs, Hmin=Hmin, Hmax=Hmax, hysteresis=hysteresis, msi=msi, **kwargs)
+
+    with open(filename, 'w') as f:
+        f.write('MicroMag 2900/3900 Data File (Series 0016)\n')
+        f.write('First-order reversal curves\n')
+        f.write('\n')
+        f.write('SCRIPT\n')
+        f.write('{:<31}{:+E}\n'.format('Averaging time', 0.1))
+        f.write('{:<31}{:+E}\n'.format('Hb1', Hmin))
+        f.write('{:<31}{:+E}\n'.format('Hb2', Hmax))
+        f.write('{:<31}{}\n'.format('Includes hysteresis loop?', 'Yes' if hysteresis else 'No'))
+        f.write('{:<31}{}\n'.format('Includes Msi(H)?', 'Yes' if msi else 'No'))
+        f.write('{:<31}{:d}\n'.format('Number of FORCs', nforcs))
+        f.write('\n\n')
+        f.write('    Field         Moment   \n')
+        f.write('\n')
+        WriteSegments(f, segments, '{:+E},{:+E}\n')
+        f.write('\n')
+        f.write('MicroMag 2900/3900 Data File ends\n')
+
+    return ForcPoints(segments, hysteresis, msi)
+
+
+def WriteVFTBFORCFile(filename, npoints=None, nforcs=None, Hmin=-0.1, Hmax=0.1, **kwargs):
+    """ write synthetic FORCs in VFTB format (tab separated field, moment, temperature columns) """
+    if nforcs is None:
+        nforcs = NForcsForPoints(npoints)
+
+    segments = SyntheticSegments(nforcs, Hmin=Hmin, Hmax=Hmax, **kwargs)
+
+    with open(filename, 'w') as f:
+        f.write('VFTB FORC measurement\n')
+        f.write('Sample: synthetic\n')
+        f.write('Number of FORCs: {:d}\n'.format(nforcs))
+        f.write('\n')
+        f.write('Field (T)\tMoment (Am2)\tTemperature (K)\n')
+        WriteSegments(f, segments, '{:.6E}\t{:.6E}\t293.0\n')
+
+    return ForcPoints(segments)
+
+
+def ForcPoints(segments, hysteresis=False, msi=False):
+    """ number of FORC points in segments as returned by SyntheticSegments """
+    skip = 3 * hysteresis + 2 * msi
+    return sum(len(H) for H, M in segments[skip + 1::2])
+
+
+def WriteSegments(f, segments, fmt):
+    """ write segments of (field, moment) values separated by empty lines """
+    for i, (H, M) in enumerate(segments):
+        if i > 0:
+            f.write('\n')
+        f.write(''.join(fmt.format(h, m) for h, m in zip(H, M)))
+
+
+if __name__ == '__main__':  # test routine
+    n = WriteMicroMagFORCFile('synthetic.forc', npoints=10000)
+    print('wrote {} forc points to synthetic.forc'.format(n))
+    n = WriteMicroMagFORCFile('synthetic_full.forc', npoints=10000, hysteresis=True, msi=True, drift=0.01,
+                              noise=1e-3, seed=0,
+                              components=[(0.7, 0.02, 0.0, 0.008), (0.3, 0.06, -0.005, 0.015)])
+    print('wrote {} forc points with hysteresis, msi, drift and noise to synthetic_full.forc'.format(n))
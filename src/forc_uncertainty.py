@@ -0,0 +1,142 @@
+__author__ = 'wack'
+
+# Uncertainty of FORC distributions
+# replicas of the measured moments are created from the noise of the repeated drift (Ms) measurements,
+# either gaussian noise or bootstrap resampling of the drift residuals, optionally with a resampled drift fit.
+# All replicas of a shard go through mirroring, gridding and convolution as one stacked array with one
+# precomputed grid operator, shards run on a pool of worker processes and are reduced to per pixel statistics.
+
+import os
+import sys
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from forc_convolution import DriftCorrection, DriftModel, SegmentIndex, MirrorIndex, PrepareForcData, \
+    ForcGridOperator, ConvolveForcGrid, FORC_KERNEL
+from forc_filter import MixedDerivativeKernel
+from forc_grid import SparseGridOperator
+
+METHODS = ('noise', 'bootstrap')
+
+
+def DriftResiduals(drift_df, model='poly', polyorder=6):
+    """ segment numbers, moments, fitted drift and residuals of the drift measurements """
+    x = np.asarray(drift_df['segment'], dtype=float)
+    y = np.asarray(drift_df['Moment'], dtype=float)
+    fit = DriftModel(x, y, model=model, polyorder=polyorder)(x)
+    return x, y, fit, y - fit
+
+
+def ReplicaMoments(shard, nreplicas, rng):
+    """ raw moments of nreplicas replicas (nreplicas, npoints) """
+    moment = shard['moment']
+    residuals = shard['residuals']
+    if shard['drift']:  # resample drift measurements, refit drift model and correct with it
+        factor = np.empty((nreplicas, len(moment)))
+        for r in range(nreplicas):
+            y = shard['driftfit'] + rng.choice(residuals, len(residuals))
+            drift = DriftModel(shard['driftx'], y, model=shard['drift_model'], polyorder=shard['polyorder'])
+            factor[r] = drift(1) / drift(shard['segstep'])
+        moments = moment * factor
+    else:
+        moments = np.broadcast_to(moment, (nreplicas, len(moment)))
+
+    if shard['method'] == 'noise':
+        return moments + rng.normal(0, residuals.std(), moments.shape)
+    return moments + rng.choice(residuals, moments.shape)
+
+
+def ReplicaShard(shard, nreplicas, seed):
+    """ process nreplicas replicas, returns count, mean, sum of squared deviations and count of positive values """
+    rng = np.random.default_rng(seed)
+    moments = ReplicaMoments(shard, nreplicas, rng)
+
+    # mirroring of all replicas at once, then gridding and convolution of the whole stack
+    if shard['mirror'] is not None:
+        source, anchor, mirrored = shard['mirror']
+        moments = np.where(mirrored, 2 * moments[:, anchor] - moments[:, source], moments[:, source])
+    grids = shard['operator'](moments)
+    forcs = ConvolveForcGrid(grids, k=shard['kernel'], nan_aware=shard['nan_aware'])
+
+    mean = forcs.mean(axis=0)
+    return nreplicas, mean, ((forcs - mean) ** 2).sum(axis=0), (forcs > 0).sum(axis=0)
+
+
+def CombineStatistics(a, b):
+    """ combine count, mean, sum of squared deviations and positive counts of two shards (Chan et al.) """
+    na, meana, m2a, posa = a
+    nb, meanb, m2b, posb = b
+    n = na + nb
+    delta = meanb - meana
+    return n, meana + delta * nb / n, m2a + m2b + delta ** 2 * na * nb / n, posa + posb
+
+
+def ForcUncertainty(forc_df, drift_df, nreplicas=1000, method='noise', drift=False, polyorder=6, drift_model='poly',
+                    mirror=True, grid='linear', SF=None, nan_aware=False, z=1.96, jobs=None, shardsize=50, seed=None):
+    """ per pixel uncertainty of the FORC distribution on the Ha, Hb grid from replicas of the measurement
+
+    forc_df, drift_df: imported (not drift corrected) data frames or ForcDatasets
+    method: 'noise' adds gaussian noise with the scatter of the drift measurements, 'bootstrap' adds drift
+            residuals resampled with replacement
+    drift: drift correct the data and resample the drift fit for each replica
+    jobs: number of worker processes (all cores by default, 1: no pool), shardsize: replicas per task
+    returns dictionary with axes Hb, Ha, FORC distribution forc, replica mean, standard error stderr, z score
+    zscore, significance mask significant (|zscore| > z) and fraction of positive replicas positive
+    """
+    if method not in METHODS:
+        raise ValueError("unknown method '{}', use one of {}".format(method, METHODS))
+
+    driftx, drifty, driftfit, residuals = DriftResiduals(drift_df, model=drift_model, polyorder=polyorder)
+
+    # nominal result, also builds the grid operator
+    fd = forc_df
+    if drift:
+        fd = DriftCorrection(forc_df, drift_df, polyorder=polyorder, model=drift_model)
+    prepared, Halen, Hblen = PrepareForcData(fd, mirror=mirror)
+    Hb, Ha, operator = ForcGridOperator(prepared, Halen, Hblen, method=grid)
+    M = operator(np.asarray(prepared['Moment'], dtype=float))
+    kernel = FORC_KERNEL if SF is None else MixedDerivativeKernel(SF)
+    forc = ConvolveForcGrid(M, k=kernel, nan_aware=nan_aware)
+
+    segments = np.asarray(forc_df['segment'])
+    shard = {'moment': np.asarray(forc_df['Moment'], dtype=float), 'residuals': residuals, 'method': method,
+             'drift': drift, 'driftx': driftx, 'driftfit': driftfit, 'drift_model': drift_model,
+             'polyorder': polyorder, 'kernel': kernel, 'nan_aware': nan_aware,
+             # plain sparse operator: no triangulation to send to the workers
+             'operator': SparseGridOperator(operator.matrix, operator.xi, operator.yi, operator.outside),
+             'mirror': MirrorIndex(*SegmentIndex(segments)[:3]) if mirror else None}
+    if drift:
+        shard['segstep'] = np.asarray(fd['segstep'])
+
+    sizes = [min(shardsize, nreplicas - start) for start in range(0, nreplicas, shardsize)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if jobs == 1:
+        results = [ReplicaShard(shard, n, s) for n, s in zip(sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(ReplicaShard, [shard] * len(sizes), sizes, seeds))
+
+    stats = results[0]
+    for r in results[1:]:
+        stats = CombineStatistics(stats, r)
+    n, mean, m2, positive = stats
+
+    stderr = np.sqrt(m2 / max(n - 1, 1))
+    zscore = np.divide(forc, stderr, out=np.full(forc.shape, np.nan), where=stderr > 0)
+    return {'Hb': Hb, 'Ha': Ha, 'forc': forc, 'mean': mean, 'stderr': stderr, 'zscore': zscore,
+            'significant': np.absolute(zscore) > z, 'positive': positive / n, 'nreplicas': n}
+
+
+if __name__ == '__main__':  # test routine
+    from forc_convolution import FastImportFORCData
+
+    fname = sys.argv[1] if len(sys.argv) > 1 else '../data/FeNi100-A-a-24-M001_005.forc'
+    dd, fd = FastImportFORCData(fname, dialect='auto')
+    start_time = timeit.default_timer()
+    result = ForcUncertainty(fd, dd, nreplicas=1000, method='bootstrap', drift=True)
+    print("Seconds for {} replicas on {} cores: {}".format(result['nreplicas'], os.cpu_count(),
+                                                           timeit.default_timer() - start_time))
+    print("median standard error: {}".format(np.nanmedian(result['stderr'])))
+    print("significant pixels: {:.1%}".format(np.mean(result['significant'])))
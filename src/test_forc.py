@@ -0,0 +1,44 @@
+__author__ = 'wack'
+
+# regression test of the vectorized FORC distribution of forc.py against the per pixel fits of the original
+# processing (python -m pytest in src)
+
+import numpy as np
+import pytest
+
+from forc import compute_forc_distribution, fitPolySurface
+
+
+def PixelFits(zi, SF):
+    """ FORC distribution by fitting fitPolySurface to the subarea of every pixel, as forc.py did originally """
+    n = 2 * SF + 1
+    x, y = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')  # x: row, y: column of the subarea
+    forc = np.full(zi.shape, np.nan)
+    for i in range(SF, zi.shape[0] - SF):
+        for j in range(SF, zi.shape[1] - SF):
+            fitdata = zi[i - SF:i + SF + 1, j - SF:j + SF + 1]
+            forc[i, j] = -0.5 * fitPolySurface(x.ravel(), y.ravel(), fitdata.ravel())[0][5]
+    return forc
+
+
+def GridWithHoles(shape=(30, 34), seed=0):
+    """ smooth surface with noise and nan regions: FORC like triangle, a block larger than the subareas and
+    isolated points (rank deficient fits)
+    """
+    rng = np.random.default_rng(seed)
+    rows, columns = np.meshgrid(np.linspace(-1, 1, shape[0]), np.linspace(-1, 1, shape[1]), indexing='ij')
+    zi = np.tanh(3 * columns + rows) + 0.3 * rows * columns + 0.01 * rng.standard_normal(shape)
+    zi[columns < rows - 0.6] = np.nan
+    zi[2:10, 20:29] = np.nan
+    zi[rng.random(shape) < 0.05] = np.nan
+    zi[15, 3:9] = np.nan  # a whole row of some subareas
+    return zi
+
+
+@pytest.mark.parametrize('SF', [1, 2, 3])
+def test_matches_pixel_fits(SF):
+    zi = GridWithHoles()
+    expected = PixelFits(zi, SF)
+    forc = compute_forc_distribution(zi, SF=SF)
+    np.testing.assert_array_equal(np.isnan(forc), np.isnan(expected))
+    np.testing.assert_allclose(forc, expected, rtol=1e-9, atol=1e-12)
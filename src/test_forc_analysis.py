@@ -0,0 +1,49 @@
+__author__ = 'wack'
+
+# tests of the parameter table of forc_analysis (python -m pytest in src)
+
+import csv
+
+import numpy as np
+
+import forc_analysis
+import forc_series
+from forc_batch import BatchWorker
+from forc_filter import MixedDerivativeKernel
+from forc_store import OpenResult
+from forc_synthetic import WriteMicroMagFORCFile
+
+
+def test_batch_and_series_results_in_one_table(tmp_path):
+    """ series results (normalized, with irreversible_fraction) and batch results (without) mix in one table """
+    files = []
+    for i in range(2):
+        files.append(str(tmp_path / 'specimen{}.forc'.format(i)))
+        WriteMicroMagFORCFile(files[-1], nforcs=15, seed=i)
+    status = BatchWorker(files[0], str(tmp_path))
+    assert status['ok'], status.get('error')
+    series = str(tmp_path / 'series.forcr')
+    assert forc_series.main(files + ['-o', series]) == 0
+
+    table = str(tmp_path / 'parameters.csv')
+    assert forc_analysis.main([status['output'], series, '-o', table]) == 0
+    with open(table, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [row['name'] for row in rows] == ['specimen0', 'specimen0', 'specimen1']
+    assert rows[0]['irreversible_fraction'] == ''
+    assert all(float(row['irreversible_fraction']) > 0 for row in rows[1:])
+
+
+def test_variable_smoothing_scale(tmp_path):
+    """ results of variable smoothing are scaled as Savitzky-Golay results, not with the default kernel """
+    fname = str(tmp_path / 'specimen.forc')
+    WriteMicroMagFORCFile(fname, nforcs=15)
+    status = BatchWorker(fname, str(tmp_path), SFmax=4)
+    assert status['ok'], status.get('error')
+    row = forc_analysis.AnalyseResultFile(status['output'])[0]
+    with OpenResult(status['output']) as result:
+        data = {key: np.asarray(result[key]) for key in ('Hb', 'Ha', 'forc', 'Hc', 'Hu', 'forc_hchu')}
+    expected = forc_analysis.AnalyseForc(data['Hc'], data['Hu'], data['forc_hchu'], hb=data['Hb'], ha=data['Ha'],
+                                         forc=data['forc'], k=MixedDerivativeKernel(2))
+    for key in ('moment_integral', 'ridge_height', 'reversible'):
+        assert row[key] == float(expected[key])
@@ -0,0 +1,126 @@
+__author__ = 'wack'
+
+# tests of the sparse grid operators of forc_grid against scipy interpolation and of their caches
+# (python -m pytest in src)
+
+import numpy as np
+from scipy.interpolate import LinearNDInterpolator, RegularGridInterpolator, griddata
+
+import forc_grid
+from forc_grid import LRUDict, CachedDelaunay, GridOperator, StructuredGridOperator, rotate_to_hc_hu
+
+
+def ScatteredPoints(n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(-1, 1, (n, 2))
+    values = np.sin(3 * points[:, 0]) * np.cos(2 * points[:, 1]) + points[:, 0] * points[:, 1]
+    return points, values
+
+
+def test_linear_operator_matches_griddata():
+    points, values = ScatteredPoints()
+    xi, yi = np.linspace(-1.1, 1.1, 37), np.linspace(-1.1, 1.1, 29)  # partly outside of the convex hull
+    operator = GridOperator(points, xi, yi)
+    mg_x, mg_y = np.meshgrid(xi, yi)
+    expected = griddata(points, values, (mg_x, mg_y), method='linear')
+    result = operator(values)
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected, rtol=1e-10, atol=1e-12)
+
+    # stacks of value arrays on the same points
+    stack = np.stack((values, 2 * values, values ** 2))
+    expected = np.stack([LinearNDInterpolator(points, v)(mg_x, mg_y) for v in stack])
+    np.testing.assert_allclose(operator(stack), expected, rtol=1e-10, atol=1e-12)
+
+
+def test_operators_are_reused():
+    points, values = ScatteredPoints(seed=1)
+    xi, yi = np.linspace(-1, 1, 21), np.linspace(-1, 1, 23)
+    forc_grid.OPERATORS.clear()
+    forc_grid.TRIANGULATIONS.clear()
+    first = GridOperator(points, xi, yi)
+    # same content in new arrays gives the cached operator and triangulation
+    assert GridOperator(points.copy(), xi.copy(), yi.copy()) is first
+    assert CachedDelaunay(points.copy()) is CachedDelaunay(points)
+    assert len(forc_grid.OPERATORS) == 1 and len(forc_grid.TRIANGULATIONS) == 1
+    # another target grid reuses the triangulation only
+    assert GridOperator(points, xi, yi[:-1]) is not first
+    assert len(forc_grid.OPERATORS) == 2 and len(forc_grid.TRIANGULATIONS) == 1
+
+
+def test_lru_eviction():
+    calls = []
+
+    def Factory(value):
+        def Create():
+            calls.append(value)
+            return value
+        return Create
+
+    d = LRUDict(maxsize=2)
+    assert d.Get('a', Factory(1)) == 1
+    assert d.Get('b', Factory(2)) == 2
+    assert d.Get('a', Factory(-1)) == 1  # hit, 'a' becomes the most recently used
+    assert d.Get('c', Factory(3)) == 3  # evicts 'b'
+    assert list(d) == ['a', 'c']
+    assert d.Get('b', Factory(4)) == 4  # created again, evicts 'a'
+    assert list(d) == ['c', 'b']
+    assert calls == [1, 2, 3, 4]
+
+
+def StructuredReference(curves, Ha, Hb, M, xi, yi):
+    """ interpolation of each curve along Hb, then between the neighbouring curves along Ha (loops) """
+    labels = np.unique(curves)
+    curveHa = np.array([Ha[curves == c][0] for c in labels])
+    alongHb = []
+    for c in labels:
+        order = np.argsort(Hb[curves == c])
+        hb, m = Hb[curves == c][order], M[curves == c][order]
+        alongHb.append(np.where((xi >= hb[0]) & (xi <= hb[-1]), np.interp(xi, hb, m), np.nan))
+    alongHb = np.array(alongHb)[np.argsort(curveHa)]
+    curveHa = np.sort(curveHa)
+    grid = np.full((len(yi), len(xi)), np.nan)
+    for i, ha in enumerate(yi):
+        if ha < curveHa[0] or ha > curveHa[-1]:
+            continue
+        j = min(np.searchsorted(curveHa, ha, side='right') - 1, len(curveHa) - 2)
+        w = (ha - curveHa[j]) / (curveHa[j + 1] - curveHa[j])
+        if w == 0:  # on a curve: the neighbouring curve may be nan there
+            grid[i] = alongHb[j]
+        elif w == 1:
+            grid[i] = alongHb[j + 1]
+        else:
+            grid[i] = (1 - w) * alongHb[j] + w * alongHb[j + 1]
+    return grid
+
+
+def test_structured_operator_matches_curve_interpolation():
+    rng = np.random.default_rng(2)
+    curves, Ha, Hb = [], [], []
+    for c, ha in enumerate(np.sort(rng.uniform(-1, 1, 12))):
+        hb = np.sort(np.append(ha, rng.uniform(ha, 1, 15)))  # each FORC starts at its reversal field
+        curves.append(np.full(len(hb), c))
+        Ha.append(np.full(len(hb), ha))
+        Hb.append(hb)
+    curves, Ha, Hb = np.concatenate(curves), np.concatenate(Ha), np.concatenate(Hb)
+    M = np.tanh(2 * Hb) + 0.2 * Ha
+    shuffle = rng.permutation(len(M))  # the operator does not need sorted points
+    xi, yi = np.linspace(-1, 1, 31), np.linspace(-1.05, 1.05, 25)
+    operator = StructuredGridOperator(curves[shuffle], Ha[shuffle], Hb[shuffle], xi, yi)
+    expected = StructuredReference(curves, Ha, Hb, M, xi, yi)
+    result = operator(M[shuffle])
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_rotation_matches_bilinear_interpolation():
+    xi, yi = np.linspace(-1, 1, 41), np.linspace(-1, 0.5, 31)
+    Hb, Ha = np.meshgrid(xi, yi)
+    grid = np.sin(2 * Hb) * np.cos(Ha) + Ha * Hb
+    hc, hu, result = rotate_to_hc_hu(grid, (xi, yi), hc=50, hu=60)
+    mg_hc, mg_hu = np.meshgrid(hc, hu)
+    interpolator = RegularGridInterpolator((yi, xi), grid, method='linear', bounds_error=False, fill_value=np.nan)
+    expected = interpolator(np.stack(((mg_hu - mg_hc).ravel(), (mg_hu + mg_hc).ravel()), axis=-1)).reshape(
+        mg_hc.shape)
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))  # nan outside of the Ha, Hb grid
+    np.testing.assert_allclose(result, expected, rtol=1e-10, atol=1e-12)
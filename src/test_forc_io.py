@@ -0,0 +1,46 @@
+__author__ = 'wack'
+
+# tests of the file dialect detection of forc_io (python -m pytest in src)
+
+import pytest
+
+from forc_io import ReadMeasurement, SniffDialect
+from forc_synthetic import WriteMicroMagFORCFile, WriteVFTBFORCFile
+
+
+def test_vftb_without_name_in_header(tmp_path):
+    """ VFTB files are recognized by their structure, the header need not mention VFTB """
+    fname = str(tmp_path / 'sample.frc')
+    WriteVFTBFORCFile(fname, nforcs=10)
+    with open(fname) as f:
+        lines = f.readlines()
+    with open(fname, 'w') as f:
+        f.write('Mag-Instruments FORC measurement\n')
+        f.writelines(lines[1:])
+    assert SniffDialect(fname) == 'vftb'
+    assert len(ReadMeasurement(fname).forc) > 0
+
+
+def test_comma_separated_vftb(tmp_path):
+    fname = str(tmp_path / 'sample.frc')
+    with open(fname, 'w') as f:
+        f.write('Sample: test\n\nField,Moment\n')
+        for h in range(10):
+            f.write('{:.3f},{:.3E}\n'.format(0.1 - h * 0.01, 1e-5 - h * 1e-6))
+    assert SniffDialect(fname) == 'vftb'
+
+
+def test_micromag_sniffed_as_micromag(tmp_path):
+    fname = str(tmp_path / 'sample.forc')
+    WriteMicroMagFORCFile(fname, nforcs=10)
+    assert SniffDialect(fname) == 'micromag'
+
+
+@pytest.mark.parametrize('content', ['garbage\n', 'Sample: test\n1.0 2.0\nmore text\n3.0 4.0\n5.0 6.0\n7.0 8.0\n',
+                                     '1.0 2.0\n1.0 2.0 3.0\n1.0 2.0\n1.0 2.0\n', 'a b\n1\n2\n3\n4\n'])
+def test_unknown_dialect(tmp_path, content):
+    fname = str(tmp_path / 'sample.dat')
+    with open(fname, 'w') as f:
+        f.write(content)
+    with pytest.raises(Exception, match='unknown dialect'):
+        SniffDialect(fname)
@@ -0,0 +1,52 @@
+__author__ = 'wack'
+
+# tests of the live processing of forc_live against the one-shot processing (python -m pytest in src)
+
+import numpy as np
+import pytest
+
+from forc_convolution import FastImportFORCData, PrepareForcData, GridForcData
+from forc_filter import Convolve
+from forc_live import LiveFORCProcessor
+from forc_synthetic import WriteMicroMagFORCFile, WriteVFTBFORCFile
+
+
+def FeedInChunks(source, live, seed=0):
+    """ append source to live in random byte chunks, processing after each chunk """
+    with open(source, 'rb') as f:
+        data = f.read()
+    open(live, 'wb').close()
+    processor = LiveFORCProcessor(live)
+    rng = np.random.default_rng(seed)
+    pos = 0
+    while pos < len(data):
+        n = int(rng.integers(1, 400))
+        with open(live, 'ab') as f:
+            f.write(data[pos:pos + n])
+        pos += n
+        processor.Step()
+    return processor
+
+
+@pytest.mark.parametrize('write, extension, options', [(WriteMicroMagFORCFile, '.forc', {}),
+                                                      (WriteMicroMagFORCFile, '.forc', {'hysteresis': True,
+                                                                                        'msi': True}),
+                                                      (WriteVFTBFORCFile, '.frc', {})])
+def test_chunked_live_processing(tmp_path, write, extension, options):
+    source, live = str(tmp_path / ('source' + extension)), str(tmp_path / ('live' + extension))
+    write(source, nforcs=20, **options)
+    processor = FeedInChunks(source, live)
+    grid = processor.grid
+    assert len(grid.Ha) == 20
+
+    # band wise updates give the convolution of the whole grid
+    k = grid.kernel[::-1] if grid.descending else grid.kernel
+    np.testing.assert_array_equal(grid.forc, Convolve(grid.M, k, mode='reflect'))
+
+    # the grid is the structured gridding of the complete file
+    hb, ha, M, forc = grid.Diagram()
+    dd, fd = FastImportFORCData(source, dialect='auto')
+    fd, Halen, Hblen = PrepareForcData(fd, mirror=True)
+    xi, yi, expected = GridForcData(fd, len(ha), len(hb), method='structured', axes=(hb, ha))
+    np.testing.assert_array_equal(np.isnan(M), np.isnan(expected))
+    np.testing.assert_allclose(M, expected, rtol=0, atol=1e-12 * np.nanmax(np.absolute(expected)))
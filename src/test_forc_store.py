@@ -0,0 +1,87 @@
+__author__ = 'wack'
+
+# round trip and lazy slicing tests of the .forcr result files of forc_store (python -m pytest in src)
+
+import numpy as np
+import pytest
+
+from forc_store import CHUNK, ForcResult, OpenResult, SaveResult, ConvertResult
+
+
+def Arrays(seed=0):
+    rng = np.random.default_rng(seed)
+    grid = rng.standard_normal((2 * CHUNK + 7, CHUNK + 3))  # chunk boundaries inside and a partial last chunk
+    grid[5:40, 100:150] = np.nan
+    return {'forc': grid,
+            'stack': rng.standard_normal((3, CHUNK + 5, 2 * CHUNK + 1)).astype(np.float32),
+            'Hb': np.linspace(-0.1, 0.1, grid.shape[1]),  # small, stored uncompressed
+            'labels': np.arange(5000, dtype=np.int64),
+            'Ms': np.float64(1.5e-5),
+            'normalized': np.bool_(True),
+            'names': np.array(['a', 'run1__b', 'ü'])}
+
+
+@pytest.fixture
+def result(tmp_path):
+    arrays = Arrays()
+    filename = str(tmp_path / 'result.forcr')
+    SaveResult(filename, arrays, params={'SF': 3, 'grid': 'linear'}, provenance={'source': 'x.forc'})
+    with ForcResult(filename) as r:
+        yield arrays, r
+
+
+def test_round_trip(result):
+    arrays, r = result
+    assert sorted(r.files) == sorted(arrays)
+    assert r.params == {'SF': 3, 'grid': 'linear'} and r.provenance == {'source': 'x.forc'}
+    for name, expected in arrays.items():
+        value = np.asarray(r[name])
+        assert value.shape == np.shape(expected) and value.dtype == np.asarray(expected).dtype, name
+        np.testing.assert_array_equal(value, expected)
+    assert r['forc'].compressed and r['stack'].compressed and not r['Hb'].compressed
+    assert float(np.asarray(r['Ms'])) == 1.5e-5 and bool(np.asarray(r['normalized']))
+
+
+KEYS = [np.s_[...], np.s_[0], np.s_[-1], np.s_[CHUNK - 1:CHUNK + 1], np.s_[CHUNK:], np.s_[::-1],
+        np.s_[::7, ::-3], np.s_[-5:3:-2, 10], np.s_[3, -1], np.s_[200:100], np.s_[-CHUNK - 2:-1:5, CHUNK - 2::2],
+        np.s_[1:1, :], np.s_[CHUNK + 3:CHUNK - 3:-1, ::CHUNK]]
+
+
+@pytest.mark.parametrize('key', KEYS)
+def test_slicing_matches_numpy(result, key):
+    arrays, r = result
+    for name in ('forc', 'Hb', 'labels'):
+        k = key if name == 'forc' else (key[0] if isinstance(key, tuple) else key)
+        np.testing.assert_array_equal(r[name][k], arrays[name][k])
+
+
+def test_stack_slicing(result):
+    arrays, r = result
+    for key in (np.s_[1], np.s_[:, CHUNK], np.s_[::-1, -3:, 5::40], np.s_[-1, ..., CHUNK - 1:CHUNK + 2]):
+        np.testing.assert_array_equal(r['stack'][key], arrays['stack'][key])
+
+
+def test_invalid_indices(result):
+    arrays, r = result
+    with pytest.raises(IndexError):
+        r['forc'][arrays['forc'].shape[0]]
+    with pytest.raises(IndexError):
+        r['forc'][0, 0, 0]
+    with pytest.raises(IndexError):
+        r['forc'][[1, 2]]
+
+
+def test_uncompressed_and_npz_conversion(tmp_path):
+    arrays = Arrays(seed=1)
+    filename = str(tmp_path / 'plain.forcr')
+    SaveResult(filename, arrays, compress=False)
+    with OpenResult(filename) as r:
+        assert not r['forc'].compressed
+        np.testing.assert_array_equal(r['forc'].Memmap(), arrays['forc'])
+        np.testing.assert_array_equal(r['forc'][::-2, 3], arrays['forc'][::-2, 3])
+
+    npz = str(tmp_path / 'result.npz')
+    np.savez(npz, **arrays)
+    with OpenResult(ConvertResult(npz)) as r:
+        for name, expected in arrays.items():
+            np.testing.assert_array_equal(np.asarray(r[name]), expected)
@@ -0,0 +1,38 @@
+__author__ = 'wack'
+
+# import time budget of the processing modules (python -m pytest in src)
+# heavy packages must be imported on first use, not when a module is loaded
+
+import json
+import os
+import subprocess
+import sys
+
+from forc_benchmark import STARTUP_BUDGET
+
+MODULES = ('forc', 'forc_convolution', 'forc_grid', 'forc_filter', 'forc_io')
+HEAVY = ('matplotlib.pyplot', 'pandas', 'scipy.interpolate')
+
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import {modules}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def ImportInFreshInterpreter():
+    script = SCRIPT.format(modules=', '.join(MODULES), heavy=HEAVY)
+    run = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+                         capture_output=True, text=True)
+    return json.loads(run.stdout)
+
+
+def test_no_heavy_imports():
+    assert ImportInFreshInterpreter()['loaded'] == []
+
+
+def test_import_time_within_budget():
+    seconds = min(ImportInFreshInterpreter()['seconds'] for i in range(3))  # best of three, the first warms caches
+    assert seconds <= STARTUP_BUDGET